@@ -1,4 +1,5 @@
 from django.contrib import admin
+from . import search, teams
 from .models import UserProfile, Team, Activity, Leaderboard, Workout
 
 
@@ -29,11 +30,7 @@ class TeamAdmin(admin.ModelAdmin):
     list_filter = ['created_at']
     search_fields = ['name', 'description', 'captain__username']
     filter_horizontal = ['members']
-    readonly_fields = ['created_at', 'updated_at']
-    
-    def member_count(self, obj):
-        return obj.members.count()
-    member_count.short_description = 'Members'
+    readonly_fields = ['member_count', 'total_points', 'created_at', 'updated_at']
     
     fieldsets = (
         ('Team Information', {
@@ -43,13 +40,20 @@ class TeamAdmin(admin.ModelAdmin):
             'fields': ('members',)
         }),
         ('Statistics', {
-            'fields': ('total_points',)
+            'fields': ('member_count', 'total_points')
         }),
         ('Timestamps', {
             'fields': ('created_at', 'updated_at'),
             'classes': ('collapse',)
         }),
     )
+    
+    def save_model(self, request, obj, form, change):
+        """Leave the member count and totals to their own atomic updates"""
+        if change:
+            teams.save_team(obj)
+        else:
+            super().save_model(request, obj, form, change)
 
 
 @admin.register(Activity)
@@ -105,6 +109,7 @@ class WorkoutAdmin(admin.ModelAdmin):
     list_filter = ['difficulty', 'activity_type', 'created_at']
     search_fields = ['title', 'description', 'activity_type']
     readonly_fields = ['created_at', 'updated_at']
+    search_help_text = 'Matches whole words of titles, activity types, descriptions, exercises and target muscles'
     
     fieldsets = (
         ('Workout Information', {
@@ -121,3 +126,10 @@ class WorkoutAdmin(admin.ModelAdmin):
             'classes': ('collapse',)
         }),
     )
+    
+    def get_search_results(self, request, queryset, search_term):
+        """Look words up in the search index instead of regex scans of every workout"""
+        if not search_term.strip():
+            return queryset, False
+        _, ranked, _ = search.index.search(search_term, limit=None)
+        return queryset.filter(_id__in=[workout_id for workout_id, _ in ranked]), False
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.db.models.signals import post_migrate
+
+
+class OctofitTrackerConfig(AppConfig):
+    name = 'octofit_tracker'
+
+    def ready(self):
+        from . import profiling, signals
+        post_migrate.connect(signals.sync_indexes, sender=self)
+        if profiling.is_enabled():
+            # Before any connection exists, so the Mongo listener attaches
+            profiling.install()
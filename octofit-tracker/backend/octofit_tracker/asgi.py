@@ -2,6 +2,8 @@
 ASGI config for octofit_tracker project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+The leaderboard event stream is only served here, so run the backend under an
+ASGI server, e.g. ``uvicorn octofit_tracker.asgi:application``.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.1/howto/deployment/asgi/
@@ -13,4 +15,21 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'octofit_tracker.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after setup: the stream needs the app registry
+from django.conf import settings  # noqa: E402
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler  # noqa: E402
+
+from octofit_tracker.realtime import STREAM_PATH, leaderboard_stream  # noqa: E402
+
+if settings.DEBUG:
+    # Serve the admin's static files the way runserver does
+    django_application = ASGIStaticFilesHandler(django_application)
+
+
+async def application(scope, receive, send):
+    """Serve the leaderboard event stream directly and everything else through Django"""
+    if scope['type'] == 'http' and scope['path'] == STREAM_PATH:
+        return await leaderboard_stream(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,107 @@
+"""
+Async entry points for the hottest read endpoints.
+
+Under ASGI Django runs a sync view with ``sync_to_async``, so every request
+in flight blocks a thread of its own on djongo for as long as its Mongo
+reads take, and nothing bounds how many do at once. The views here are
+async: under ASGI they hand the existing DRF view to a shared, bounded
+thread pool and await it. At most ``ASYNC_READ_POOL_SIZE`` threads block on
+the database, and requests waiting for a slot cost a coroutine. Once more
+than ``ASYNC_READ_MAX_PENDING`` are waiting, new ones get a 503 instead of
+growing the queue without bound.
+
+Django's own middleware still hops briefly onto a per-request thread, so
+the pool bounds blocking database work rather than the raw thread count.
+Each pool thread keeps its own database connection (Django connections are
+per thread), so the pool size also bounds the number of Mongo clients.
+
+Under WSGI, and with ``ASYNC_READ_POOL_SIZE = 0``, the views run the same
+way plain sync views do. The profiling middleware attributes work per
+thread, so it doesn't see queries made on the pool.
+"""
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse
+
+from .views import ActivityViewSet, LeaderboardViewSet
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def get_executor():
+    """Return the shared read pool, or None when disabled"""
+    global _executor
+    size = getattr(settings, 'ASYNC_READ_POOL_SIZE', 16)
+    if not size:
+        return None
+    with _executor_lock:
+        if _executor is None or _executor._max_workers != size:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='async-read')
+    return _executor
+
+
+def _acquire():
+    global _pending
+    with _pending_lock:
+        if _pending >= getattr(settings, 'ASYNC_READ_MAX_PENDING', 10000):
+            return False
+        _pending += 1
+        return True
+
+
+def _release():
+    global _pending
+    with _pending_lock:
+        _pending -= 1
+
+
+def _render(view, request, *args, **kwargs):
+    # Render on the worker thread; the handler skips already rendered responses
+    response = view(request, *args, **kwargs)
+    if hasattr(response, 'render') and callable(response.render):
+        response.render()
+    return response
+
+
+def pooled(view):
+    """Wrap a sync view so ASGI requests run it on the bounded read pool"""
+    @wraps(view)
+    async def async_view(request, *args, **kwargs):
+        executor = get_executor()
+        if executor is None or not isinstance(request, ASGIRequest):
+            return await sync_to_async(_render, thread_sensitive=True)(view, request, *args, **kwargs)
+        if not _acquire():
+            response = JsonResponse({'detail': 'Server busy, try again shortly'}, status=503)
+            response['Retry-After'] = '1'
+            return response
+        try:
+            future = executor.submit(partial(_render, view, request, *args, **kwargs))
+            return await asyncio.wrap_future(future)
+        finally:
+            _release()
+    return async_view
+
+
+leaderboard_list = pooled(LeaderboardViewSet.as_view(
+    {'get': 'list'}, basename='leaderboard', detail=False
+))
+my_activities = pooled(ActivityViewSet.as_view(
+    {'get': 'my_activities'}, basename='activity', detail=False
+))
+activity_stats = pooled(ActivityViewSet.as_view(
+    {'get': 'stats'}, basename='activity', detail=False
+))
+activity_timeseries = pooled(ActivityViewSet.as_view(
+    {'get': 'timeseries'}, basename='activity', detail=False
+))
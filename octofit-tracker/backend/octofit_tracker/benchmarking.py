@@ -0,0 +1,179 @@
+"""
+Helpers shared by the benchmark management commands.
+
+Benchmarks run against a throwaway test database (the same one the test
+runner creates) so they never touch the development data.
+"""
+import random
+import statistics
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from pymongo import InsertOne, monitoring
+
+from .models import Activity
+from .mongo import bulk_write, get_collection, to_mongo_datetime
+
+ACTIVITY_TYPES = [choice for choice, _ in Activity.ACTIVITY_TYPES]
+
+
+@contextmanager
+def isolated_database(verbosity=1):
+    """Create a fresh test database for the duration of the block"""
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+@contextmanager
+def timed(results, name):
+    """Record the wall-clock seconds spent in the block under ``results[name]``"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        results[name] = time.perf_counter() - start
+
+
+def seed_users(count, prefix='bench', batch_size=1000):
+    """Bulk create ``count`` users and return their ids"""
+    User.objects.bulk_create(
+        (User(username=f'{prefix}{index}') for index in range(count)),
+        batch_size=batch_size,
+    )
+    return list(User.objects.filter(username__startswith=prefix).values_list('id', flat=True))
+
+
+def seed_activities(user_ids, per_user, seed=0, days=90):
+    """Insert ``per_user`` random activities for every user straight into Mongo"""
+    rng = random.Random(seed)
+    start = timezone.now()
+
+    def documents():
+        for user_id in user_ids:
+            for _ in range(per_user):
+                duration = rng.randint(10, 120)
+                yield {
+                    'user_id': user_id,
+                    'activity_type': rng.choice(ACTIVITY_TYPES),
+                    'duration': duration,
+                    'distance': round(rng.uniform(0, 20), 2),
+                    'calories': duration * 8,
+                    'points_earned': duration,
+                    'notes': None,
+                    'date': to_mongo_datetime(start - timedelta(days=rng.randint(0, days))),
+                    'created_at': to_mongo_datetime(start),
+                }
+
+    return insert_documents(get_collection(Activity), documents())
+
+
+def insert_documents(collection, documents, batch_size=10000):
+    """Insert an iterable of documents in batches and return the count"""
+    return bulk_write(collection, (InsertOne(doc) for doc in documents), batch_size=batch_size)
+
+
+class CommandCounter(monitoring.CommandListener):
+    """
+    Counts the commands pymongo sends, i.e. database round trips.
+
+    This sees native pymongo calls as well as the ones djongo makes for the
+    ORM. Listeners only apply to clients created after ``register()``, so
+    call it before the benchmark database is connected.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def register(self):
+        monitoring.register(self)
+        return self
+
+    @property
+    def count(self):
+        return getattr(self._local, 'count', 0)
+
+    def started(self, event):
+        self._local.count = self.count + 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def percentile(sorted_samples, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    index = max(0, min(len(sorted_samples) - 1, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def measure(run, repeat=50, warmup=5, setup=None, commands=None):
+    """
+    Time ``run()`` and count what each call costs.
+
+    ``setup()``, if given, runs untimed before every call. Latency comes
+    from plain runs; SQL queries, Mongo round trips (with a
+    ``CommandCounter``) and allocations are measured on separate runs so
+    tracing doesn't skew the timings. Returns a dict of summary figures,
+    latencies in milliseconds.
+    """
+    for _ in range(warmup):
+        if setup:
+            setup()
+        run()
+
+    latencies = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+
+    queries = []
+    round_trips = []
+    allocations = []
+    for _ in range(max(1, min(repeat, 5))):
+        if setup:
+            setup()
+        before = commands.count if commands else 0
+        with CaptureQueriesContext(connection) as context:
+            run()
+        queries.append(len(context.captured_queries))
+        round_trips.append(commands.count - before if commands else None)
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            run()
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        allocations.append(peak)
+
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'samples': repeat,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'mean_ms': total / repeat * 1000,
+        'throughput_rps': repeat / total if total else None,
+        'queries': statistics.median(queries),
+        'round_trips': statistics.median(round_trips) if commands else None,
+        'peak_alloc_kb': statistics.median(allocations) / 1024,
+    }
@@ -0,0 +1,148 @@
+"""
+Response caching for read-heavy list endpoints.
+
+Cached views store their serialized response data in Django's cache, keyed
+by namespace, path and query parameters. Each namespace has a version; model
+signals and the leaderboard engine bump it whenever the underlying data
+changes, which orphans every entry built from the old version at once. The
+TTL only bounds how long orphaned entries take up space.
+
+Entries carry an ETag (a hash of the data) and a Last-Modified time (when
+the namespace last changed), so clients revalidating with If-None-Match or
+If-Modified-Since get an empty 304 instead of the full body.
+
+Versions are counters in the ``cache_versions`` collection rather than cache
+entries, so a bump made by any process (another web worker, a ``run_jobs``
+worker finishing a rebuild, a management command) orphans the entries of
+every process at once, even with the default per-process locmem backend.
+``shared_version`` and ``bump_versions`` give other caches keyed the same
+way, such as the time series buckets, the same guarantee.
+"""
+import hashlib
+import json
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .mongo import bulk_write, from_mongo_datetime, get_collection, now
+
+LEADERBOARD = 'leaderboard'
+WORKOUTS = 'workouts'
+
+KEY_PREFIX = 'octofit:response'
+
+VERSIONS_COLLECTION = 'cache_versions'
+
+
+def shared_version(name):
+    """The current version of ``name``, 0 until it is first bumped"""
+    state = get_collection(VERSIONS_COLLECTION).find_one({'_id': name}, {'version': True})
+    return state['version'] if state else 0
+
+
+def bump_versions(names):
+    """Move every process on to new versions of ``names``"""
+    timestamp = now()
+    bulk_write(get_collection(VERSIONS_COLLECTION), (
+        UpdateOne({'_id': name}, {'$inc': {'version': 1}, '$set': {'modified': timestamp}}, upsert=True)
+        for name in set(names)
+    ))
+
+
+def _version_name(namespace):
+    return f'response:{namespace}'
+
+
+def namespace_state(namespace):
+    """Return ``{'version', 'modified'}`` for a namespace, creating it if needed"""
+    collection = get_collection(VERSIONS_COLLECTION)
+    name = _version_name(namespace)
+    state = collection.find_one({'_id': name})
+    if state is None:
+        try:
+            state = collection.find_one_and_update(
+                {'_id': name},
+                {'$setOnInsert': {'version': 0, 'modified': now()}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            # Created by a concurrent request
+            state = collection.find_one({'_id': name})
+    return {'version': state['version'], 'modified': int(from_mongo_datetime(state['modified']).timestamp())}
+
+
+def invalidate(*namespaces):
+    """Orphan every cached response in the given namespaces, in every process"""
+    bump_versions(_version_name(namespace) for namespace in namespaces)
+
+
+def response_key(namespace, version, request, vary=''):
+    """Cache key for a request: host, path, sorted query parameters and ``vary``"""
+    params = sorted(
+        (name, value)
+        for name in request.query_params
+        for value in request.query_params.getlist(name)
+    )
+    raw = json.dumps([request.get_host(), request.path, params, vary])
+    digest = hashlib.md5(raw.encode()).hexdigest()
+    return f'{KEY_PREFIX}:{namespace}:{version}:{digest}'
+
+
+def compute_etag(data):
+    encoded = json.dumps(data, cls=JSONEncoder, sort_keys=True).encode()
+    return quote_etag(hashlib.md5(encoded).hexdigest())
+
+
+def _not_modified(request, entry):
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or entry['etag'] in tags or f'W/{entry["etag"]}' in tags
+    if_modified_since = parse_http_date_safe(request.headers.get('If-Modified-Since', ''))
+    return if_modified_since is not None and entry['last_modified'] <= if_modified_since
+
+
+def cached_response(namespace, vary_on=None):
+    """
+    Cache a view method's successful responses in ``namespace``.
+
+    ``vary_on(view, request)`` may return extra key material for responses
+    that depend on more than the URL, e.g. the caller's fitness level.
+    Only 200 responses are cached.
+    """
+    def decorator(view_method):
+        @wraps(view_method)
+        def wrapper(self, request, *args, **kwargs):
+            state = namespace_state(namespace)
+            vary = vary_on(self, request) if vary_on else ''
+            key = response_key(namespace, state['version'], request, vary)
+            entry = cache.get(key)
+            if entry is None:
+                response = view_method(self, request, *args, **kwargs)
+                if response.status_code != status.HTTP_200_OK:
+                    return response
+                entry = {
+                    'data': response.data,
+                    'etag': compute_etag(response.data),
+                    'last_modified': state['modified'],
+                }
+                cache.set(key, entry, getattr(settings, 'RESPONSE_CACHE_TIMEOUT', 300))
+
+            if _not_modified(request, entry):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = Response(entry['data'])
+            response['ETag'] = entry['etag']
+            response['Last-Modified'] = http_date(entry['last_modified'])
+            return response
+        return wrapper
+    return decorator
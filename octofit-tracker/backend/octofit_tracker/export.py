@@ -0,0 +1,181 @@
+"""
+Streaming columnar export of activity history.
+
+Rows are read straight from the activities collection, with only the
+exported fields projected and the user, type and date filters in the
+query, in batches of ``EXPORT_BATCH_SIZE``. Each batch becomes one Parquet
+row group or Arrow record batch and is handed on as bytes before the next
+one is read, so memory stays at one batch however many rows are exported.
+
+Parquet, zstd-compressed, is the default; CSV is there for quick looks in
+tools that can't read columnar files.
+"""
+import csv
+import io
+from datetime import datetime, time
+
+import pyarrow
+import pyarrow.ipc
+import pyarrow.parquet
+from django.utils.dateparse import parse_date, parse_datetime
+
+from .models import Activity
+from .mongo import from_mongo_datetime, get_collection, to_mongo_datetime
+
+EXPORT_BATCH_SIZE = 10000
+
+COLUMNS = (
+    'id', 'user_id', 'activity_type', 'duration', 'distance',
+    'calories', 'points_earned', 'date', 'created_at',
+)
+
+FORMATS = {
+    # format -> (content type, file extension)
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'csv': ('text/csv', 'csv'),
+}
+DEFAULT_FORMAT = 'parquet'
+
+
+def parse_bound(value):
+    """Parse an ISO date or datetime; naive values are taken as UTC"""
+    parsed = parse_datetime(value)
+    if parsed is None:
+        day = parse_date(value)
+        if day is None:
+            raise ValueError(f'Invalid date: {value}')
+        parsed = datetime.combine(day, time.min)
+    return from_mongo_datetime(parsed)
+
+
+def build_filter(user_id=None, activity_type=None, since=None, until=None):
+    """The Mongo filter for the export; ``until`` is exclusive"""
+    match = {}
+    if user_id is not None:
+        match['user_id'] = user_id
+    if activity_type:
+        match['activity_type'] = activity_type
+    if since is not None or until is not None:
+        match['date'] = {}
+        if since is not None:
+            match['date']['$gte'] = to_mongo_datetime(since)
+        if until is not None:
+            match['date']['$lt'] = to_mongo_datetime(until)
+    return match
+
+
+def _batches(cursor, batch_size):
+    """Columns of up to ``batch_size`` rows at a time"""
+    columns = {name: [] for name in COLUMNS}
+    count = 0
+    for document in cursor:
+        columns['id'].append(str(document['_id']))
+        for name in COLUMNS[1:]:
+            columns[name].append(document.get(name))
+        count += 1
+        if count == batch_size:
+            yield columns
+            columns = {name: [] for name in COLUMNS}
+            count = 0
+    if count:
+        yield columns
+
+
+def _arrow_schema():
+    return pyarrow.schema([
+        ('id', pyarrow.string()),
+        ('user_id', pyarrow.int64()),
+        ('activity_type', pyarrow.string()),
+        ('duration', pyarrow.int64()),
+        ('distance', pyarrow.float64()),
+        ('calories', pyarrow.int64()),
+        ('points_earned', pyarrow.int64()),
+        ('date', pyarrow.timestamp('ms', tz='UTC')),
+        ('created_at', pyarrow.timestamp('ms', tz='UTC')),
+    ])
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _write_arrow(batches, output):
+    schema = _arrow_schema()
+    sink = _ChunkSink()
+    if output == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema, options=pyarrow.ipc.IpcWriteOptions(compression='zstd'))
+    try:
+        for columns in batches:
+            # Mongo returns naive UTC datetimes
+            for name in ('date', 'created_at'):
+                columns[name] = [from_mongo_datetime(value) for value in columns[name]]
+            writer.write_batch(pyarrow.record_batch(
+                [columns[name] for name in COLUMNS], schema=schema
+            ))
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def _write_csv(batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for columns in batches:
+        for name in ('date', 'created_at'):
+            columns[name] = [
+                from_mongo_datetime(value).isoformat() if value is not None else None
+                for value in columns[name]
+            ]
+        writer.writerows(zip(*(columns[name] for name in COLUMNS)))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def export_activities(match, output=None, batch_size=EXPORT_BATCH_SIZE, collection=None):
+    """
+    Yield the matching activities, oldest first, as chunks of ``output``.
+
+    Pass ``collection`` when the chunks are consumed away from the thread
+    that owns the database connection, e.g. by a streaming response.
+    """
+    output = output or DEFAULT_FORMAT
+    if output not in FORMATS:
+        raise ValueError(f'Unsupported export format: {output}')
+    if collection is None:
+        collection = get_collection(Activity)
+    projection = {name: True for name in COLUMNS[1:]}
+    cursor = collection.find(match, projection, sort=[('date', 1), ('_id', 1)]).batch_size(batch_size)
+    batches = _batches(cursor, batch_size)
+    if output == 'csv':
+        return _write_csv(batches)
+    return _write_arrow(batches, output)
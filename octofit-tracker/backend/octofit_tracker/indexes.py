@@ -0,0 +1,164 @@
+"""
+MongoDB index management.
+
+djongo only creates the indexes implied by primary keys and unique fields,
+so the compound indexes the hot queries need are declared here, next to the
+query shapes they serve. ``ensure_indexes`` creates any that are missing and
+runs after every ``migrate``; ``index_report`` reads $indexStats to show how
+often each index is used and which ones nothing reads.
+"""
+from collections import namedtuple
+
+from django.contrib.auth.models import User
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+from .jobs import JOB_RETENTION_DAYS, JOBS_COLLECTION
+from .models import Activity, Leaderboard, LeaderboardBucket, Team, UserProfile, Workout
+from .mongo import get_collection
+
+# ``options`` are passed on to create_index, e.g. sparse or expireAfterSeconds
+IndexSpec = namedtuple('IndexSpec', ['name', 'keys', 'unique', 'options'], defaults=[False, {}])
+
+IndexUsage = namedtuple('IndexUsage', ['collection', 'name', 'keys', 'ops', 'since', 'declared'])
+
+# Collection name -> indexes. Models are used where they exist so renamed
+# tables follow automatically; M2M through tables have no model of their own.
+DECLARED_INDEXES = {
+    Activity._meta.db_table: [
+        # my_activities, per-user stats and feeds: filter by user, newest first
+        IndexSpec('user_date', [('user_id', ASCENDING), ('date', DESCENDING), ('_id', DESCENDING)]),
+        # Activity list pagination and date-range scans
+        IndexSpec('date', [('date', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    Leaderboard._meta.db_table: [
+        # Entry upserts from the incremental engine
+        IndexSpec('user_period', [('user_id', ASCENDING), ('period', ASCENDING)], unique=True),
+        # Leaderboard list pagination: filter by period, order by rank
+        IndexSpec('period_rank', [('period', ASCENDING), ('rank', ASCENDING), ('_id', ASCENDING)]),
+        # Rank shifts and re-ranking: filter by period, range on points
+        IndexSpec('period_points', [('period', ASCENDING), ('total_points', DESCENDING), ('user_id', ASCENDING)]),
+    ],
+    LeaderboardBucket._meta.db_table: [
+        IndexSpec('user_day', [('user_id', ASCENDING), ('day', ASCENDING)], unique=True),
+        # Window roll-over and pruning: range on day
+        IndexSpec('day', [('day', ASCENDING)]),
+    ],
+    Workout._meta.db_table: [
+        # by_difficulty: filter by difficulty, newest first
+        IndexSpec('difficulty_created', [('difficulty', ASCENDING), ('created_at', DESCENDING), ('_id', DESCENDING)]),
+        # Workout list pagination
+        IndexSpec('created', [('created_at', DESCENDING), ('_id', DESCENDING)]),
+    ],
+    UserProfile._meta.db_table: [
+        # Unique, so concurrent first credits upsert one profile, not two
+        IndexSpec('user', [('user_id', ASCENDING)], unique=True),
+    ],
+    Team.members.through._meta.db_table: [
+        # Team lookups for nested users and membership checks
+        IndexSpec('user_team', [('user_id', ASCENDING), ('team_id', ASCENDING)]),
+        # Unique, so concurrent joins can't add a user twice
+        IndexSpec('team_user', [('team_id', ASCENDING), ('user_id', ASCENDING)], unique=True),
+    ],
+    User._meta.db_table: [
+        IndexSpec('id', [('id', ASCENDING)], unique=True),
+    ],
+    JOBS_COLLECTION: [
+        # Workers claim the oldest queued job; the job list filters by status
+        IndexSpec('status_created', [('status', ASCENDING), ('created_at', ASCENDING)]),
+        # At most one queued job per dedupe key
+        IndexSpec('dedupe_key', [('dedupe_key', ASCENDING)], unique=True, options={'sparse': True}),
+        IndexSpec('finished', [('finished_at', ASCENDING)],
+                  options={'expireAfterSeconds': JOB_RETENTION_DAYS * 24 * 60 * 60}),
+    ],
+}
+
+
+def _key_pattern(keys):
+    """Normalise a key spec (list of pairs, dict or SON) for comparison"""
+    if hasattr(keys, 'items'):
+        keys = keys.items()
+    return tuple(
+        (field, direction if isinstance(direction, str) else int(direction))
+        for field, direction in keys
+    )
+
+
+def ensure_indexes(using='default'):
+    """
+    Create every declared index that doesn't exist yet.
+
+    An existing index with the same keys counts as present whatever its
+    name, so indexes djongo created for unique fields aren't duplicated.
+    When a declared index is unique and the existing one isn't, such as the
+    plain index djongo creates for a foreign key, the existing one is
+    replaced; if Mongo refuses the unique index it is put back as it was.
+    Returns ``(created, failed)``: the ``collection.name`` of each index
+    created, and ``(collection.name, error)`` for each one Mongo refused,
+    e.g. a unique index over existing duplicates.
+    """
+    created = []
+    failed = []
+    for collection_name, specs in DECLARED_INDEXES.items():
+        collection = get_collection(collection_name, using)
+        existing = {
+            _key_pattern(info['key']): (index_name, info.get('unique', False))
+            for index_name, info in collection.index_information().items()
+        }
+        for spec in specs:
+            replaced = existing.get(_key_pattern(spec.keys))
+            if replaced is not None:
+                replaced_name, replaced_unique = replaced
+                if replaced_unique or not spec.unique:
+                    continue
+                collection.drop_index(replaced_name)
+            name = f'{collection_name}.{spec.name}'
+            try:
+                collection.create_index(
+                    spec.keys, name=spec.name, unique=spec.unique, background=True, **spec.options
+                )
+            except OperationFailure as exc:
+                failed.append((name, str(exc)))
+                if replaced is not None:
+                    collection.create_index(spec.keys, name=replaced_name, background=True)
+            else:
+                created.append(name)
+    return created, failed
+
+
+def index_report(using='default'):
+    """
+    Usage counters for every index on the managed collections.
+
+    Counters come from $indexStats and reset when mongod restarts, so an
+    index only counts as unused after the server has run for a while.
+    """
+    report = []
+    for collection_name, specs in DECLARED_INDEXES.items():
+        declared = {_key_pattern(spec.keys) for spec in specs}
+        collection = get_collection(collection_name, using)
+        try:
+            stats = list(collection.aggregate([{'$indexStats': {}}]))
+        except OperationFailure:
+            stats = []
+        for row in stats:
+            keys = _key_pattern(row['key'])
+            report.append(IndexUsage(
+                collection=collection_name,
+                name=row['name'],
+                keys=keys,
+                ops=row['accesses']['ops'],
+                since=row['accesses']['since'],
+                declared=keys in declared,
+            ))
+    return sorted(report, key=lambda usage: (usage.collection, -usage.ops))
+
+
+def unused_indexes(using='default', report=None):
+    """
+    Indexes, other than the _id index, that no query has used, from
+    ``report`` if given or a fresh ``index_report``
+    """
+    if report is None:
+        report = index_report(using)
+    return [usage for usage in report if usage.ops == 0 and usage.name != '_id_']
@@ -0,0 +1,70 @@
+"""
+Bulk activity ingestion for device sync batches.
+
+A batch is validated item by item, scored in one pass and written with a
+single insert_many. Profile points go out as one bulk write with a merged
+increment per user, and the activities_created signal brings the derived
+data (leaderboard entries and buckets) up to date for the whole batch.
+Activities the batch's days reach by streak are re-scored afterwards.
+"""
+from .models import Activity
+from .mongo import get_collection, now, to_mongo_datetime
+from .points import credit_many
+from .scoring import day_number, get_rules, rescore_around, score_new_activities
+from .serializers import ActivitySerializer
+from .signals import activities_created
+
+MAX_BATCH_SIZE = 5000
+
+
+def ingest_activities(user, items, context=None):
+    """
+    Insert the valid items of a batch as activities of ``user``.
+
+    Returns ``(activities, errors)``: the created Activity instances, and a
+    list of ``{'index': i, 'errors': {...}}`` for each item that failed
+    validation. Invalid items don't stop the valid ones from being stored.
+    """
+    valid = []
+    errors = []
+    for index, item in enumerate(items):
+        serializer = ActivitySerializer(data=item, context=context)
+        if serializer.is_valid():
+            valid.append(serializer.validated_data)
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+    if not valid:
+        return [], errors
+
+    points = score_new_activities(user.pk, valid)
+    created_at = now()
+    activities = [
+        Activity(user=user, points_earned=points_earned, created_at=created_at, **data)
+        for data, points_earned in zip(valid, points)
+    ]
+    documents = [
+        {
+            'user_id': activity.user_id,
+            'activity_type': activity.activity_type,
+            'duration': activity.duration,
+            'distance': activity.distance,
+            'calories': activity.calories,
+            'points_earned': activity.points_earned,
+            'notes': activity.notes,
+            'date': to_mongo_datetime(activity.date),
+            'created_at': created_at,
+        }
+        for activity in activities
+    ]
+
+    result = get_collection(Activity).insert_many(documents, ordered=False)
+    for activity, inserted_id in zip(activities, result.inserted_ids):
+        activity._id = inserted_id
+        activity._state.adding = False
+
+    credit_many({user.pk: sum(points)})
+    activities_created.send(sender=Activity, instances=activities)
+    # Backfilled days can extend the streaks of the user's later activities
+    if get_rules().streak_bonus:
+        rescore_around(user.pk, [day_number(activity.date) for activity in activities])
+    return activities, errors
@@ -0,0 +1,251 @@
+"""
+Persistent background jobs.
+
+Slow work, such as a full leaderboard rebuild, is queued as a document in
+the ``jobs`` collection instead of running inside the request. Workers
+(``manage.py run_jobs``) claim queued jobs with a single atomic
+find-and-modify, so any number of them can share the queue, and the queue
+survives restarts without a separate broker.
+
+A job can carry a dedupe key. While a job with that key is still queued,
+enqueueing the same key again returns the queued job; the key is released
+when a worker claims the job, so a request made during a run queues one
+follow-up run that will see its changes.
+
+Running jobs send a heartbeat. A job whose worker stopped sending them is
+put back on the queue by the next idle worker. Finished jobs expire after
+``JOB_RETENTION_DAYS``.
+"""
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.conf import settings
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from . import leaderboard
+from .mongo import from_mongo_datetime, get_collection, now
+
+logger = logging.getLogger(__name__)
+
+JOBS_COLLECTION = 'jobs'
+JOB_RETENTION_DAYS = 7
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+STATUSES = (QUEUED, RUNNING, SUCCEEDED, FAILED)
+
+# Job name -> callable(progress, **params)
+_handlers = {}
+
+
+def handler(name):
+    """Register a function as the handler for jobs called ``name``"""
+    def register(func):
+        _handlers[name] = func
+        return func
+    return register
+
+
+def get_jobs_collection():
+    return get_collection(JOBS_COLLECTION)
+
+
+def enqueue(name, params=None, dedupe_key=None):
+    """
+    Queue a job and return ``(job, created)``.
+
+    With a ``dedupe_key``, an already queued job with the same key is
+    returned instead of queueing another one.
+    """
+    if name not in _handlers:
+        raise ValueError(f'No handler registered for job {name!r}')
+    collection = get_jobs_collection()
+    job = {
+        '_id': ObjectId(),
+        'name': name,
+        'params': params or {},
+        'status': QUEUED,
+        'progress': {'done': 0, 'total': None},
+        'attempts': 0,
+        'created_at': now(),
+    }
+    if dedupe_key is None:
+        collection.insert_one(job)
+        return job, True
+
+    job['dedupe_key'] = dedupe_key
+    while True:
+        try:
+            # Upsert, so a queued job with the key is found rather than duplicated;
+            # the unique index settles two enqueues racing for the same key
+            stored = collection.find_one_and_update(
+                {'dedupe_key': dedupe_key},
+                {'$setOnInsert': job},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+        except DuplicateKeyError:
+            continue
+        return stored, stored['_id'] == job['_id']
+
+
+def get_job(job_id):
+    """Return the job with this id, or None"""
+    try:
+        job_id = ObjectId(job_id)
+    except (InvalidId, TypeError):
+        return None
+    return get_jobs_collection().find_one({'_id': job_id})
+
+
+def list_jobs(status=None, name=None, limit=50):
+    """The most recent jobs, newest first"""
+    query = {}
+    if status:
+        query['status'] = status
+    if name:
+        query['name'] = name
+    return list(get_jobs_collection().find(query, sort=[('created_at', -1), ('_id', -1)], limit=limit))
+
+
+def claim(worker):
+    """Atomically take the oldest queued job, or return None"""
+    timestamp = now()
+    return get_jobs_collection().find_one_and_update(
+        {'status': QUEUED},
+        {
+            '$set': {'status': RUNNING, 'worker': worker, 'started_at': timestamp, 'heartbeat_at': timestamp},
+            '$unset': {'dedupe_key': ''},
+            '$inc': {'attempts': 1},
+        },
+        sort=[('created_at', ASCENDING), ('_id', ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def set_progress(job_id, done, total=None):
+    get_jobs_collection().update_one(
+        {'_id': job_id},
+        {'$set': {'progress': {'done': done, 'total': total}, 'heartbeat_at': now()}},
+    )
+
+
+def _heartbeat(collection, job_id, stop, interval):
+    # Runs on its own thread; pymongo collections are thread-safe, Django
+    # connections are per thread, so the collection is passed in
+    while not stop.wait(interval):
+        collection.update_one({'_id': job_id}, {'$set': {'heartbeat_at': now()}})
+
+
+def run_job(job):
+    """Run a claimed job and record how it ended; returns the final status"""
+    stop = threading.Event()
+    beat = threading.Thread(
+        target=_heartbeat,
+        args=(get_jobs_collection(), job['_id'], stop, getattr(settings, 'JOBS_HEARTBEAT_INTERVAL', 30)),
+        daemon=True,
+    )
+    beat.start()
+    try:
+        func = _handlers[job['name']]
+        result = func(lambda done, total=None: set_progress(job['_id'], done, total), **job['params'])
+    except Exception as exc:
+        logger.exception('Job %s (%s) failed', job['_id'], job['name'])
+        update = {
+            'status': FAILED,
+            'error': ''.join(traceback.format_exception_only(type(exc), exc)).strip(),
+        }
+    else:
+        update = {'status': SUCCEEDED, 'result': result}
+    finally:
+        stop.set()
+        beat.join()
+    update['finished_at'] = now()
+    get_jobs_collection().update_one({'_id': job['_id']}, {'$set': update})
+    return update['status']
+
+
+def requeue_stale(stale_after=None):
+    """
+    Put back running jobs whose worker stopped sending heartbeats.
+
+    They go back without their dedupe key, so they can't clash with a job
+    queued since. Returns the number of jobs requeued.
+    """
+    if stale_after is None:
+        stale_after = getattr(settings, 'JOBS_STALE_AFTER', 300)
+    result = get_jobs_collection().update_many(
+        {'status': RUNNING, 'heartbeat_at': {'$lt': now() - timedelta(seconds=stale_after)}},
+        {'$set': {'status': QUEUED}, '$unset': {'worker': ''}},
+    )
+    return result.modified_count
+
+
+def default_worker_name():
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def run_pending(worker=None, limit=None):
+    """Run queued jobs until the queue is empty; returns the number run"""
+    worker = worker or default_worker_name()
+    count = 0
+    while limit is None or count < limit:
+        job = claim(worker)
+        if job is None:
+            break
+        run_job(job)
+        count += 1
+    return count
+
+
+def work(stop, worker=None, poll_interval=None):
+    """Run jobs as they arrive until ``stop`` (a threading.Event) is set"""
+    worker = worker or default_worker_name()
+    if poll_interval is None:
+        poll_interval = getattr(settings, 'JOBS_POLL_INTERVAL', 1.0)
+    while not stop.is_set():
+        job = claim(worker)
+        if job is None:
+            requeued = requeue_stale()
+            if requeued:
+                logger.warning('Requeued %d jobs left running by a stopped worker', requeued)
+            else:
+                stop.wait(poll_interval)
+            continue
+        run_job(job)
+
+
+def to_representation(job):
+    """The API view of a job document"""
+    return {
+        'id': str(job['_id']),
+        'name': job['name'],
+        'params': job['params'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'attempts': job['attempts'],
+        'result': job.get('result'),
+        'error': job.get('error'),
+        'created_at': from_mongo_datetime(job['created_at']),
+        'started_at': from_mongo_datetime(job.get('started_at')),
+        'finished_at': from_mongo_datetime(job.get('finished_at')),
+    }
+
+
+@handler('leaderboard.rebuild')
+def rebuild_leaderboard(progress, period=leaderboard.DEFAULT_PERIOD):
+    return {'entries_written': leaderboard.rebuild(period, progress=progress)}
+
+
+def enqueue_leaderboard_rebuild(period):
+    """Queue a rebuild of one period, reusing one already queued"""
+    return enqueue('leaderboard.rebuild', {'period': period}, dedupe_key=f'leaderboard.rebuild:{period}')
@@ -0,0 +1,453 @@
+"""
+Incremental leaderboard engine.
+
+Every Activity write applies a delta to its user's Leaderboard entries with a
+single atomic $inc, and only the entries whose position actually changed get
+their rank shifted. Ranks use competition ranking: an entry's rank is one
+plus the number of entries in the same period with strictly more points, so
+tied users share a rank.
+
+The daily, weekly and monthly periods are rolling windows of whole UTC days.
+Activity writes also keep a per-user total for each day (LeaderboardBucket),
+and when a window moves only the buckets that left or entered it are summed
+and applied, so rolling over never rescans the activities collection.
+
+A full rebuild is still available for repairs and backfills; it aggregates
+in one pipeline and writes ranks in bulk.
+
+These writes go straight to the collections, bypassing model signals, so
+each one invalidates the cached leaderboard responses itself.
+"""
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.dispatch import Signal
+from django.utils import timezone
+from pymongo import ASCENDING, DESCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from . import caching
+from .models import Activity, Leaderboard, LeaderboardBucket, LeaderboardWindow
+from .mongo import BULK_BATCH_SIZE, bulk_write, get_collection, now, to_mongo_datetime
+from .repositories import ActivityRepository
+
+DEFAULT_PERIOD = 'all_time'
+
+# Number of days, ending today, summed into each windowed period
+PERIOD_WINDOWS = {
+    'daily': 1,
+    'weekly': 7,
+    'monthly': 30,
+}
+PERIODS = (DEFAULT_PERIOD,) + tuple(PERIOD_WINDOWS)
+
+# Buckets older than the longest window no longer feed any period
+BUCKET_RETENTION_DAYS = max(PERIOD_WINDOWS.values())
+
+STAT_FIELDS = ('total_points', 'total_activities', 'total_duration', 'total_distance')
+
+# Sent with ``periods`` after entries of those periods changed
+changed = Signal()
+
+# Windows this process has already rolled forward, so the write path checks
+# the stored window at most once per period per day
+_current_windows = {}
+
+
+def bucket_day(value):
+    """Return the start of the UTC day containing ``value``, as stored in Mongo"""
+    value = to_mongo_datetime(value)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def window_bounds(period, today=None):
+    """Return the first and last day summed into a windowed period"""
+    end = bucket_day(today or timezone.now())
+    return end - timedelta(days=PERIOD_WINDOWS[period] - 1), end
+
+
+def snapshot(activity):
+    """Capture the fields of an activity that contribute to leaderboard, team and rollup totals"""
+    return {
+        'user_id': activity.user_id,
+        'day': bucket_day(activity.date),
+        'activity_type': activity.activity_type,
+        'points_earned': activity.points_earned or 0,
+        'duration': activity.duration or 0,
+        'distance': activity.distance or 0,
+        'has_distance': activity.distance is not None,
+    }
+
+
+def document_snapshot(document):
+    """The same snapshot, for an activity document read straight from Mongo"""
+    return {
+        'user_id': document['user_id'],
+        'day': bucket_day(document['date']),
+        'activity_type': document['activity_type'],
+        'points_earned': document.get('points_earned') or 0,
+        'duration': document.get('duration') or 0,
+        'distance': document.get('distance') or 0,
+        'has_distance': document.get('distance') is not None,
+    }
+
+
+def _delta(snap, sign):
+    return {
+        'total_points': sign * snap['points_earned'],
+        'total_activities': sign,
+        'total_duration': sign * snap['duration'],
+        'total_distance': sign * snap['distance'],
+    }
+
+
+def _merge_deltas(changes, key):
+    deltas = {}
+    for snap, sign in changes:
+        delta = _delta(snap, sign)
+        existing = deltas.get(key(snap))
+        if existing:
+            delta = {field: existing[field] + delta[field] for field in STAT_FIELDS}
+        deltas[key(snap)] = delta
+    return {k: delta for k, delta in deltas.items() if any(delta.values())}
+
+
+def user_deltas(changes):
+    """Merge ``(snapshot, sign)`` pairs into ``{user_id: stats delta}``"""
+    return _merge_deltas(changes, key=lambda snap: snap['user_id'])
+
+
+def apply_activity_change(previous, current):
+    """
+    Apply the leaderboard delta between two activity snapshots.
+
+    Pass ``previous=None`` for a new activity and ``current=None`` for a
+    deleted one.
+    """
+    changes = [(snap, sign) for snap, sign in ((previous, -1), (current, 1)) if snap is not None]
+    apply_changes(changes)
+
+
+def apply_activity_batch(snapshots):
+    """
+    Apply a batch of new activities.
+
+    Deltas are merged per user first, so a batch from one user costs the
+    same as a single activity.
+    """
+    apply_changes([(snap, 1) for snap in snapshots])
+
+
+def _write_buckets(changes):
+    retention_start = bucket_day(timezone.now()) - timedelta(days=BUCKET_RETENTION_DAYS)
+    bucket_deltas = _merge_deltas(
+        [(snap, sign) for snap, sign in changes if snap['day'] >= retention_start],
+        key=lambda snap: (snap['user_id'], snap['day']),
+    )
+    bulk_write(get_collection(LeaderboardBucket), (
+        UpdateOne({'user_id': user_id, 'day': day}, {'$inc': delta}, upsert=True)
+        for (user_id, day), delta in bucket_deltas.items()
+    ))
+
+
+def _period_deltas(changes):
+    """Yield ``(period, {user_id: delta})`` for every period, with windows applied"""
+    # Resolve the windows before touching buckets: the first roll of a period
+    # rebuilds it from the buckets and must not see this change yet.
+    windows = {period: current_window(period) for period in PERIOD_WINDOWS}
+    _write_buckets(changes)
+    for period in PERIODS:
+        period_changes = changes
+        if period in windows:
+            start, end = windows[period]
+            period_changes = [(snap, sign) for snap, sign in changes if start <= snap['day'] <= end]
+        yield period, user_deltas(period_changes)
+
+
+def apply_changes(changes):
+    """Apply ``(snapshot, sign)`` pairs, shifting ranks user by user"""
+    touched = []
+    for period, deltas in _period_deltas(changes):
+        for user_id, delta in deltas.items():
+            apply_delta(user_id, delta, period)
+        if deltas:
+            touched.append(period)
+    caching.invalidate(caching.LEADERBOARD)
+    if touched:
+        changed.send(sender=None, periods=touched)
+
+
+def apply_batch_changes(changes):
+    """
+    Apply ``(snapshot, sign)`` pairs with one bulk $inc per period, leaving
+    ranks alone.
+
+    For batch jobs that touch many users: shifting ranks user by user would
+    cost more than re-ranking once. Returns the periods that changed; pass
+    them to ``rerank`` when the job is done.
+    """
+    touched = []
+    updated_at = now()
+    for period, deltas in _period_deltas(changes):
+        bulk_write(get_collection(Leaderboard), (
+            UpdateOne(
+                {'user_id': user_id, 'period': period},
+                {'$inc': delta, '$set': {'updated_at': updated_at}},
+                upsert=True,
+            )
+            for user_id, delta in deltas.items()
+        ))
+        if deltas:
+            touched.append(period)
+    return touched
+
+
+def rerank(periods):
+    """Recompute the ranks of periods changed by ``apply_batch_changes``"""
+    for period in periods:
+        recompute_ranks(period)
+    caching.invalidate(caching.LEADERBOARD)
+    changed.send(sender=None, periods=list(periods))
+
+
+def apply_delta(user_id, delta, period=DEFAULT_PERIOD):
+    """Add a stats delta to a user's entry and shift the ranks it passes"""
+    collection = get_collection(Leaderboard)
+    before = collection.find_one_and_update(
+        {'user_id': user_id, 'period': period},
+        {'$inc': delta, '$set': {'updated_at': now()}},
+        projection={'total_points': True},
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+    )
+    old_points = before.get('total_points', 0) if before else 0
+    new_points = old_points + delta.get('total_points', 0)
+    _shift_ranks(collection, user_id, period, old_points, new_points, created=before is None)
+
+
+def _shift_ranks(collection, user_id, period, old_points, new_points, created=False):
+    # Another entry's rank changes only if this user crossed its score, which
+    # confines the update to the half-open range between the two scores.
+    if new_points > old_points:
+        passed = {'$gte': old_points, '$lt': new_points}
+        step = 1
+    elif new_points < old_points:
+        passed = {'$gte': new_points, '$lt': old_points}
+        step = -1
+    else:
+        passed = None
+
+    if passed is not None:
+        collection.update_many(
+            {'period': period, 'user_id': {'$ne': user_id}, 'total_points': passed},
+            {'$inc': {'rank': step}},
+        )
+    if passed is not None or created:
+        rank = collection.count_documents(
+            {'period': period, 'total_points': {'$gt': new_points}}
+        ) + 1
+        collection.update_one(
+            {'user_id': user_id, 'period': period},
+            {'$set': {'rank': rank}},
+        )
+
+
+def current_window(period):
+    """Return the current bounds of a windowed period, rolling it forward if needed"""
+    bounds = window_bounds(period)
+    if _current_windows.get(period) != bounds:
+        roll(period, bounds)
+        _current_windows[period] = bounds
+    return bounds
+
+
+def roll(period, bounds=None):
+    """
+    Move a windowed period to its current bounds.
+
+    Buckets that left the window are subtracted and buckets that entered it
+    are added, then the period is re-ranked in one pass. The stored window is
+    claimed atomically, so concurrent callers never apply the same move twice.
+    Returns True if the window moved.
+    """
+    start, end = bounds or window_bounds(period)
+    windows = get_collection(LeaderboardWindow)
+    previous = windows.find_one_and_update(
+        {'period': period, 'end': {'$lt': end}},
+        {'$set': {'start': start, 'end': end, 'updated_at': now()}},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if previous is None:
+        if windows.count_documents({'period': period}, limit=1):
+            return False
+        try:
+            windows.insert_one({'period': period, 'start': start, 'end': end, 'updated_at': now()})
+        except DuplicateKeyError:
+            return False
+        rebuild(period)
+        return True
+
+    one_day = timedelta(days=1)
+    expired = _bucket_totals(previous['start'], min(start - one_day, previous['end']))
+    entered = _bucket_totals(max(previous['end'] + one_day, start), end)
+
+    deltas = {user_id: {field: -value for field, value in totals.items()}
+              for user_id, totals in expired.items()}
+    for user_id, totals in entered.items():
+        delta = deltas.setdefault(user_id, dict.fromkeys(STAT_FIELDS, 0))
+        for field, value in totals.items():
+            delta[field] += value
+
+    updated_at = now()
+    bulk_write(get_collection(Leaderboard), (
+        UpdateOne(
+            {'user_id': user_id, 'period': period},
+            {'$inc': delta, '$set': {'updated_at': updated_at}},
+            upsert=True,
+        )
+        for user_id, delta in deltas.items()
+    ))
+    recompute_ranks(period)
+    caching.invalidate(caching.LEADERBOARD)
+    changed.send(sender=None, periods=[period])
+    return True
+
+
+def roll_all():
+    """Roll every windowed period forward and drop buckets no window needs"""
+    moved = [period for period in PERIOD_WINDOWS if roll(period)]
+    retention_start = bucket_day(timezone.now()) - timedelta(days=BUCKET_RETENTION_DAYS)
+    get_collection(LeaderboardBucket).delete_many({'day': {'$lt': retention_start}})
+    return moved
+
+
+def _bucket_totals(first_day, last_day):
+    if first_day > last_day:
+        return {}
+    pipeline = [
+        {'$match': {'day': {'$gte': first_day, '$lte': last_day}}},
+        {'$group': {
+            '_id': '$user_id',
+            **{field: {'$sum': f'${field}'} for field in STAT_FIELDS},
+        }},
+    ]
+    return _totals_by_user(get_collection(LeaderboardBucket), pipeline)
+
+
+def _totals_by_user(collection, pipeline):
+    return {
+        row.pop('_id'): row
+        for row in collection.aggregate(pipeline, allowDiskUse=True)
+    }
+
+
+def rebuild_buckets():
+    """Recompute the retained daily buckets from the activities collection"""
+    retention_start = bucket_day(timezone.now()) - timedelta(days=BUCKET_RETENTION_DAYS)
+    day_ms = 24 * 60 * 60 * 1000
+    pipeline = [
+        {'$match': {'date': {'$gte': retention_start}}},
+        {'$group': {
+            '_id': {
+                'user_id': '$user_id',
+                'day': {'$toDate': {'$subtract': [
+                    {'$toLong': '$date'}, {'$mod': [{'$toLong': '$date'}, day_ms]},
+                ]}},
+            },
+            'total_points': {'$sum': '$points_earned'},
+            'total_activities': {'$sum': 1},
+            'total_duration': {'$sum': '$duration'},
+            'total_distance': {'$sum': '$distance'},
+        }},
+    ]
+    buckets = get_collection(LeaderboardBucket)
+    buckets.delete_many({})
+    rows = get_collection(Activity).aggregate(pipeline, allowDiskUse=True)
+    return bulk_write(buckets, (
+        UpdateOne(row.pop('_id'), {'$set': row}, upsert=True)
+        for row in rows
+    ))
+
+
+def rebuild(period=DEFAULT_PERIOD, progress=None):
+    """
+    Recompute every user's entry for a period.
+
+    All-time totals come from a single $group over the activities; windowed
+    periods sum the buckets in their current window. Entries are written with
+    batched upserts, so the number of round trips no longer grows per user.
+
+    ``progress``, if given, is called with ``(users done, total users)`` as
+    entries are written.
+    """
+    if period in PERIOD_WINDOWS:
+        start, end = window_bounds(period)
+        get_collection(LeaderboardWindow).update_one(
+            {'period': period},
+            {'$set': {'start': start, 'end': end, 'updated_at': now()}},
+            upsert=True,
+        )
+        _current_windows[period] = (start, end)
+        totals = _bucket_totals(start, end)
+    else:
+        totals = ActivityRepository().totals_by_user()
+
+    empty = dict.fromkeys(STAT_FIELDS, 0)
+    updated_at = now()
+    user_ids = User.objects.values_list('id', flat=True).iterator()
+    if progress is not None:
+        user_ids = _reporting(user_ids, progress, User.objects.count())
+    operations = (
+        UpdateOne(
+            {'user_id': user_id, 'period': period},
+            {'$set': {**totals.get(user_id, empty), 'updated_at': updated_at}},
+            upsert=True,
+        )
+        for user_id in user_ids
+    )
+    written = bulk_write(get_collection(Leaderboard), operations)
+    recompute_ranks(period)
+    if progress is not None:
+        progress(written, written)
+    caching.invalidate(caching.LEADERBOARD)
+    changed.send(sender=None, periods=[period])
+    return written
+
+
+def _reporting(items, progress, total, every=BULK_BATCH_SIZE):
+    """Yield ``items``, calling ``progress(done, total)`` every ``every`` items"""
+    done = 0
+    progress(done, total)
+    for item in items:
+        yield item
+        done += 1
+        if done % every == 0:
+            progress(done, total)
+
+
+def recompute_ranks(period=DEFAULT_PERIOD):
+    """
+    Re-rank a period from a single sorted scan.
+
+    Only entries whose rank changed are written. Returns the number of
+    entries updated.
+    """
+    collection = get_collection(Leaderboard)
+    cursor = collection.find(
+        {'period': period},
+        {'total_points': True, 'rank': True},
+        sort=[('total_points', DESCENDING), ('user_id', ASCENDING)],
+    ).batch_size(1000)
+
+    def operations():
+        rank = 0
+        previous_points = None
+        for position, entry in enumerate(cursor, start=1):
+            points = entry.get('total_points', 0)
+            if points != previous_points:
+                rank = position
+                previous_points = points
+            if entry.get('rank') != rank:
+                yield UpdateOne({'_id': entry['_id']}, {'$set': {'rank': rank}})
+
+    return bulk_write(collection, operations())
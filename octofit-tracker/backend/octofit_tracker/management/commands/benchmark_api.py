@@ -0,0 +1,231 @@
+import json
+import platform
+import random
+import subprocess
+from datetime import timedelta
+from fnmatch import fnmatch
+
+import django
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from octofit_tracker import leaderboard, recommendations, search, synthetic
+from octofit_tracker.benchmarking import CommandCounter, isolated_database, measure
+from octofit_tracker.models import Team, Workout
+from octofit_tracker.points import credit_points
+
+WORKOUT_COUNT = 200
+# Workouts in the in-memory catalogue behind the recommendations.rank and
+# search.query scenarios
+RANKING_CATALOGUE_SIZE = 100000
+
+
+def synthetic_catalogue(size, seed=0):
+    """Workout documents with random features, as the recommendation and search indexes read them"""
+    rng = random.Random(seed)
+    activity_types = ['running', 'cycling', 'swimming', 'walking', 'yoga', 'strength', 'hiit', 'rowing']
+    muscles = ['legs', 'core', 'arms', 'back', 'chest', 'shoulders', 'glutes', 'cardio']
+    equipment = ['mat', 'dumbbells', 'kettlebell', 'bike', 'bands', 'pool', 'rower']
+    exercises = ['squats', 'lunges', 'plank', 'burpees', 'push ups', 'pull ups', 'deadlift', 'sprints',
+                 'intervals', 'stretching', 'crunches', 'rows', 'presses', 'step ups', 'jumps', 'holds']
+    words = ['easy', 'hard', 'quick', 'long', 'steady', 'explosive', 'recovery', 'endurance', 'power',
+             'morning', 'evening', 'full', 'body', 'upper', 'lower', 'session', 'circuit', 'tempo']
+    created_at = timezone.now()
+    for index in range(size):
+        activity_type = rng.choice(activity_types)
+        yield {
+            '_id': index,
+            'title': f'{rng.choice(words).title()} {activity_type} {index}',
+            'description': ' '.join(rng.choices(words, k=12)),
+            'exercises': rng.sample(exercises, rng.randint(2, 5)),
+            'difficulty': rng.choice(recommendations.DIFFICULTIES),
+            'activity_type': activity_type,
+            'duration': rng.randint(5, 90),
+            'target_muscles': rng.sample(muscles, rng.randint(1, 3)),
+            'equipment_needed': rng.sample(equipment, rng.randint(0, 2)),
+            'created_at': created_at - timedelta(minutes=index),
+        }
+
+
+def current_commit():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+class Command(BaseCommand):
+    help = 'Measure latency, queries, round trips and allocations for every API endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--activities-per-user', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--repeat', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--only', action='append', default=[],
+                            help='Only run scenarios matching this glob (repeatable)')
+        parser.add_argument('--output', default='benchmark_results.json',
+                            help='Where to save the results as JSON')
+        parser.add_argument('--compare',
+                            help='Earlier results file to compare against')
+        parser.add_argument('--threshold', type=float, default=1.2,
+                            help='p95 ratio above which a scenario counts as a regression')
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as baseline_file:
+                    baseline = json.load(baseline_file)['results']
+            except (OSError, ValueError, KeyError) as exc:
+                raise CommandError(f"Can't read {options['compare']}: {exc}")
+
+        commands = CommandCounter().register()
+        results = {}
+        setup_test_environment()
+        try:
+            with isolated_database(verbosity=options['verbosity']):
+                self.stdout.write(
+                    f"Seeding {options['users']} users with ~{options['activities_per_user']} activities each..."
+                )
+                synthetic.generate(options['users'], options['activities_per_user'], seed=options['seed'])
+                scenarios = self.scenarios(self.seed_fixtures())
+                for name, (run, setup) in scenarios.items():
+                    if options['only'] and not any(fnmatch(name, pattern) for pattern in options['only']):
+                        continue
+                    self.stdout.write(f'Running {name}...')
+                    try:
+                        results[name] = measure(
+                            run, repeat=options['repeat'], warmup=options['warmup'],
+                            setup=setup, commands=commands,
+                        )
+                    except Exception as exc:
+                        results[name] = {'error': f'{type(exc).__name__}: {exc}'}
+        finally:
+            teardown_test_environment()
+
+        report = {
+            'meta': {
+                'commit': current_commit(),
+                'timestamp': timezone.now().isoformat(),
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                **{key: options[key] for key in ('users', 'activities_per_user', 'seed', 'repeat', 'warmup')},
+            },
+            'results': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+        self.print_results(results, baseline, options['threshold'])
+        self.stdout.write(self.style.SUCCESS(f"Results saved to {options['output']}"))
+
+    def seed_fixtures(self):
+        """Pick a staff user with activities and a team, and add workouts"""
+        user = User.objects.order_by('id').first()
+        user.is_staff = True
+        user.save(update_fields=['is_staff'])
+        # djongo can't bulk_create the workouts' list fields
+        for index in range(WORKOUT_COUNT):
+            Workout.objects.create(
+                title=f'Workout {index}',
+                description='Benchmark workout',
+                difficulty=('beginner', 'intermediate', 'advanced')[index % 3],
+                duration=30,
+                activity_type='running',
+                created_by=user,
+            )
+        return user, Team.objects.order_by('_id').first()
+
+    def scenarios(self, fixtures):
+        """Scenario name -> (run, untimed setup or None)"""
+        user, team = fixtures
+        client = APIClient()
+        client.force_authenticate(user=user)
+
+        def request(method, url, data=None):
+            def run():
+                response = getattr(client, method)(url, data, format='json')
+                if response.status_code >= 400:
+                    raise AssertionError(f'{method.upper()} {url} returned {response.status_code}')
+                return response
+            return run
+
+        payload = {
+            'activity_type': 'running',
+            'duration': 30,
+            'distance': 5.0,
+            'date': timezone.now().isoformat(),
+        }
+        delta = {'total_points': 10, 'total_activities': 1, 'total_duration': 30, 'total_distance': 5.0}
+        # Never reloads, so it keeps serving the synthetic catalogue
+        catalogue = search.WorkoutSearchIndex(ttl=float('inf'))
+        catalogue.load(synthetic_catalogue(RANKING_CATALOGUE_SIZE))
+        preferences = recommendations.Preferences(
+            difficulty='intermediate',
+            activity_mix={'running': 0.6, 'cycling': 0.3, 'yoga': 0.1},
+            usual_duration=40,
+            muscles=['legs', 'core'],
+            equipment={'mat', 'dumbbells'},
+        )
+        cached = {
+            'leaderboard.list': '/api/leaderboard/',
+            'workouts.by_difficulty': '/api/workouts/by_difficulty/?difficulty=intermediate',
+        }
+
+        scenarios = {
+            'activities.create': (request('post', '/api/activities/', payload), None),
+            'activities.bulk': (request('post', '/api/activities/bulk/', [payload] * 100), None),
+            'activities.list': (request('get', '/api/activities/'), None),
+            'activities.my_activities': (request('get', '/api/activities/my_activities/'), None),
+            'activities.stats': (request('get', '/api/activities/stats/'), None),
+            'activities.timeseries': (
+                request('get', '/api/activities/timeseries/?interval=week&metric=duration'), None
+            ),
+            'users.list': (request('get', '/api/users/'), None),
+            'profiles.list': (request('get', '/api/profiles/'), None),
+            'teams.list': (request('get', '/api/teams/'), None),
+            'workouts.list': (request('get', '/api/workouts/'), None),
+            'workouts.recommended': (request('get', '/api/workouts/recommended/'), None),
+            # Queues the rebuild; leaderboard.rebuild measures the work itself
+            'leaderboard.update_rankings': (request('post', '/api/leaderboard/update_rankings/'), None),
+            'leaderboard.rebuild': (leaderboard.rebuild, None),
+            'points.credit_points': (lambda: credit_points(user.pk, 10), None),
+            'recommendations.rank': (lambda: catalogue.recommend(preferences), None),
+            'search.query': (lambda: catalogue.search('steady legs', equipment='mat'), None),
+            'leaderboard.apply_delta': (lambda: leaderboard.apply_delta(user.pk, delta), None),
+        }
+        if team is not None:
+            scenarios['teams.stats'] = (request('get', f'/api/teams/{team._id}/stats/'), None)
+        for name, url in cached.items():
+            scenarios[name] = (request('get', url), None)
+            scenarios[f'{name}.uncached'] = (request('get', url), cache.clear)
+        return scenarios
+
+    def print_results(self, results, baseline, threshold):
+        header = f"{'scenario':<34}{'p50':>9}{'p95':>9}{'p99':>9}{'queries':>9}{'trips':>7}{'alloc KB':>10}"
+        self.stdout.write(header)
+        for name, result in sorted(results.items()):
+            if 'error' in result:
+                self.stdout.write(self.style.ERROR(f"{name:<34}failed: {result['error']}"))
+                continue
+            line = (
+                f"{name:<34}{result['p50_ms']:>9.2f}{result['p95_ms']:>9.2f}{result['p99_ms']:>9.2f}"
+                f"{result['queries']:>9g}{result['round_trips']:>7g}{result['peak_alloc_kb']:>10.1f}"
+            )
+            previous = (baseline or {}).get(name)
+            if previous and previous.get('p95_ms'):
+                ratio = result['p95_ms'] / previous['p95_ms']
+                line += f'  p95 x{ratio:.2f}'
+                if ratio > threshold:
+                    self.stdout.write(self.style.ERROR(f'{line}  REGRESSION'))
+                    continue
+            self.stdout.write(line)
@@ -0,0 +1,67 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Sum
+
+from octofit_tracker import leaderboard
+from octofit_tracker.benchmarking import isolated_database, seed_activities, seed_users, timed
+from octofit_tracker.models import Activity, Leaderboard
+
+
+def legacy_rebuild(period):
+    """The per-user rebuild update_rankings used before the incremental engine"""
+    for user in User.objects.all():
+        stats = Activity.objects.filter(user=user).aggregate(
+            total_activities=Count('_id'),
+            total_points=Sum('points_earned'),
+            total_duration=Sum('duration'),
+            total_distance=Sum('distance')
+        )
+        Leaderboard.objects.update_or_create(
+            user=user,
+            period=period,
+            defaults={
+                'total_points': stats['total_points'] or 0,
+                'total_activities': stats['total_activities'] or 0,
+                'total_duration': stats['total_duration'] or 0,
+                'total_distance': stats['total_distance'] or 0,
+            }
+        )
+
+    entries = Leaderboard.objects.filter(period=period).order_by('-total_points')
+    for index, entry in enumerate(entries, start=1):
+        entry.rank = index
+        entry.save()
+
+
+class Command(BaseCommand):
+    help = 'Compare the legacy and bulk leaderboard rebuilds on a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100000)
+        parser.add_argument('--activities-per-user', type=int, default=5)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--skip-legacy', action='store_true',
+                            help='Only time the bulk rebuild')
+
+    def handle(self, *args, **options):
+        results = {}
+        with isolated_database(verbosity=options['verbosity']):
+            self.stdout.write(f"Seeding {options['users']} users...")
+            user_ids = seed_users(options['users'])
+            seed_activities(user_ids, options['activities_per_user'], seed=options['seed'])
+
+            if not options['skip_legacy']:
+                self.stdout.write('Running legacy rebuild...')
+                with timed(results, 'legacy'):
+                    legacy_rebuild('benchmark_legacy')
+
+            self.stdout.write('Running bulk rebuild...')
+            with timed(results, 'bulk'):
+                leaderboard.rebuild('benchmark_bulk')
+
+        for name, seconds in results.items():
+            self.stdout.write(f'{name:>8}: {seconds:.2f}s')
+        if 'legacy' in results and results['bulk']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Speedup: {results['legacy'] / results['bulk']:.1f}x"
+            ))
@@ -0,0 +1,74 @@
+import statistics
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+from django.db.models import Count, Sum
+
+from octofit_tracker import rollups
+from octofit_tracker.benchmarking import isolated_database, seed_activities, seed_users, timed
+from octofit_tracker.models import Activity, Team
+from octofit_tracker.repositories import ActivityRepository
+
+
+def orm_stats(activities):
+    """The Django aggregate the stats endpoints used before the repository"""
+    return activities.aggregate(
+        total_activities=Count('_id'),
+        total_points=Sum('points_earned'),
+        total_duration=Sum('duration'),
+        total_distance=Sum('distance')
+    )
+
+
+class Command(BaseCommand):
+    help = 'Compare ORM, native pipeline and rollup stats queries on a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--activities', type=int, default=1000000)
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--team-size', type=int, default=50)
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = {}
+        with isolated_database(verbosity=options['verbosity']):
+            users = options['users']
+            self.stdout.write(f"Seeding {options['activities']} activities for {users} users...")
+            user_ids = seed_users(users)
+            seed_activities(user_ids, max(1, options['activities'] // users), seed=options['seed'])
+            # Seeding bypasses the signals that keep the rollups
+            rollups.rebuild()
+
+            team = Team.objects.create(name='Benchmark Team')
+            members = User.objects.filter(id__in=user_ids[:options['team_size']])
+            team.members.set(members)
+            member_ids = [member.pk for member in team.members.all()]
+            user = User.objects.get(id=user_ids[0])
+            repository = ActivityRepository()
+
+            cases = {
+                'user stats (orm)': lambda: orm_stats(Activity.objects.filter(user=user)),
+                'user stats (native)': lambda: repository.user_stats(user.pk),
+                'user stats (rollup)': lambda: rollups.user_stats(user.pk, list(rollups.BREAKDOWNS)),
+                'team stats (orm)': lambda: orm_stats(Activity.objects.filter(user__in=team.members.all())),
+                'team stats (native)': lambda: repository.users_stats(member_ids),
+            }
+            for name, run in cases.items():
+                samples = {}
+                try:
+                    for index in range(options['repeat']):
+                        with timed(samples, index):
+                            run()
+                except DatabaseError as exc:
+                    # djongo can't translate some aggregate shapes at all
+                    results[name] = exc
+                    continue
+                results[name] = statistics.median(samples.values())
+
+        for name, result in results.items():
+            if isinstance(result, Exception):
+                self.stdout.write(self.style.ERROR(f'{name:>20}: failed ({type(result).__name__})'))
+            else:
+                self.stdout.write(f'{name:>20}: {result * 1000:.1f} ms (median)')
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import export
+
+
+class Command(BaseCommand):
+    help = 'Export activities to a Parquet, Arrow IPC or CSV file for analytics'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to write')
+        parser.add_argument('--format', dest='output', choices=list(export.FORMATS),
+                            default=export.DEFAULT_FORMAT)
+        parser.add_argument('--user', type=int, help='Only this user id')
+        parser.add_argument('--type', dest='activity_type', help='Only this activity type')
+        parser.add_argument('--since', help='ISO date or datetime, inclusive')
+        parser.add_argument('--until', help='ISO date or datetime, exclusive')
+        parser.add_argument('--batch-size', type=int, default=export.EXPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        output = options['output']
+        try:
+            match = export.build_filter(
+                user_id=options['user'],
+                activity_type=options['activity_type'],
+                since=export.parse_bound(options['since']) if options['since'] else None,
+                until=export.parse_bound(options['until']) if options['until'] else None,
+            )
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        written = 0
+        with open(options['path'], 'wb') as destination:
+            for chunk in export.export_activities(match, output, batch_size=options['batch_size']):
+                destination.write(chunk)
+                written += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {written} bytes of {output} to {options['path']}"))
@@ -0,0 +1,177 @@
+import asyncio
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.asgi import get_asgi_application
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from pymongo import monitoring
+
+from octofit_tracker import synthetic
+from octofit_tracker.benchmarking import isolated_database, percentile
+
+PATHS = (
+    '/api/leaderboard/',
+    '/api/activities/my_activities/',
+    '/api/activities/stats/',
+)
+
+
+class MongoLatency(monitoring.CommandListener):
+    """Blocks the calling thread before each command, like a slow network would"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def started(self, event):
+        time.sleep(self.seconds)
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+async def slow_request(application, path, headers, client_delay):
+    """
+    Drive one GET through the ASGI application as a slow client.
+
+    The client takes ``client_delay`` seconds to send its request and the
+    same again to read each part of the response.
+    """
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': headers,
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    sent = False
+    result = {}
+
+    async def receive():
+        nonlocal sent
+        if not sent:
+            sent = True
+            await asyncio.sleep(client_delay)
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Stay connected until the server is done with the request
+        await asyncio.Future()
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            result['status'] = message['status']
+        await asyncio.sleep(client_delay)
+
+    start = time.perf_counter()
+    await application(scope, receive, send)
+    return result.get('status'), time.perf_counter() - start
+
+
+class Command(BaseCommand):
+    help = 'Load test the async read endpoints over ASGI with different read pool sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--activities-per-user', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--clients', type=int, default=1000,
+                            help='Concurrent simulated clients')
+        parser.add_argument('--requests-per-client', type=int, default=3)
+        parser.add_argument('--client-delay', type=float, default=50,
+                            help='Milliseconds each client takes to send and to read')
+        parser.add_argument('--mongo-latency', type=float, default=0,
+                            help='Milliseconds added before every Mongo command')
+        parser.add_argument('--pool-sizes', default='0,4,16,64',
+                            help='Comma-separated ASYNC_READ_POOL_SIZE values; 0 is the plain sync path')
+        parser.add_argument('--output', help='Also save the results as JSON')
+
+    def handle(self, *args, **options):
+        if options['mongo_latency']:
+            monitoring.register(MongoLatency(options['mongo_latency'] / 1000))
+        pool_sizes = [int(size) for size in options['pool_sizes'].split(',')]
+
+        results = {}
+        setup_test_environment()
+        try:
+            with isolated_database(verbosity=options['verbosity']):
+                synthetic.generate(options['users'], options['activities_per_user'], seed=options['seed'])
+                client = Client()
+                client.force_login(User.objects.order_by('id').first())
+                cookie = client.cookies[settings.SESSION_COOKIE_NAME].value
+                headers = [
+                    (b'host', b'testserver'),
+                    (b'cookie', f'{settings.SESSION_COOKIE_NAME}={cookie}'.encode()),
+                ]
+                application = get_asgi_application()
+
+                for size in pool_sizes:
+                    self.stdout.write(f'Pool size {size}: {options["clients"]} clients...')
+                    with override_settings(ASYNC_READ_POOL_SIZE=size):
+                        cache.clear()
+                        results[size] = asyncio.run(self.run_load(application, headers, options))
+        finally:
+            teardown_test_environment()
+
+        self.stdout.write(
+            f"{'pool':>6}{'requests':>10}{'errors':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'threads':>9}"
+        )
+        for size, result in results.items():
+            self.stdout.write(
+                f"{size:>6}{result['requests']:>10}{result['errors']:>8}{result['throughput_rps']:>9.1f}"
+                f"{result['p50_ms']:>9.1f}{result['p95_ms']:>9.1f}{result['p99_ms']:>9.1f}{result['peak_threads']:>9}"
+            )
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump({str(size): result for size, result in results.items()}, output, indent=2)
+
+    async def run_load(self, application, headers, options):
+        client_delay = options['client_delay'] / 1000
+        peak_threads = threading.active_count()
+        running = True
+
+        async def watch_threads():
+            nonlocal peak_threads
+            while running:
+                peak_threads = max(peak_threads, threading.active_count())
+                await asyncio.sleep(0.01)
+
+        async def simulated_client(index):
+            outcomes = []
+            for number in range(options['requests_per_client']):
+                path = PATHS[(index + number) % len(PATHS)]
+                outcomes.append(await slow_request(application, path, headers, client_delay))
+            return outcomes
+
+        watcher = asyncio.ensure_future(watch_threads())
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(simulated_client(index) for index in range(options['clients'])))
+        elapsed = time.perf_counter() - start
+        running = False
+        await watcher
+
+        latencies = sorted(latency for client in outcomes for _, latency in client)
+        errors = sum(1 for client in outcomes for status, _ in client if status != 200)
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'seconds': elapsed,
+            'throughput_rps': len(latencies) / elapsed,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'peak_threads': peak_threads,
+        }
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker.indexes import ensure_indexes, index_report, unused_indexes
+
+
+class Command(BaseCommand):
+    help = 'Create the declared MongoDB indexes and report how often each index is used'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', action='store_true',
+                            help='Only report index usage, without creating indexes')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        if not options['report']:
+            created, failed = ensure_indexes(options['database'])
+            for name in created:
+                self.stdout.write(self.style.SUCCESS(f'Created {name}'))
+            for name, error in failed:
+                self.stdout.write(self.style.ERROR(f'Could not create {name}: {error}'))
+            if not created and not failed:
+                self.stdout.write('All declared indexes exist')
+
+        report = index_report(options['database'])
+        unused = set(unused_indexes(report=report))
+        if not report:
+            self.stdout.write('No index statistics available')
+            return
+
+        self.stdout.write('\nIndex usage since the server started:')
+        for usage in report:
+            keys = ', '.join(f'{field} {direction}' for field, direction in usage.keys)
+            marker = '' if usage.declared or usage.name == '_id_' else '  (undeclared)'
+            line = f'{usage.collection:<20} {usage.name:<24} {usage.ops:>10}  [{keys}]{marker}'
+            if usage in unused:
+                line = self.style.WARNING(line + '  UNUSED')
+            self.stdout.write(line)
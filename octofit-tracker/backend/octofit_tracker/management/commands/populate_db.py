@@ -2,19 +2,41 @@ from django.core.management.base import BaseCommand
 from django.contrib.auth.models import User
 from datetime import datetime, timedelta
 import random
-from octofit_tracker.models import Team, Activity, Leaderboard, Workout, UserProfile
+import time
+from octofit_tracker import leaderboard, rollups, synthetic, teams
+from octofit_tracker.models import (
+    Team, Activity, Leaderboard, LeaderboardBucket, LeaderboardWindow, Workout, UserProfile
+)
 
 
 class Command(BaseCommand):
     help = 'Populate the octofit_db database with test data'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int,
+            help='Generate this many synthetic users instead of the superhero data set'
+        )
+        parser.add_argument('--activities-per-user', type=int, default=50,
+                            help='Mean activities per synthetic user (skewed per user)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Processes inserting synthetic chunks in parallel')
+        parser.add_argument('--chunk-size', type=int, default=synthetic.CHUNK_SIZE,
+                            help='Synthetic users generated per chunk')
+
     def handle(self, *args, **options):
+        if options['users'] is not None:
+            return self.populate_synthetic(options)
+
         self.stdout.write(self.style.SUCCESS('Starting database population...'))
 
         # Clear existing data
         self.stdout.write('Clearing existing data...')
         Activity.objects.all().delete()
         Leaderboard.objects.all().delete()
+        LeaderboardBucket.objects.all().delete()
+        LeaderboardWindow.objects.all().delete()
         Workout.objects.all().delete()
         Team.objects.all().delete()
         UserProfile.objects.all().delete()
@@ -46,7 +68,7 @@ class Command(BaseCommand):
         UserProfile.objects.create(user=user1, fitness_level='advanced', points=1250)
         team_marvel.members.add(user1)
         team_marvel.captain = user1
-        team_marvel.save()
+        team_marvel.save(update_fields=['captain'])
         
         user2 = User.objects.create_user(
             username='captainamerica',
@@ -99,7 +121,7 @@ class Command(BaseCommand):
         UserProfile.objects.create(user=user6, fitness_level='advanced', points=1400)
         team_dc.members.add(user6)
         team_dc.captain = user6
-        team_dc.save()
+        team_dc.save(update_fields=['captain'])
         
         user7 = User.objects.create_user(
             username='batman',
@@ -213,36 +235,14 @@ class Command(BaseCommand):
         # Calculate and insert Leaderboard entries
         self.stdout.write('Calculating leaderboard...')
         
-        leaderboard_count = 0
-        for user in users:
-            user_activities = Activity.objects.filter(user=user)
-            total_points = sum(a.points_earned for a in user_activities)
-            total_activities = user_activities.count()
-            total_duration = sum(a.duration for a in user_activities)
-            total_distance = sum(a.distance for a in user_activities if a.distance)
-            
-            Leaderboard.objects.create(
-                user=user,
-                total_points=total_points,
-                total_activities=total_activities,
-                total_duration=total_duration,
-                total_distance=total_distance,
-                period='all_time'
-            )
-            leaderboard_count += 1
-        
-        # Update ranks
-        leaderboard_entries = Leaderboard.objects.filter(period='all_time').order_by('-total_points')
-        for rank, entry in enumerate(leaderboard_entries, start=1):
-            entry.rank = rank
-            entry.save()
-        
-        # Update team points
-        team_marvel.total_points = sum(Activity.objects.filter(user__in=team_marvel.members.all()).values_list('points_earned', flat=True))
-        team_marvel.save()
-        
-        team_dc.total_points = sum(Activity.objects.filter(user__in=team_dc.members.all()).values_list('points_earned', flat=True))
-        team_dc.save()
+        # Activity signals already keep the entries current; the rebuild also
+        # adds entries for users without activities and re-ranks.
+        leaderboard_count = sum(leaderboard.rebuild(period) for period in leaderboard.PERIODS)
+        
+        # Team totals are maintained the same way; rebuild them for good measure
+        teams.rebuild_totals()
+        # Rollups too; this also drops those of the deleted users
+        rollups.rebuild()
 
         self.stdout.write(self.style.SUCCESS('\n=== Database Population Complete ==='))
         self.stdout.write(self.style.SUCCESS(f'Teams created: 2'))
@@ -251,3 +251,34 @@ class Command(BaseCommand):
         self.stdout.write(self.style.SUCCESS(f'Workouts created: {len(workouts_data)}'))
         self.stdout.write(self.style.SUCCESS(f'Leaderboard entries created: {leaderboard_count}'))
         self.stdout.write(self.style.SUCCESS('\nDatabase successfully populated with superhero test data!'))
+
+    def populate_synthetic(self, options):
+        users = options['users']
+        self.stdout.write(self.style.SUCCESS(
+            f"Generating {users} synthetic users with ~{options['activities_per_user']} "
+            f"activities each (seed {options['seed']}, {options['workers']} workers)..."
+        ))
+        self.stdout.write('Clearing existing data...')
+        synthetic.clear()
+
+        done = {'users': 0}
+
+        def progress(counts):
+            done['users'] += counts[User._meta.db_table]
+            self.stdout.write(f"  {done['users']}/{users} users")
+
+        start = time.perf_counter()
+        totals = synthetic.generate(
+            users,
+            options['activities_per_user'],
+            seed=options['seed'],
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            progress=progress if options['verbosity'] >= 2 else None,
+        )
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(self.style.SUCCESS('\n=== Synthetic Population Complete ==='))
+        for name, count in totals.items():
+            self.stdout.write(self.style.SUCCESS(f'{name}: {count}'))
+        self.stdout.write(self.style.SUCCESS(f'Finished in {elapsed:.1f}s'))
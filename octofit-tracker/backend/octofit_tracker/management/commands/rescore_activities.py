@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from octofit_tracker import scoring
+
+
+class Command(BaseCommand):
+    help = (
+        'Re-score stored activities with a points rule version and pass the differences on '
+        'to profile points, the leaderboards, team totals and rollups.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rules-version', type=int, default=None,
+                            help='Rule version to score with (default: POINTS_RULES_VERSION)')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only re-score this user id; repeat for several users')
+        parser.add_argument('--chunk-size', type=int, default=scoring.RESCORE_CHUNK_SIZE,
+                            help='Users whose activities are re-scored together')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without writing anything')
+
+    def handle(self, *args, **options):
+        try:
+            rules = scoring.get_rules(options['rules_version'])
+        except ValueError as exc:
+            available = ', '.join(str(version) for version in scoring.versions())
+            raise CommandError(f'{exc}. Available: {available}')
+
+        self.stdout.write(f'Re-scoring activities with rules version {rules.version}...')
+
+        def progress(done, total):
+            self.stdout.write(f'  {done}/{total} users')
+
+        report = scoring.rescore(
+            rules.version,
+            user_ids=options['user_ids'],
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run'],
+            progress=progress if options['verbosity'] >= 2 else None,
+        )
+        summary = (
+            f'{report.users} users, {report.activities} activities: {report.changed} changed, '
+            f'{report.points_delta:+d} points'
+        )
+        if options['dry_run']:
+            self.stdout.write(f'Dry run, nothing written. {summary}')
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Re-scored {summary}'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import leaderboard
+
+
+class Command(BaseCommand):
+    help = (
+        'Roll the daily, weekly and monthly leaderboards forward to the current day. '
+        'Schedule this shortly after midnight UTC, e.g. from cron.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--rebuild',
+            action='store_true',
+            help='Recompute the daily buckets from activities and rebuild every period',
+        )
+
+    def handle(self, *args, **options):
+        if options['rebuild']:
+            self.stdout.write('Rebuilding daily buckets...')
+            buckets = leaderboard.rebuild_buckets()
+            self.stdout.write(f'Buckets written: {buckets}')
+            for period in leaderboard.PERIODS:
+                leaderboard.rebuild(period)
+                self.stdout.write(f'Rebuilt {period} leaderboard')
+            return
+
+        moved = leaderboard.roll_all()
+        if moved:
+            self.stdout.write(self.style.SUCCESS(f"Rolled forward: {', '.join(moved)}"))
+        else:
+            self.stdout.write('All leaderboard windows are current')
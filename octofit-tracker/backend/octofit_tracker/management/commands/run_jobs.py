@@ -0,0 +1,39 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Run queued background jobs, such as leaderboard rebuilds. '
+        'Keep at least one worker running next to the web server.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Run the jobs queued now, then exit')
+        parser.add_argument('--poll-interval', type=float,
+                            help='Seconds to wait between checks when the queue is empty')
+        parser.add_argument('--name', help='Worker name shown on claimed jobs')
+
+    def handle(self, *args, **options):
+        worker = options['name'] or jobs.default_worker_name()
+        if options['once']:
+            count = jobs.run_pending(worker)
+            self.stdout.write(self.style.SUCCESS(f'Ran {count} jobs'))
+            return
+
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            # Finish the current job, then exit
+            self.stdout.write('Stopping after the current job...')
+            stop.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+        self.stdout.write(f'Worker {worker} waiting for jobs')
+        jobs.work(stop, worker, poll_interval=options['poll_interval'])
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from octofit_tracker import rollups
+
+SAMPLE_SIZE = 10
+
+
+class Command(BaseCommand):
+    help = (
+        'Check the per-user activity rollups against the activities collection, '
+        'and with --repair rewrite the ones that drifted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true',
+                            help='Rewrite drifted rollups and delete orphaned ones')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids',
+                            help='Only check this user id; repeat for several users')
+
+    def handle(self, *args, **options):
+        report = rollups.verify(repair=options['repair'], user_ids=options['user_ids'])
+        summary = (
+            f'Checked {report.users} users: {len(report.drifted)} drifted, '
+            f'{len(report.orphaned)} orphaned'
+        )
+        if not report.drifted and not report.orphaned:
+            self.stdout.write(self.style.SUCCESS(summary))
+            return
+
+        self.stdout.write(self.style.WARNING(summary))
+        for label, user_ids in (('Drifted', report.drifted), ('Orphaned', report.orphaned)):
+            if user_ids:
+                sample = ', '.join(str(user_id) for user_id in user_ids[:SAMPLE_SIZE])
+                more = f' and {len(user_ids) - SAMPLE_SIZE} more' if len(user_ids) > SAMPLE_SIZE else ''
+                self.stdout.write(f'{label}: {sample}{more}')
+        if options['repair']:
+            self.stdout.write(self.style.SUCCESS(f'Rollups written: {report.written}'))
+        else:
+            self.stdout.write('Run again with --repair to rewrite them')
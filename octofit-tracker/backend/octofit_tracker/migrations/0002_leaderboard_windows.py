@@ -0,0 +1,47 @@
+# Generated by Django 4.1.7 on 2026-10-18 04:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import djongo.models.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('octofit_tracker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardWindow',
+            fields=[
+                ('_id', djongo.models.fields.ObjectIdField(auto_created=True, primary_key=True, serialize=False)),
+                ('period', models.CharField(max_length=20, unique=True)),
+                ('start', models.DateTimeField(help_text='First UTC day in the window')),
+                ('end', models.DateTimeField(help_text='Last UTC day in the window')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'db_table': 'leaderboard_windows',
+            },
+        ),
+        migrations.CreateModel(
+            name='LeaderboardBucket',
+            fields=[
+                ('_id', djongo.models.fields.ObjectIdField(auto_created=True, primary_key=True, serialize=False)),
+                ('day', models.DateTimeField(help_text='Start of the UTC day')),
+                ('total_points', models.IntegerField(default=0)),
+                ('total_activities', models.IntegerField(default=0)),
+                ('total_duration', models.IntegerField(default=0, help_text='Total duration in minutes')),
+                ('total_distance', models.FloatField(default=0, help_text='Total distance in kilometers')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_buckets', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'leaderboard_buckets',
+                'ordering': ['-day'],
+                'unique_together': {('user', 'day')},
+            },
+        ),
+    ]
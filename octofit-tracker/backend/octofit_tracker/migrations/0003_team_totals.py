@@ -0,0 +1,59 @@
+# Generated by Django 4.1.7 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+TOTAL_FIELDS = ('total_points', 'total_activities', 'total_duration', 'total_distance')
+
+
+def sum_member_totals(apps, schema_editor):
+    Activity = apps.get_model('octofit_tracker', 'Activity')
+    Team = apps.get_model('octofit_tracker', 'Team')
+    database = schema_editor.connection.connection
+    totals = {
+        row['_id']: row
+        for row in database[Activity._meta.db_table].aggregate([
+            {'$group': {
+                '_id': '$user_id',
+                'total_points': {'$sum': '$points_earned'},
+                'total_activities': {'$sum': 1},
+                'total_duration': {'$sum': '$duration'},
+                'total_distance': {'$sum': '$distance'},
+            }},
+        ], allowDiskUse=True)
+    }
+    team_totals = {}
+    for membership in database[Team.members.through._meta.db_table].find({}, {'_id': False}):
+        user_totals = totals.get(membership['user_id'])
+        if user_totals is None:
+            continue
+        sums = team_totals.setdefault(membership['team_id'], dict.fromkeys(TOTAL_FIELDS, 0))
+        for field in TOTAL_FIELDS:
+            sums[field] += user_totals[field] or 0
+    for team_id, sums in team_totals.items():
+        database[Team._meta.db_table].update_one({'_id': team_id}, {'$set': sums})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('octofit_tracker', '0002_leaderboard_windows'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='total_activities',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='total_distance',
+            field=models.FloatField(default=0, help_text='Distance in kilometers'),
+        ),
+        migrations.AddField(
+            model_name='team',
+            name='total_duration',
+            field=models.IntegerField(default=0, help_text='Duration in minutes'),
+        ),
+        migrations.RunPython(sum_member_totals, migrations.RunPython.noop),
+    ]
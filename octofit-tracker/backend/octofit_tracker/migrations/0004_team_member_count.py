@@ -0,0 +1,29 @@
+# Generated by Django 4.1.7 on 2026-10-18 15:40
+
+from django.db import migrations, models
+
+
+def count_members(apps, schema_editor):
+    Team = apps.get_model('octofit_tracker', 'Team')
+    database = schema_editor.connection.connection
+    counts = database[Team.members.through._meta.db_table].aggregate([
+        {'$group': {'_id': '$team_id', 'count': {'$sum': 1}}},
+    ])
+    for row in counts:
+        database[Team._meta.db_table].update_one({'_id': row['_id']}, {'$set': {'member_count': row['count']}})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('octofit_tracker', '0003_team_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='team',
+            name='member_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(count_members, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+from datetime import datetime, timezone
+
+from django.db import migrations
+from pymongo import ReplaceOne
+
+ROLLUPS_COLLECTION = 'activity_rollups'
+BATCH_SIZE = 1000
+COUNTER_FIELDS = ('total_activities', 'total_points', 'total_duration', 'total_distance', 'distance_count')
+
+
+def _field_name(value):
+    return value.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def build_rollups(apps, schema_editor):
+    """Write every user's rollup from their activities; see octofit_tracker/rollups.py"""
+    Activity = apps.get_model('octofit_tracker', 'Activity')
+    database = schema_editor.connection.connection
+    groups = database[Activity._meta.db_table].aggregate([
+        {'$group': {
+            '_id': {
+                'user_id': '$user_id',
+                'activity_type': '$activity_type',
+                'year': {'$year': '$date'},
+                'month': {'$month': '$date'},
+            },
+            'total_activities': {'$sum': 1},
+            'total_points': {'$sum': '$points_earned'},
+            'total_duration': {'$sum': '$duration'},
+            'total_distance': {'$sum': '$distance'},
+            'distance_count': {'$sum': {'$cond': [{'$gt': ['$distance', None]}, 1, 0]}},
+        }},
+        # One user's groups in a row, so rollups are written as they complete
+        {'$sort': {'_id.user_id': 1}},
+    ], allowDiskUse=True)
+    collection = database[ROLLUPS_COLLECTION]
+    updated_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    operations = []
+    user_id, rollup = None, None
+    for group in groups:
+        key = group['_id']
+        if key['user_id'] != user_id:
+            if rollup is not None:
+                operations.append(ReplaceOne({'_id': user_id}, {**rollup, 'updated_at': updated_at}, upsert=True))
+            if len(operations) >= BATCH_SIZE:
+                collection.bulk_write(operations, ordered=False)
+                operations = []
+            user_id, rollup = key['user_id'], {'totals': {}, 'types': {}, 'months': {}}
+        entries = (
+            rollup['totals'],
+            rollup['types'].setdefault(_field_name(key['activity_type']), {}),
+            rollup['months'].setdefault(f"{key['year']:04d}-{key['month']:02d}", {}),
+        )
+        for field in COUNTER_FIELDS:
+            for counters in entries:
+                counters[field] = counters.get(field, 0) + (group[field] or 0)
+    if rollup is not None:
+        operations.append(ReplaceOne({'_id': user_id}, {**rollup, 'updated_at': updated_at}, upsert=True))
+    if operations:
+        collection.bulk_write(operations, ordered=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('octofit_tracker', '0004_team_member_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(build_rollups, migrations.RunPython.noop),
+    ]
@@ -24,7 +24,12 @@ class Team(models.Model):
     description = models.TextField(blank=True, null=True)
     members = models.ManyToManyField(User, related_name='teams')
     captain = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, related_name='captained_teams')
+    # Member count and members' activity totals, maintained by octofit_tracker.teams
+    member_count = models.IntegerField(default=0)
     total_points = models.IntegerField(default=0)
+    total_activities = models.IntegerField(default=0)
+    total_duration = models.IntegerField(default=0, help_text='Duration in minutes')
+    total_distance = models.FloatField(default=0, help_text='Distance in kilometers')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -85,6 +90,40 @@ class Leaderboard(models.Model):
         return f"{self.user.username} - Rank {self.rank} ({self.period})"
 
 
+class LeaderboardBucket(models.Model):
+    """Per-user totals for one UTC day, summed to build the windowed periods"""
+    _id = models.ObjectIdField(primary_key=True)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='leaderboard_buckets')
+    day = models.DateTimeField(help_text='Start of the UTC day')
+    total_points = models.IntegerField(default=0)
+    total_activities = models.IntegerField(default=0)
+    total_duration = models.IntegerField(default=0, help_text='Total duration in minutes')
+    total_distance = models.FloatField(default=0, help_text='Total distance in kilometers')
+
+    class Meta:
+        db_table = 'leaderboard_buckets'
+        ordering = ['-day']
+        unique_together = ['user', 'day']
+
+    def __str__(self):
+        return f"{self.user.username} - {self.day:%Y-%m-%d}"
+
+
+class LeaderboardWindow(models.Model):
+    """The range of days currently summed into a windowed leaderboard period"""
+    _id = models.ObjectIdField(primary_key=True)
+    period = models.CharField(max_length=20, unique=True)
+    start = models.DateTimeField(help_text='First UTC day in the window')
+    end = models.DateTimeField(help_text='Last UTC day in the window')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'leaderboard_windows'
+
+    def __str__(self):
+        return f"{self.period}: {self.start:%Y-%m-%d} - {self.end:%Y-%m-%d}"
+
+
 class Workout(models.Model):
     DIFFICULTY_LEVELS = [
         ('beginner', 'Beginner'),
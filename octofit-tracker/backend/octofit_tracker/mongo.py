@@ -0,0 +1,114 @@
+"""
+Direct pymongo access for the hot paths djongo can't translate efficiently
+(atomic increments, bulk writes and aggregation pipelines).
+
+The collections are the same ones the models read and write, reached through
+djongo's own connection: native calls reuse the MongoClient the ORM has open
+on the current thread instead of opening clients of their own.
+"""
+import threading
+from collections import deque
+from datetime import timezone as dt_timezone
+from itertools import islice
+
+from django.db import connections
+from django.utils import timezone
+from pymongo import ReturnDocument
+
+BULK_BATCH_SIZE = 1000
+
+
+def get_database(using='default'):
+    """Return the pymongo Database behind the djongo connection"""
+    connection = connections[using]
+    connection.ensure_connection()
+    return connection.connection
+
+
+def get_collection(model_or_name, using='default'):
+    """Return the pymongo Collection for a model class or collection name"""
+    if isinstance(model_or_name, str):
+        name = model_or_name
+    else:
+        name = model_or_name._meta.db_table
+    return get_database(using)[name]
+
+
+def reserve_ids(model_or_name, count, using='default'):
+    """
+    Reserve ``count`` integer primary keys for documents inserted natively.
+
+    djongo hands out auto-increment ids from a counter in its ``__schema__``
+    collection; advancing the counter in one atomic step keeps later ORM
+    inserts from reusing the ids. Returns the reserved range.
+    """
+    name = model_or_name if isinstance(model_or_name, str) else model_or_name._meta.db_table
+    schema = get_database(using)['__schema__'].find_one_and_update(
+        {'name': name, 'auto': {'$exists': True}},
+        {'$inc': {'auto.seq': count}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if schema is None:
+        raise LookupError(f'No auto-increment counter for {name}; run migrate first')
+    last = schema['auto']['seq']
+    return range(last - count + 1, last + 1)
+
+
+class IdPool:
+    """
+    Integer primary keys for native inserts, reserved ``block_size`` at a time.
+
+    Single inserts take an id from the block in memory instead of spending
+    a round trip on the counter. Ids left unused when the process exits
+    are simply skipped.
+    """
+
+    def __init__(self, model_or_name, block_size=100, using='default'):
+        self.model_or_name = model_or_name
+        self.block_size = block_size
+        self.using = using
+        self._ids = deque()
+        self._lock = threading.Lock()
+
+    def take(self, count=1):
+        """Return ``count`` unused ids"""
+        with self._lock:
+            if len(self._ids) < count:
+                needed = max(self.block_size, count - len(self._ids))
+                self._ids.extend(reserve_ids(self.model_or_name, needed, self.using))
+            return [self._ids.popleft() for _ in range(count)]
+
+
+def to_mongo_datetime(value):
+    """Convert a datetime to the naive UTC value djongo stores"""
+    if value is not None and timezone.is_aware(value):
+        value = timezone.make_naive(value, dt_timezone.utc)
+    return value
+
+
+def from_mongo_datetime(value):
+    """Convert a naive UTC datetime read from Mongo to an aware datetime"""
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def now():
+    """Current time in the format djongo stores"""
+    return to_mongo_datetime(timezone.now())
+
+
+def bulk_write(collection, operations, batch_size=BULK_BATCH_SIZE):
+    """
+    Send an iterable of write operations in unordered batches.
+
+    Returns the number of documents matched, upserted or inserted.
+    """
+    operations = iter(operations)
+    written = 0
+    while True:
+        batch = list(islice(operations, batch_size))
+        if not batch:
+            return written
+        result = collection.bulk_write(batch, ordered=False)
+        written += result.matched_count + result.upserted_count + result.inserted_count
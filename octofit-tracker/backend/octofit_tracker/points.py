@@ -0,0 +1,144 @@
+"""
+Point accrual on user profiles; how many points an activity earns is up to
+scoring.py.
+
+Points are added with an atomic $inc upsert: one round trip per activity,
+and concurrent activities for the same user can no longer overwrite each
+other's increments the way get_or_create() + save() did.
+
+With ``POINTS_WRITE_BEHIND`` enabled, increments are instead merged in
+memory per user and flushed in one bulk write every
+``POINTS_FLUSH_INTERVAL`` seconds, or as soon as ``POINTS_FLUSH_SIZE`` users
+are pending. Profiles then lag by up to one interval, and increments still
+pending when the process dies are lost.
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from pymongo import UpdateOne
+
+from .models import UserProfile
+from .mongo import bulk_write, get_collection, now
+
+logger = logging.getLogger(__name__)
+
+
+def _increment(user_id, points, timestamp):
+    defaults = {
+        name: UserProfile._meta.get_field(name).get_default()
+        for name in ('bio', 'fitness_level')
+    }
+    return UpdateOne(
+        {'user_id': user_id},
+        {
+            '$inc': {'points': points},
+            '$set': {'updated_at': timestamp},
+            '$setOnInsert': {**defaults, 'created_at': timestamp},
+        },
+        upsert=True,
+    )
+
+
+def write_increments(increments):
+    """Apply ``{user_id: points}`` to the profiles in bulk"""
+    timestamp = now()
+    return bulk_write(get_collection(UserProfile), (
+        _increment(user_id, points, timestamp)
+        for user_id, points in increments.items()
+        if points
+    ))
+
+
+class PointsBuffer:
+    """
+    Merges point increments per user and writes them in bulk.
+
+    Timed flushes run on one long-lived daemon thread, started by the first
+    ``add``, so the buffer holds a single database connection however many
+    flushes it makes. A flush that fails keeps its increments and is tried
+    again one interval later.
+    """
+
+    def __init__(self, flush_interval=1.0, flush_size=500):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, user_id, points):
+        with self._lock:
+            self._pending[user_id] = self._pending.get(user_id, 0) + points
+            full = len(self._pending) >= self.flush_size
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='points-flusher', daemon=True)
+                self._thread.start()
+        if full:
+            self.flush()
+        else:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            # Let increments gather for one interval, then write them together
+            time.sleep(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Flushing buffered points failed; retrying in %ss', self.flush_interval)
+
+    def flush(self):
+        """Write every pending increment; returns the number of profiles written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            return write_increments(pending)
+        except Exception:
+            # Keep the increments for the next flush rather than dropping them
+            with self._lock:
+                for user_id, points in pending.items():
+                    self._pending[user_id] = self._pending.get(user_id, 0) + points
+            self._wakeup.set()
+            raise
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Return the process-wide write-behind buffer, or None when disabled"""
+    global _buffer
+    if not getattr(settings, 'POINTS_WRITE_BEHIND', False):
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = PointsBuffer(
+                flush_interval=getattr(settings, 'POINTS_FLUSH_INTERVAL', 1.0),
+                flush_size=getattr(settings, 'POINTS_FLUSH_SIZE', 500),
+            )
+            atexit.register(_buffer.flush)
+    return _buffer
+
+
+def credit_many(increments):
+    """Add ``{user_id: points}`` to the profiles, through the buffer if enabled"""
+    buffer = get_buffer()
+    if buffer is None:
+        return write_increments(increments)
+    for user_id, points in increments.items():
+        if points:
+            buffer.add(user_id, points)
+
+
+def credit_points(user_id, points):
+    """Add points to a user's profile, creating the profile if needed"""
+    credit_many({user_id: points})
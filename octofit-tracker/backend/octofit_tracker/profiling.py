@@ -0,0 +1,240 @@
+"""
+Opt-in per-request profiling.
+
+With ``PROFILING_ENABLED`` set, ``ProfilingMiddleware`` records for every
+request:
+
+* ``sql``: ORM queries, timed around djongo's cursor, so this includes
+  translating the SQL and the Mongo commands the query runs
+* ``translate``: the part of ``sql`` not spent in Mongo commands, i.e.
+  djongo's SQL parsing and result conversion
+* ``mongo``: every Mongo command, from the ORM or from native pymongo
+  calls, timed by pymongo's command listener
+* ``serialize``: time spent producing serializer ``.data``, which is where
+  ``to_representation`` runs for the whole nested tree, including any
+  queries it triggers
+
+The figures go out as a ``Server-Timing`` header and into a rolling window
+of the last ``PROFILING_WINDOW`` requests, summarised per endpoint by
+``summary()`` and served at ``/api/profiling/``.
+
+Command listeners only attach to clients created after they are
+registered, so ``install()`` runs from the app config before the first
+connection is made.
+"""
+import statistics
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from pymongo import monitoring
+from rest_framework.serializers import BaseSerializer
+
+METRICS = ('sql', 'translate', 'mongo', 'serialize')
+
+_state = threading.local()
+_installed = False
+_install_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'PROFILING_ENABLED', False)
+
+
+class RequestProfile:
+    """Counters for one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.sql_mongo_time = 0.0
+        self.mongo_count = 0
+        self.mongo_time = 0.0
+        self.serialize_time = 0.0
+        self.in_sql = False
+        self.serialize_depth = 0
+
+    def timings(self):
+        """Metric name -> (count or None, milliseconds)"""
+        return {
+            'sql': (self.sql_count, self.sql_time * 1000),
+            'translate': (None, max(0.0, self.sql_time - self.sql_mongo_time) * 1000),
+            'mongo': (self.mongo_count, self.mongo_time * 1000),
+            'serialize': (None, self.serialize_time * 1000),
+        }
+
+
+def current_profile():
+    """The profile of the request being handled on this thread, if any"""
+    return getattr(_state, 'profile', None)
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Adds each Mongo command's server round trip to the current request"""
+
+    def started(self, event):
+        pass
+
+    def _finished(self, event):
+        profile = current_profile()
+        if profile is None:
+            return
+        seconds = event.duration_micros / 1e6
+        profile.mongo_count += 1
+        profile.mongo_time += seconds
+        if profile.in_sql:
+            profile.sql_mongo_time += seconds
+
+    succeeded = _finished
+    failed = _finished
+
+
+def _sql_wrapper(execute, sql, params, many, context):
+    profile = current_profile()
+    if profile is None or profile.in_sql:
+        return execute(sql, params, many, context)
+    profile.in_sql = True
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.sql_time += time.perf_counter() - start
+        profile.sql_count += 1
+        profile.in_sql = False
+
+
+def _timed_data(fget):
+    def data(self):
+        profile = current_profile()
+        if profile is None or profile.serialize_depth:
+            return fget(self)
+        profile.serialize_depth += 1
+        start = time.perf_counter()
+        try:
+            return fget(self)
+        finally:
+            profile.serialize_time += time.perf_counter() - start
+            profile.serialize_depth -= 1
+    return data
+
+
+def install():
+    """Register the Mongo listener and wrap serializer output, once per process"""
+    global _installed
+    with _install_lock:
+        if _installed:
+            return
+        monitoring.register(MongoCommandListener())
+        # Serializer.data and ListSerializer.data both go through
+        # BaseSerializer.data, which runs to_representation on the whole tree
+        BaseSerializer.data = property(_timed_data(BaseSerializer.data.fget))
+        _installed = True
+
+
+class ProfileLog:
+    """Rolling window of recent request profiles"""
+
+    def __init__(self, size=1000):
+        self._records = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, record):
+        with self._lock:
+            self._records.append(record)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+
+log = ProfileLog(getattr(settings, 'PROFILING_WINDOW', 1000))
+
+
+def _endpoint(request):
+    # The URL name groups detail URLs for different objects together
+    match = request.resolver_match
+    name = match.view_name if match else '<unresolved>'
+    return f'{request.method} {name}'
+
+
+def summary(sort='p95_ms'):
+    """
+    Per-endpoint summary of the window, worst first.
+
+    ``sort`` names the field to order by, e.g. ``p95_ms``, ``total_ms``
+    (time summed over all requests) or ``mongo_count``.
+    """
+    by_endpoint = {}
+    for record in log.records():
+        by_endpoint.setdefault(record['endpoint'], []).append(record)
+
+    rows = []
+    for endpoint, records in by_endpoint.items():
+        durations = sorted(record['total_ms'] for record in records)
+        row = {
+            'endpoint': endpoint,
+            'requests': len(records),
+            'total_ms': sum(durations),
+            'mean_ms': statistics.mean(durations),
+            'p95_ms': durations[max(0, round(0.95 * len(durations)) - 1)],
+            'max_ms': durations[-1],
+        }
+        for metric in METRICS:
+            row[f'{metric}_ms'] = statistics.mean(record[f'{metric}_ms'] for record in records)
+        for metric in ('sql', 'mongo'):
+            row[f'{metric}_count'] = statistics.mean(record[f'{metric}_count'] for record in records)
+        rows.append(row)
+
+    if rows and sort not in rows[0]:
+        sort = 'p95_ms'
+    return sorted(rows, key=lambda row: row[sort], reverse=True)
+
+
+def server_timing(profile, total):
+    entries = []
+    for name, (count, milliseconds) in profile.timings().items():
+        description = f';desc="{count} calls"' if count is not None else ''
+        entries.append(f'{name}{description};dur={milliseconds:.2f}')
+    entries.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(entries)
+
+
+class ProfilingMiddleware:
+    """Times ORM queries, Mongo commands and serialization per request"""
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            raise MiddlewareNotUsed
+        install()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        _state.profile = profile
+        try:
+            with connections['default'].execute_wrapper(_sql_wrapper):
+                response = self.get_response(request)
+        finally:
+            _state.profile = None
+        total = time.perf_counter() - profile.started
+
+        response['Server-Timing'] = server_timing(profile, total)
+        record = {
+            'endpoint': _endpoint(request),
+            'status': response.status_code,
+            'total_ms': total * 1000,
+        }
+        for name, (count, milliseconds) in profile.timings().items():
+            record[f'{name}_ms'] = milliseconds
+            if count is not None:
+                record[f'{name}_count'] = count
+        log.add(record)
+        return response
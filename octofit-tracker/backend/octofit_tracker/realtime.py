@@ -0,0 +1,350 @@
+"""
+Real-time leaderboard updates over Server-Sent Events.
+
+The leaderboard engine sends ``leaderboard.changed`` whenever entries move.
+``LeaderboardPublisher`` collects the changed periods for a short window
+(``LEADERBOARD_STREAM_COALESCE`` seconds), then reads the top
+``LEADERBOARD_STREAM_SIZE`` entries of each changed period once, diffs them
+against the previous read and publishes only the entries whose rank or
+points changed. However many viewers are connected, a burst of activity
+writes costs one query per period.
+
+Messages go through a broker. ``LocalBroker`` fans them out to the streams
+of this process; a broker shared between processes (e.g. Redis pub/sub)
+can be plugged in with ``LEADERBOARD_BROKER`` and must provide
+``publish``, ``subscribe`` and ``has_subscribers``. With the local broker
+and nobody watching, changes are not computed at all.
+
+Changes made in another process, such as a rebuild run by a ``run_jobs``
+worker, never send the signal here. Once a viewer has connected, the
+publisher also checks the leaderboard's shared cache version every
+``LEADERBOARD_STREAM_POLL`` seconds, and re-reads the watched periods when
+it has moved since they were last read.
+
+``leaderboard_stream`` is a plain ASGI app, mounted by asgi.py at
+``STREAM_PATH``, because Django 4.1 can't stream from an async iterator.
+Each connection gets a ``snapshot`` event with the current top entries,
+then a ``delta`` event per published change. A viewer too slow to keep up
+gets a fresh snapshot instead of a backlog.
+"""
+import asyncio
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.utils.module_loading import import_string
+
+from . import caching, leaderboard
+from .models import Leaderboard, Team
+from .mongo import get_collection
+
+logger = logging.getLogger(__name__)
+
+STREAM_PATH = '/api/leaderboard/stream/'
+HEARTBEAT_SECONDS = 15
+# Sentinel a subscription yields after dropping messages it couldn't hold
+RESYNC = object()
+
+
+def channel_for(period):
+    return f'leaderboard:{period}'
+
+
+class Subscription:
+    """One stream's queue, fed from any thread"""
+
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize)
+        self.overflowed = False
+
+    def deliver(self, message):
+        self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        if self.queue.full():
+            # Drop the backlog; the stream sends a snapshot instead
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.overflowed = True
+            return
+        self.queue.put_nowait(message)
+
+    async def get(self):
+        if self.overflowed:
+            self.overflowed = False
+            return RESYNC
+        message = await self.queue.get()
+        if self.overflowed:
+            self.overflowed = False
+            return RESYNC
+        return message
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker:
+    """In-process pub/sub between threads and event loops"""
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, channel):
+        """Subscribe the running event loop to a channel"""
+        subscription = Subscription(self, channel)
+        with self._lock:
+            self._subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.get(subscription.channel, set()).discard(subscription)
+
+    def has_subscribers(self, channel):
+        with self._lock:
+            return bool(self._subscriptions.get(channel))
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.deliver(message)
+            except RuntimeError:
+                # The subscriber's event loop has closed
+                self.unsubscribe(subscription)
+        return len(subscriptions)
+
+
+def load_entries(period, size):
+    """The top ``size`` entries of a period, with usernames and team names"""
+    entries = list(get_collection(Leaderboard).find(
+        {'period': period},
+        {'_id': False, 'user_id': True, 'rank': True, 'total_points': True, 'total_activities': True},
+        sort=[('rank', 1), ('user_id', 1)],
+        limit=size,
+    ))
+    user_ids = [entry['user_id'] for entry in entries]
+    usernames = {
+        user['id']: user['username']
+        for user in get_collection(User).find({'id': {'$in': user_ids}}, {'id': True, 'username': True})
+    }
+    team_ids = {}
+    for membership in get_collection(Team.members.through).find({'user_id': {'$in': user_ids}}):
+        team_ids.setdefault(membership['user_id'], membership['team_id'])
+    team_names = {
+        team['_id']: team['name']
+        for team in get_collection(Team).find({'_id': {'$in': list(team_ids.values())}}, {'name': True})
+    }
+    for entry in entries:
+        entry['username'] = usernames.get(entry['user_id'])
+        entry['team_name'] = team_names.get(team_ids.get(entry['user_id']))
+    return entries
+
+
+def diff_entries(previous, current):
+    """Return ``(changed entries, user ids that left)`` between two reads"""
+    before = {entry['user_id']: entry for entry in previous}
+    changes = [entry for entry in current if before.get(entry['user_id']) != entry]
+    current_ids = {entry['user_id'] for entry in current}
+    removed = [user_id for user_id in before if user_id not in current_ids]
+    return changes, removed
+
+
+class LeaderboardPublisher:
+    """Coalesces leaderboard changes and publishes them as rank deltas"""
+
+    def __init__(self, broker, size=100, window=0.25, poll_interval=2.0):
+        self.broker = broker
+        self.size = size
+        self.window = window
+        self.poll_interval = poll_interval
+        self._dirty = set()
+        self._snapshots = {}
+        self._versions = {}
+        # Shared leaderboard version the snapshots were read at
+        self._seen_version = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='leaderboard-publisher', daemon=True)
+            self._thread.start()
+
+    def mark_dirty(self, periods):
+        """Note that entries of these periods moved; safe from any thread"""
+        watched = set()
+        with self._lock:
+            for period in periods:
+                if self.broker.has_subscribers(channel_for(period)):
+                    watched.add(period)
+                else:
+                    # Nobody to tell; the next viewer reads a fresh snapshot
+                    self._snapshots.pop(period, None)
+            if not watched:
+                return
+            self._dirty |= watched
+            self._start()
+        self._wakeup.set()
+
+    def poll(self):
+        """Mark every period dirty if the leaderboard changed since it was last read"""
+        version = caching.namespace_state(caching.LEADERBOARD)['version']
+        if self._seen_version is not None and version != self._seen_version:
+            self.mark_dirty(leaderboard.PERIODS)
+        self._seen_version = version
+
+    def _run(self):
+        while True:
+            if not self._wakeup.wait(self.poll_interval):
+                try:
+                    self.poll()
+                except Exception:
+                    logger.exception('Checking for leaderboard changes failed')
+                continue
+            # Let the burst that woke us finish before reading
+            time.sleep(self.window)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Publishing leaderboard changes failed')
+
+    def flush(self):
+        """Publish a delta for every dirty period now; returns the messages sent"""
+        with self._lock:
+            periods, self._dirty = self._dirty, set()
+        if periods:
+            # The reads below see every change up to this version
+            self._seen_version = caching.namespace_state(caching.LEADERBOARD)['version']
+        return sum(self.publish(period) for period in periods)
+
+    def publish(self, period):
+        entries = load_entries(period, self.size)
+        with self._lock:
+            previous = self._snapshots.get(period)
+            version = self._versions.get(period, 0) + 1
+            self._snapshots[period] = entries
+            self._versions[period] = version
+        if previous is None:
+            return 0
+        changes, removed = diff_entries(previous, entries)
+        if not changes and not removed:
+            return 0
+        self.broker.publish(channel_for(period), {
+            'type': 'delta',
+            'period': period,
+            'version': version,
+            'changes': changes,
+            'removed': removed,
+        })
+        return 1
+
+    def snapshot(self, period):
+        """The current top entries, read at most once between changes"""
+        with self._lock:
+            # A viewer is connecting; start watching for changes
+            self._start()
+            entries = self._snapshots.get(period)
+            version = self._versions.get(period, 0)
+        if entries is None:
+            if self._seen_version is None:
+                self._seen_version = caching.namespace_state(caching.LEADERBOARD)['version']
+            entries = load_entries(period, self.size)
+            with self._lock:
+                version = self._versions.get(period, 0) + 1
+                self._snapshots[period] = entries
+                self._versions[period] = version
+        return {'type': 'snapshot', 'period': period, 'version': version, 'entries': entries}
+
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+def get_publisher():
+    """Return the process-wide publisher and its configured broker"""
+    global _publisher
+    with _publisher_lock:
+        if _publisher is None:
+            broker_path = getattr(settings, 'LEADERBOARD_BROKER', 'octofit_tracker.realtime.LocalBroker')
+            _publisher = LeaderboardPublisher(
+                import_string(broker_path)(),
+                size=getattr(settings, 'LEADERBOARD_STREAM_SIZE', 100),
+                window=getattr(settings, 'LEADERBOARD_STREAM_COALESCE', 0.25),
+                poll_interval=getattr(settings, 'LEADERBOARD_STREAM_POLL', 2.0),
+            )
+    return _publisher
+
+
+def format_event(message):
+    return (
+        f"event: {message['type']}\n"
+        f"id: {message['version']}\n"
+        f"data: {json.dumps(message, default=str)}\n\n"
+    ).encode()
+
+
+async def leaderboard_stream(scope, receive, send):
+    """ASGI app streaming one period's leaderboard as Server-Sent Events"""
+    query = parse_qs(scope.get('query_string', b'').decode())
+    period = query.get('period', [leaderboard.DEFAULT_PERIOD])[0]
+    headers = [(b'content-type', b'text/event-stream'), (b'cache-control', b'no-cache'),
+               (b'x-accel-buffering', b'no')]
+    if getattr(settings, 'CORS_ALLOW_ALL_ORIGINS', False):
+        headers.append((b'access-control-allow-origin', b'*'))
+
+    if period not in leaderboard.PERIODS:
+        await send({'type': 'http.response.start', 'status': 400,
+                    'headers': [(b'content-type', b'application/json')]})
+        await send({'type': 'http.response.body',
+                    'body': json.dumps({'detail': f'Unknown period: {period}'}).encode()})
+        return
+
+    publisher = get_publisher()
+    subscription = publisher.broker.subscribe(channel_for(period))
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': headers})
+        message = RESYNC
+        while not disconnected.done():
+            if message is RESYNC:
+                message = await sync_to_async(publisher.snapshot, thread_sensitive=False)(period)
+            if message is not None:
+                await send({'type': 'http.response.body', 'body': format_event(message), 'more_body': True})
+            message = await _next_message(subscription, disconnected)
+            if message is None and not disconnected.done():
+                await send({'type': 'http.response.body', 'body': b': keepalive\n\n', 'more_body': True})
+    finally:
+        subscription.close()
+        disconnected.cancel()
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+
+
+async def _next_message(subscription, disconnected):
+    """The next message, RESYNC, or None on heartbeat timeout or disconnect"""
+    getter = asyncio.ensure_future(subscription.get())
+    done, _ = await asyncio.wait({getter, disconnected}, timeout=HEARTBEAT_SECONDS,
+                                 return_when=asyncio.FIRST_COMPLETED)
+    if getter in done:
+        return getter.result()
+    getter.cancel()
+    return None
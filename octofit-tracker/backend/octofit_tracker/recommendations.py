@@ -0,0 +1,382 @@
+"""
+Workout recommendations ranked from an in-memory index.
+
+Each process keeps the whole workout catalogue as numpy arrays, one row per
+workout: codes for difficulty, activity type and duration band, multi-hot
+matrices of target muscles and equipment, and the creation time. The index
+loads with one query on first use. After that, workout saves and deletes in
+this process update their own row through signals, and the index reloads
+every ``RECOMMENDATION_INDEX_TTL`` seconds to pick up writes made by other
+processes.
+
+A request turns the user's recent activity into weights per feature value:
+each activity type gets the share of minutes the user logged in it over the
+last ``RECENT_DAYS`` days, and the duration band of their average session
+gets the most weight. Scoring the catalogue is then a few array lookups and
+additions. ``argpartition`` picks the top k without sorting every row.
+Difficulty is a filter, not a weight, so users only see workouts at their
+fitness level.
+
+The process-wide instance is ``search.index``: the search index is a
+``WorkoutIndex`` too, so one copy of the catalogue, loaded and reloaded
+once, serves both recommendations and search.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import timedelta
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db import connections
+from django.utils import timezone
+
+from .models import Activity, Workout
+from .mongo import from_mongo_datetime, get_collection, to_mongo_datetime
+
+logger = logging.getLogger(__name__)
+
+RECENT_DAYS = 30
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+# Seconds a failed background reload waits before the next attempt
+RELOAD_RETRY_INTERVAL = 60
+
+# Upper bounds of the duration bands in minutes; the last band is open-ended
+DURATION_BANDS = (15, 30, 45, 60)
+DIFFICULTIES = [level for level, _ in Workout.DIFFICULTY_LEVELS]
+
+ACTIVITY_WEIGHT = 2.0
+DURATION_WEIGHT = 1.0
+MUSCLE_WEIGHT = 1.0
+# Small enough to only break ties, in favour of newer workouts
+RECENCY_WEIGHT = 0.01
+
+FIELDS = ('difficulty', 'activity_type', 'duration', 'target_muscles', 'equipment_needed', 'created_at')
+
+Preferences = namedtuple('Preferences', 'difficulty activity_mix usual_duration muscles equipment')
+
+
+def duration_band(minutes):
+    return bisect_right(DURATION_BANDS, minutes or 0)
+
+
+def _as_list(value):
+    # Older documents may hold the JSON fields as encoded strings
+    if isinstance(value, str):
+        value = json.loads(value or '[]')
+    return [item for item in value or () if isinstance(item, str)]
+
+
+class Vocabulary:
+    """Gives each distinct value a column number, in order of appearance"""
+
+    def __init__(self):
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def add(self, value):
+        return self.codes.setdefault(value, len(self.codes))
+
+    def get(self, value):
+        return self.codes.get(value)
+
+
+class WorkoutIndex:
+    """The workout catalogue as feature arrays, one row per workout"""
+
+    # Workout fields read into the index
+    fields = FIELDS
+
+    def __init__(self, capacity=1024, ttl=None):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.loaded_at = None
+        self._lock = threading.RLock()
+        # Held by whoever is loading; writes made meanwhile are kept in
+        # ``_pending`` and replayed on the new arrays
+        self._load_lock = threading.Lock()
+        self._pending = None
+        self._reload_failed_at = None
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.size = 0
+        self.ids = []
+        self.rows = {}
+        self.activity_types = Vocabulary()
+        self.muscles = Vocabulary()
+        self.equipment = Vocabulary()
+        self.active = np.zeros(capacity, dtype=bool)
+        self.difficulty = np.full(capacity, -1, dtype=np.int8)
+        self.activity_type = np.zeros(capacity, dtype=np.int32)
+        self.band = np.zeros(capacity, dtype=np.int8)
+        self.created = np.zeros(capacity, dtype=np.float64)
+        # One line per muscle or piece of equipment, one column per workout,
+        # so reading the workouts with a given value is a contiguous scan
+        self.muscle_flags = np.zeros((16, capacity), dtype=bool)
+        self.equipment_flags = np.zeros((16, capacity), dtype=bool)
+
+    def clear(self):
+        """Forget everything; the next use reloads from the database"""
+        with self._lock:
+            self.loaded_at = None
+            self._allocate(self.capacity)
+
+    def _grow_rows(self, needed):
+        capacity = len(self.active)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name in ('active', 'difficulty', 'activity_type', 'band', 'created'):
+            array = getattr(self, name)
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:len(array)] = array
+            setattr(self, name, grown)
+        for name in ('muscle_flags', 'equipment_flags'):
+            flags = getattr(self, name)
+            grown = np.zeros((len(flags), capacity), dtype=bool)
+            grown[:, :flags.shape[1]] = flags
+            setattr(self, name, grown)
+
+    def _fit_columns(self):
+        for name, vocabulary in (('muscle_flags', self.muscles), ('equipment_flags', self.equipment)):
+            flags = getattr(self, name)
+            if len(vocabulary) > len(flags):
+                grown = np.zeros((max(len(vocabulary), len(flags) * 2), flags.shape[1]), dtype=bool)
+                grown[:len(flags)] = flags
+                setattr(self, name, grown)
+
+    def _encode(self, document):
+        """One workout document as its row values, adding new values to the vocabularies"""
+        difficulty = document.get('difficulty')
+        created_at = from_mongo_datetime(document.get('created_at'))
+        return (
+            DIFFICULTIES.index(difficulty) if difficulty in DIFFICULTIES else -1,
+            self.activity_types.add(document.get('activity_type')),
+            duration_band(document.get('duration')),
+            created_at.timestamp() if created_at else 0.0,
+            [self.muscles.add(muscle) for muscle in _as_list(document.get('target_muscles'))],
+            [self.equipment.add(item) for item in _as_list(document.get('equipment_needed'))],
+        )
+
+    def _set_row(self, workout_id, document):
+        row = self.rows.get(workout_id)
+        if row is None:
+            row = self.size
+            self._grow_rows(row + 1)
+            self.rows[workout_id] = row
+            self.ids.append(workout_id)
+            self.size += 1
+        difficulty, activity_type, band, created, muscles, equipment = self._encode(document)
+        self._fit_columns()
+        self.difficulty[row] = difficulty
+        self.activity_type[row] = activity_type
+        self.band[row] = band
+        self.created[row] = created
+        self.muscle_flags[:, row] = False
+        self.muscle_flags[muscles, row] = True
+        self.equipment_flags[:, row] = False
+        self.equipment_flags[equipment, row] = True
+        self.active[row] = True
+        self._index_document(row, document)
+
+    def _index_document(self, row, document):
+        """Hook for subclasses keeping more per row; called on every load and update"""
+
+    def stored_documents(self):
+        return get_collection(Workout).find({}, {name: True for name in self.fields})
+
+    def load(self, documents=None):
+        """
+        Rebuild the whole index from workout documents, by default all stored ones.
+
+        The new arrays are built aside and swapped in at the end, so queries
+        keep using the current ones until then.
+        """
+        if documents is None:
+            documents = self.stored_documents()
+        with self._lock:
+            self._pending = []
+        try:
+            fresh = type(self)(self.capacity, self.ttl)
+            fresh._fill(documents)
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            pending, self._pending = self._pending, None
+            vars(self).update({
+                name: value for name, value in vars(fresh).items()
+                if name not in ('_lock', '_load_lock', '_pending', '_reload_failed_at')
+            })
+            for workout_id, document in pending:
+                if document is None:
+                    self._deactivate(workout_id)
+                else:
+                    self._set_row(workout_id, document)
+            self.loaded_at = time.monotonic()
+
+    def _fill(self, documents):
+        rows = []
+        for document in documents:
+            self._index_document(len(rows), document)
+            self.ids.append(document['_id'])
+            rows.append(self._encode(document))
+        self.size = len(rows)
+        self.rows = {workout_id: row for row, workout_id in enumerate(self.ids)}
+        self._grow_rows(self.size)
+        self._fit_columns()
+        if rows:
+            # Fill whole columns at once rather than row by row
+            difficulty, activity_type, band, created, muscles, equipment = zip(*rows)
+            self.difficulty[:self.size] = difficulty
+            self.activity_type[:self.size] = activity_type
+            self.band[:self.size] = band
+            self.created[:self.size] = created
+            self.active[:self.size] = True
+            for flags, codes in ((self.muscle_flags, muscles), (self.equipment_flags, equipment)):
+                flags[list(chain.from_iterable(codes)),
+                      np.repeat(np.arange(self.size), [len(row) for row in codes])] = True
+
+    def ensure_loaded(self):
+        """
+        Load the index on first use, and reload it once older than the TTL.
+
+        Only the first load makes callers wait. Later reloads run on a
+        thread of their own while queries carry on with the current arrays;
+        after a failed reload the next one waits ``RELOAD_RETRY_INTERVAL``
+        seconds.
+        """
+        ttl = self.ttl if self.ttl is not None else getattr(settings, 'RECOMMENDATION_INDEX_TTL', 300)
+        loaded_at = self.loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at <= ttl:
+            return
+        if loaded_at is None:
+            with self._load_lock:
+                if self.loaded_at is None:
+                    self.load()
+        elif self._reload_failed_at is not None and time.monotonic() - self._reload_failed_at < RELOAD_RETRY_INTERVAL:
+            return
+        elif self._load_lock.acquire(blocking=False):
+            threading.Thread(target=self._reload, name='workout-index-reload', daemon=True).start()
+
+    def _reload(self):
+        try:
+            self.load()
+        except Exception:
+            self._reload_failed_at = time.monotonic()
+            logger.exception('Reloading the workout index failed; retrying in %ss', RELOAD_RETRY_INTERVAL)
+        else:
+            self._reload_failed_at = None
+        finally:
+            # The scan ran on this thread's own connection, opened by load()
+            connections.close_all()
+            self._load_lock.release()
+
+    def update(self, workout):
+        """Add or refresh one workout's row; a no-op until the index is loaded"""
+        document = {name: getattr(workout, name) for name in self.fields}
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((workout.pk, document))
+            if self.loaded_at is not None:
+                self._set_row(workout.pk, document)
+
+    def remove(self, workout_id):
+        """Leave a workout out of results; its row goes on the next reload"""
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((workout_id, None))
+            self._deactivate(workout_id)
+
+    def _deactivate(self, workout_id):
+        row = self.rows.get(workout_id)
+        if row is not None:
+            self.active[row] = False
+
+    def recommend(self, preferences, limit=DEFAULT_LIMIT):
+        """Return ``(workout id, score)`` for the best ``limit`` workouts, best first"""
+        self.ensure_loaded()
+        with self._lock:
+            size = self.size
+            if preferences.difficulty not in DIFFICULTIES or not size:
+                return []
+            eligible = self.active[:size] & (self.difficulty[:size] == DIFFICULTIES.index(preferences.difficulty))
+            if preferences.equipment is not None:
+                missing = [code for value, code in self.equipment.codes.items() if value not in preferences.equipment]
+                if missing:
+                    eligible &= ~self.equipment_flags[missing, :size].any(axis=0)
+            count = min(limit, int(eligible.sum()))
+            if not count:
+                return []
+
+            type_weights = np.zeros(len(self.activity_types) or 1)
+            for activity_type, share in preferences.activity_mix.items():
+                code = self.activity_types.get(activity_type)
+                if code is not None:
+                    type_weights[code] = ACTIVITY_WEIGHT * share
+            scores = type_weights[self.activity_type[:size]]
+
+            if preferences.usual_duration is not None:
+                distance = np.abs(np.arange(len(DURATION_BANDS) + 1) - duration_band(preferences.usual_duration))
+                band_weights = DURATION_WEIGHT / (1 + distance)
+                scores += band_weights[self.band[:size]]
+
+            muscles = [code for code in map(self.muscles.get, preferences.muscles) if code is not None]
+            if muscles:
+                scores += MUSCLE_WEIGHT * self.muscle_flags[muscles, :size].sum(axis=0)
+
+            created = self.created[:size]
+            span = created.max() - created.min()
+            if span:
+                scores += RECENCY_WEIGHT * (created - created.min()) / span
+
+            scores[~eligible] = -np.inf
+            top = np.argpartition(-scores, count - 1)[:count]
+            top = top[np.argsort(-scores[top], kind='stable')]
+            return [(self.ids[row], float(scores[row])) for row in top]
+
+
+def user_preferences(user_id, difficulty, muscles=(), equipment=None):
+    """
+    Preferences from the user's activity over the last ``RECENT_DAYS`` days.
+
+    ``equipment`` is the equipment the user has, or None to not filter on it.
+    """
+    activity_mix = {}
+    usual_duration = None
+    if user_id is not None:
+        since = to_mongo_datetime(timezone.now() - timedelta(days=RECENT_DAYS))
+        groups = list(get_collection(Activity).aggregate([
+            {'$match': {'user_id': user_id, 'date': {'$gte': since}}},
+            {'$group': {'_id': '$activity_type', 'minutes': {'$sum': '$duration'}, 'count': {'$sum': 1}}},
+        ]))
+        minutes = sum(group['minutes'] or 0 for group in groups)
+        sessions = sum(group['count'] for group in groups)
+        if minutes:
+            activity_mix = {group['_id']: (group['minutes'] or 0) / minutes for group in groups}
+        if sessions:
+            usual_duration = minutes / sessions
+    return Preferences(
+        difficulty=difficulty,
+        activity_mix=activity_mix,
+        usual_duration=usual_duration,
+        muscles=list(muscles),
+        equipment=None if equipment is None else set(equipment),
+    )
+
+
+def recommend(user_id, difficulty, limit=DEFAULT_LIMIT, muscles=(), equipment=None):
+    # search imports this module for WorkoutIndex
+    from .search import index
+
+    return index.recommend(user_preferences(user_id, difficulty, muscles, equipment), limit)
@@ -0,0 +1,68 @@
+"""
+Native pymongo queries for hot read paths.
+
+djongo turns ORM aggregates into SQL and parses that back into Mongo
+operations on every call, and falls back to fetching documents into Python
+for shapes it can't translate. The repositories here send $match/$group
+pipelines straight to the collections through the shared client instead,
+and return the same shapes the ORM code did.
+"""
+from .models import Activity
+from .mongo import get_collection
+
+STATS_FIELDS = ('total_activities', 'total_points', 'total_duration', 'total_distance')
+
+
+class ActivityRepository:
+    """Aggregations over the activities collection"""
+
+    def __init__(self, collection=None):
+        self.collection = collection if collection is not None else get_collection(Activity)
+
+    @staticmethod
+    def _totals_group(group_id):
+        return {
+            '_id': group_id,
+            'total_activities': {'$sum': 1},
+            'total_points': {'$sum': '$points_earned'},
+            'total_duration': {'$sum': '$duration'},
+            'total_distance': {'$sum': '$distance'},
+            # Sum() over only NULL distances is None, not 0
+            'distance_count': {'$sum': {'$cond': [{'$gt': ['$distance', None]}, 1, 0]}},
+        }
+
+    def stats(self, match):
+        """
+        Totals for the activities matching a Mongo filter.
+
+        Matches ``aggregate(Count('_id'), Sum(...))``: the count is 0 and the
+        sums are None when nothing matches.
+        """
+        pipeline = [
+            {'$match': match},
+            {'$group': self._totals_group(None)},
+        ]
+        row = next(self.collection.aggregate(pipeline), None)
+        if row is None or not row['total_activities']:
+            return {'total_activities': 0, 'total_points': None,
+                    'total_duration': None, 'total_distance': None}
+        if not row['distance_count']:
+            row['total_distance'] = None
+        return {field: row[field] for field in STATS_FIELDS}
+
+    def user_stats(self, user_id):
+        """Totals for one user's activities"""
+        return self.stats({'user_id': user_id})
+
+    def users_stats(self, user_ids):
+        """Combined totals for several users' activities, e.g. a team"""
+        return self.stats({'user_id': {'$in': list(user_ids)}})
+
+    def totals_by_user(self, match=None):
+        """Per-user totals as ``{user_id: {field: value}}``"""
+        pipeline = [{'$match': match}] if match else []
+        pipeline.append({'$group': self._totals_group('$user_id')})
+        return {
+            row['_id']: {field: row[field] for field in STATS_FIELDS}
+            for row in self.collection.aggregate(pipeline, allowDiskUse=True)
+        }
@@ -0,0 +1,253 @@
+"""
+Per-user activity rollups.
+
+Every user with activities has one document in the ``activity_rollups``
+collection, keyed by user id. It holds their lifetime totals, and the same
+totals per activity type and per calendar month (UTC)::
+
+    {'_id': 42,
+     'totals': {'total_activities': 3, 'total_points': 120, ...},
+     'types': {'running': {...}, 'yoga': {...}},
+     'months': {'2026-09': {...}, '2026-10': {...}}}
+
+Every activity write applies its delta to all three parts with one ``$inc``
+on the user's document, so they can't disagree, and an edit that changes an
+activity's type, date or numbers moves its contribution from the old
+entries to the new ones in the same update. Reading a user's stats is one
+lookup by id, however long their history.
+
+Migration 0005 builds the rollups of activities written before they
+existed. ``verify`` recomputes the rollups from the activities collection
+in a single pass and reports the users whose stored rollup drifted from
+it; with ``repair`` it also rewrites them. Activities written while it runs can be
+reported as drift, so repair when writes are quiet.
+"""
+import math
+from collections import namedtuple
+from urllib.parse import unquote
+
+from pymongo import ReplaceOne, UpdateOne
+
+from .models import Activity
+from .mongo import BULK_BATCH_SIZE, bulk_write, get_collection, now
+
+ROLLUPS_COLLECTION = 'activity_rollups'
+
+COUNTER_FIELDS = ('total_activities', 'total_points', 'total_duration', 'total_distance', 'distance_count')
+# Breakdown name, as in ``?breakdown=``, -> part of the rollup document
+BREAKDOWNS = {'type': 'types', 'month': 'months'}
+
+VerifyReport = namedtuple('VerifyReport', ['users', 'drifted', 'orphaned', 'written'])
+
+
+def get_rollups_collection():
+    return get_collection(ROLLUPS_COLLECTION)
+
+
+def month_key(day):
+    return day.strftime('%Y-%m')
+
+
+def _field_name(value):
+    # Activity types become field names, which can't contain '.' or start with '$'
+    return value.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+
+def _counters(snap, sign):
+    return {
+        'total_activities': sign,
+        'total_points': sign * snap['points_earned'],
+        'total_duration': sign * snap['duration'],
+        'total_distance': sign * snap['distance'],
+        'distance_count': sign if snap['has_distance'] else 0,
+    }
+
+
+def _increments(changes):
+    """Merge ``(snapshot, sign)`` pairs into ``{user_id: {path: amount}}``"""
+    increments = {}
+    for snap, sign in changes:
+        paths = increments.setdefault(snap['user_id'], {})
+        prefixes = (
+            'totals',
+            f"types.{_field_name(snap['activity_type'])}",
+            f"months.{month_key(snap['day'])}",
+        )
+        for field, amount in _counters(snap, sign).items():
+            for prefix in prefixes:
+                path = f'{prefix}.{field}'
+                paths[path] = paths.get(path, 0) + amount
+    return {
+        user_id: {path: amount for path, amount in paths.items() if amount}
+        for user_id, paths in increments.items()
+    }
+
+
+def apply_activity_changes(changes):
+    """Apply ``(snapshot, sign)`` pairs, one update per user"""
+    timestamp = now()
+    return bulk_write(get_rollups_collection(), (
+        UpdateOne({'_id': user_id}, {'$inc': paths, '$set': {'updated_at': timestamp}}, upsert=True)
+        for user_id, paths in _increments(changes).items()
+        if paths
+    ))
+
+
+def apply_activity_change(previous, current):
+    """
+    Apply the delta between two activity snapshots to the user's rollup.
+
+    Snapshots are the ones taken by ``leaderboard.snapshot``; pass
+    ``previous=None`` for a new activity and ``current=None`` for a deleted
+    one.
+    """
+    apply_activity_changes([(snap, sign) for snap, sign in ((previous, -1), (current, 1)) if snap is not None])
+
+
+def apply_activity_batch(snapshots):
+    """Apply a batch of new activities, one update per user"""
+    apply_activity_changes([(snap, 1) for snap in snapshots])
+
+
+def _stats(counters):
+    """A counter set in the shape of ``ActivityRepository.stats``"""
+    if not counters or not counters.get('total_activities'):
+        return {'total_activities': 0, 'total_points': None, 'total_duration': None, 'total_distance': None}
+    return {
+        'total_activities': counters['total_activities'],
+        'total_points': counters.get('total_points', 0),
+        'total_duration': counters.get('total_duration', 0),
+        # Like Sum(), no distances at all is None rather than 0
+        'total_distance': counters.get('total_distance', 0) if counters.get('distance_count') else None,
+    }
+
+
+def user_stats(user_id, breakdowns=()):
+    """
+    A user's lifetime totals, plus ``by_type`` and ``by_month`` totals when
+    those breakdowns are asked for.
+    """
+    projection = {'totals': True}
+    for name in breakdowns:
+        projection[BREAKDOWNS[name]] = True
+    rollup = get_rollups_collection().find_one({'_id': user_id}, projection) or {}
+    stats = _stats(rollup.get('totals'))
+    for name in breakdowns:
+        stats[f'by_{name}'] = {
+            unquote(key): _stats(counters)
+            for key, counters in sorted(rollup.get(BREAKDOWNS[name], {}).items())
+            if counters.get('total_activities')
+        }
+    return stats
+
+
+def _expected_rollups(match=None):
+    """Yield ``(user_id, rollup)`` recomputed from the activities, in user id order"""
+    pipeline = [{'$match': match}] if match else []
+    pipeline += [
+        {'$group': {
+            '_id': {
+                'user_id': '$user_id',
+                'activity_type': '$activity_type',
+                'year': {'$year': '$date'},
+                'month': {'$month': '$date'},
+            },
+            'total_activities': {'$sum': 1},
+            'total_points': {'$sum': '$points_earned'},
+            'total_duration': {'$sum': '$duration'},
+            'total_distance': {'$sum': '$distance'},
+            'distance_count': {'$sum': {'$cond': [{'$gt': ['$distance', None]}, 1, 0]}},
+        }},
+        {'$sort': {'_id.user_id': 1}},
+    ]
+    user_id, rollup = None, None
+    for group in get_collection(Activity).aggregate(pipeline, allowDiskUse=True):
+        key = group['_id']
+        if key['user_id'] != user_id:
+            if rollup is not None:
+                yield user_id, rollup
+            user_id, rollup = key['user_id'], {'totals': {}, 'types': {}, 'months': {}}
+        entries = (
+            rollup['totals'],
+            rollup['types'].setdefault(_field_name(key['activity_type']), {}),
+            rollup['months'].setdefault(f"{key['year']:04d}-{key['month']:02d}", {}),
+        )
+        for field in COUNTER_FIELDS:
+            for counters in entries:
+                counters[field] = counters.get(field, 0) + (group[field] or 0)
+    if rollup is not None:
+        yield user_id, rollup
+
+
+def _flatten(rollup):
+    """``{(part, key, field): value}`` without zeros, so a missing counter equals a zero one"""
+    values = {('totals', None, field): value for field, value in rollup.get('totals', {}).items()}
+    for part in BREAKDOWNS.values():
+        for key, counters in rollup.get(part, {}).items():
+            values.update({(part, key, field): value for field, value in counters.items()})
+    # Floats summed by $inc and by $sum can differ in the last bits
+    return {path: value for path, value in values.items() if abs(value) > 1e-6}
+
+
+def _drifted(stored, expected):
+    stored, expected = _flatten(stored), _flatten(expected)
+    return stored.keys() != expected.keys() or any(
+        not math.isclose(stored[path], expected[path], rel_tol=1e-9, abs_tol=1e-6) for path in stored
+    )
+
+
+def _batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def verify(repair=False, user_ids=None, batch_size=BULK_BATCH_SIZE):
+    """
+    Compare every stored rollup with one recomputed from the activities.
+
+    Only users in ``user_ids`` are checked when given. With ``repair``,
+    drifted rollups are rewritten and orphaned ones (counting activities
+    that no longer exist) deleted. Returns a ``VerifyReport`` with the
+    number of users checked, the ids of drifted and orphaned rollups, and
+    the number of rollups written or deleted.
+    """
+    collection = get_rollups_collection()
+    match = {'user_id': {'$in': list(user_ids)}} if user_ids is not None else None
+    checked = set()
+    drifted = []
+    written = 0
+    timestamp = now()
+    for batch in _batches(_expected_rollups(match), batch_size):
+        stored = {
+            rollup['_id']: rollup
+            for rollup in collection.find({'_id': {'$in': [user_id for user_id, _ in batch]}})
+        }
+        replacements = []
+        for user_id, expected in batch:
+            checked.add(user_id)
+            if _drifted(stored.get(user_id, {}), expected):
+                drifted.append(user_id)
+                replacements.append(ReplaceOne({'_id': user_id}, {**expected, 'updated_at': timestamp}, upsert=True))
+        if repair:
+            written += bulk_write(collection, replacements)
+
+    orphan_filter = {'_id': {'$in': list(user_ids)}} if user_ids is not None else {}
+    orphaned = [
+        rollup['_id']
+        for rollup in collection.find(orphan_filter)
+        if rollup['_id'] not in checked and _flatten(rollup)
+    ]
+    if repair and orphaned:
+        written += collection.delete_many({'_id': {'$in': orphaned}}).deleted_count
+    return VerifyReport(users=len(checked), drifted=drifted, orphaned=orphaned, written=written)
+
+
+def rebuild():
+    """Rewrite every rollup from the activities; returns the number written"""
+    return verify(repair=True).written
@@ -0,0 +1,365 @@
+"""
+Table-driven activity scoring.
+
+The points an activity earns are set by a versioned ``RuleSet``: points per
+minute, a multiplier per activity type, a bonus per kilometre per type, a
+bonus multiplier for streaks of consecutive active days, and a cap per
+activity. ``POINTS_RULES_VERSION`` picks the rules new activities are
+scored with; registering a new version and pointing the setting at it
+changes scoring without touching the write paths.
+
+``evaluate`` scores columns of activities with array arithmetic, so
+scoring a device batch, a synthetic chunk or a re-score chunk costs one
+pass however many activities it holds. A streak counts the user's
+consecutive UTC days with activities up to and including the activity's
+own day, so it depends on the user's other activities: the write paths
+look up the recent days they need, and ``rescore`` reads whole histories.
+A write on one day can start, extend or break the streaks of the user's
+later activities, so the write paths follow it with ``rescore_around``.
+
+Activities keep the points they were scored with. ``rescore`` re-scores
+history with a rule version, writes the changed activities back and passes
+the differences on to profile points, leaderboard entries and buckets, team
+totals and rollups as increments, so nothing is recomputed from scratch.
+"""
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.contrib.auth.models import User
+from pymongo import UpdateOne
+
+from . import leaderboard, rollups, teams, timeseries
+from .models import Activity
+from .mongo import bulk_write, get_collection, to_mongo_datetime
+from .points import write_increments
+
+RuleSet = namedtuple('RuleSet', [
+    'version',
+    'points_per_minute',
+    # Activity type -> multiplier; types without one use 1.0
+    'multipliers',
+    # Activity type -> points per kilometre
+    'distance_bonus',
+    # (streak days, extra multiplier) tiers in increasing order; the
+    # longest tier reached applies
+    'streak_bonus',
+    # Most points one activity can earn, or None
+    'max_points',
+], defaults=[{}, (), None])
+
+RescoreReport = namedtuple('RescoreReport', ['version', 'users', 'activities', 'changed', 'points_delta'])
+
+RESCORE_CHUNK_SIZE = 1000  # users per chunk
+
+_rulesets = {}
+
+
+def register(rules):
+    """Make a rule set available by its version"""
+    _rulesets[rules.version] = rules
+    return rules
+
+
+def get_rules(version=None):
+    """The rule set with this version, by default the one new activities use"""
+    if version is None:
+        version = getattr(settings, 'POINTS_RULES_VERSION', 1)
+    try:
+        return _rulesets[version]
+    except KeyError:
+        raise ValueError(f'Unknown points rules version: {version}') from None
+
+
+def versions():
+    return sorted(_rulesets)
+
+
+register(RuleSet(
+    version=1,
+    points_per_minute=1,
+    multipliers={
+        'running': 1.5,
+        'cycling': 1.3,
+        'swimming': 1.6,
+        'strength_training': 1.4,
+        'walking': 1.0,
+        'yoga': 1.2,
+        'other': 1.0,
+    },
+))
+
+register(RuleSet(
+    version=2,
+    points_per_minute=1,
+    multipliers=get_rules(1).multipliers,
+    distance_bonus={'running': 2, 'walking': 1, 'cycling': 0.5, 'swimming': 8},
+    streak_bonus=((3, 0.1), (7, 0.25), (30, 0.5)),
+    max_points=600,
+))
+
+
+def day_number(value):
+    """The UTC day of a datetime, as a proleptic ordinal"""
+    return to_mongo_datetime(value).toordinal()
+
+
+def streak_lengths(user_ids, days):
+    """
+    For each activity, the number of consecutive days ending on its day on
+    which the same user has activities. ``days`` are day numbers.
+    """
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    days = np.asarray(days, dtype=np.int64)
+    if not len(days):
+        return np.zeros(0, dtype=np.int64)
+    # One key per (user, day), ordered by user then day
+    span = int(days.max()) + 1
+    keys, inverse = np.unique(user_ids * span + days, return_inverse=True)
+    key_users, key_days = np.divmod(keys, span)
+    positions = np.arange(len(keys))
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = (key_users[1:] != key_users[:-1]) | (key_days[1:] - key_days[:-1] != 1)
+    run_start = np.maximum.accumulate(np.where(starts, positions, 0))
+    return (positions - run_start + 1)[inverse]
+
+
+def _per_type(table, types, default):
+    """Look ``types`` up in ``table`` once per distinct type"""
+    distinct, inverse = np.unique(np.asarray(types, dtype=object).astype(str), return_inverse=True)
+    return np.array([table.get(name, default) for name in distinct], dtype=np.float64)[inverse]
+
+
+def evaluate(rules, activity_types, durations, distances=None, streaks=None):
+    """
+    Points for columns of activities as an int64 array.
+
+    ``distances`` may hold None for activities without one; ``streaks`` are
+    the streak lengths, and no streak bonus applies without them.
+    """
+    durations = np.asarray(durations, dtype=np.float64)
+    if not len(durations):
+        return np.zeros(0, dtype=np.int64)
+    points = durations * rules.points_per_minute * _per_type(rules.multipliers, activity_types, 1.0)
+    if rules.distance_bonus and distances is not None:
+        kilometres = np.nan_to_num(np.asarray(distances, dtype=np.float64))
+        points = points + kilometres * _per_type(rules.distance_bonus, activity_types, 0.0)
+    if rules.streak_bonus and streaks is not None:
+        thresholds = np.array([days for days, _ in rules.streak_bonus])
+        extras = np.array([0.0] + [extra for _, extra in rules.streak_bonus])
+        points = points * (1 + extras[np.searchsorted(thresholds, streaks, side='right')])
+    if rules.max_points is not None:
+        points = np.minimum(points, rules.max_points)
+    # Truncate like int() always has
+    return np.trunc(points).astype(np.int64)
+
+
+def score_documents(documents, rules=None, history=()):
+    """
+    Points for activity dicts with ``activity_type``, ``duration``,
+    ``distance`` and, for streaks, ``user_id`` and ``date``.
+
+    Streaks count the days of the documents themselves plus ``history``, an
+    iterable of ``(user_id, day number)`` for activities already stored.
+    """
+    rules = rules or get_rules()
+    streaks = None
+    if rules.streak_bonus and documents:
+        history = list(history)
+        user_ids = [user_id for user_id, _ in history] + [document['user_id'] for document in documents]
+        days = [day for _, day in history] + [day_number(document['date']) for document in documents]
+        streaks = streak_lengths(user_ids, days)[len(history):]
+    return evaluate(
+        rules,
+        [document.get('activity_type', '') for document in documents],
+        [document.get('duration') or 0 for document in documents],
+        [document.get('distance') for document in documents],
+        streaks,
+    ).tolist()
+
+
+def _recent_days(user_id, first_day, last_day, rules):
+    """``(user_id, day number)`` for the stored activities a streak ending in the range can reach"""
+    if not rules.streak_bonus:
+        return []
+    longest = rules.streak_bonus[-1][0]
+    since = datetime.fromordinal(first_day) - timedelta(days=longest - 1)
+    until = datetime.fromordinal(last_day) + timedelta(days=1)
+    cursor = get_collection(Activity).find(
+        {'user_id': user_id, 'date': {'$gte': since, '$lt': until}},
+        {'_id': False, 'date': True},
+    )
+    return [(user_id, day) for day in {day_number(activity['date']) for activity in cursor}]
+
+
+def score_new_activities(user_id, activities, rules=None):
+    """Points for new activities of one user, as validated serializer data"""
+    rules = rules or get_rules()
+    documents = [{**activity, 'user_id': user_id} for activity in activities]
+    history = ()
+    if rules.streak_bonus and documents:
+        days = [day_number(document['date']) for document in documents]
+        history = _recent_days(user_id, min(days), max(days), rules)
+    return score_documents(documents, rules, history)
+
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+SCORED_FIELDS = ('user_id', 'activity_type', 'duration', 'distance', 'points_earned', 'date')
+
+
+def _changes(activities, rules, rescorable=None):
+    """
+    ``(activity id, old snapshot, new snapshot)`` for the activities whose
+    points the rules change. ``rescorable``, if given, picks the activities
+    that may change; the others only count towards streaks.
+    """
+    points = score_documents(activities, rules)
+    changes = []
+    for activity, new_points in zip(activities, points):
+        if rescorable is not None and not rescorable(activity):
+            continue
+        if new_points != activity.get('points_earned'):
+            previous = leaderboard.document_snapshot(activity)
+            changes.append((activity['_id'], previous, {**previous, 'points_earned': new_points}))
+    return changes
+
+
+def _write_changes(changes, batch=True):
+    """
+    Write re-scored points back and pass the differences on. With ``batch``
+    leaderboard ranks are left alone and the periods left to re-rank are
+    returned; otherwise ranks shift as the entries change.
+    """
+    bulk_write(get_collection(Activity), (
+        UpdateOne({'_id': activity_id}, {'$set': {'points_earned': current['points_earned']}})
+        for activity_id, _, current in changes
+    ))
+    # Only points moved, so each change is the old snapshot out and the new one in
+    signed = [change for _, previous, current in changes for change in ((previous, -1), (current, 1))]
+    user_deltas = leaderboard.user_deltas(signed)
+    write_increments({user_id: user_delta['total_points'] for user_id, user_delta in user_deltas.items()})
+    periods = []
+    if batch:
+        periods = leaderboard.apply_batch_changes(signed)
+    else:
+        leaderboard.apply_changes(signed)
+    teams.apply_activity_changes(signed)
+    rollups.apply_activity_changes(signed)
+    timeseries.invalidate(user_deltas)
+    return periods
+
+
+def _rescore_chunk(user_ids, rules, dry_run):
+    """
+    Re-score every activity of these users. Returns the number of
+    activities, how many changed, the points difference and the leaderboard
+    periods left to re-rank.
+    """
+    activities = list(get_collection(Activity).find(
+        {'user_id': {'$in': user_ids}}, {name: True for name in SCORED_FIELDS},
+    ))
+    if not activities:
+        return 0, 0, 0, []
+    changes = _changes(activities, rules)
+    delta = sum(current['points_earned'] - previous['points_earned'] for _, previous, current in changes)
+    if dry_run or not changes:
+        return len(activities), len(changes), delta, []
+    return len(activities), len(changes), delta, _write_changes(changes)
+
+
+def _spans(days, reach):
+    """Merged ``[first, last]`` day ranges covering ``reach`` days from each of ``days``"""
+    spans = []
+    for day in sorted(set(days)):
+        if spans and day <= spans[-1][1] + 1:
+            spans[-1][1] = max(spans[-1][1], day + reach - 1)
+        else:
+            spans.append([day, day + reach - 1])
+    return spans
+
+
+def rescore_around(user_id, days, rules=None):
+    """
+    Re-score the activities of one user whose points can depend on the
+    activities on ``days``, after one was added, edited or deleted there.
+
+    Streaks carry a change on a day forward until the longest streak tier,
+    so the activities on those days and the days after them up to that tier
+    are re-scored, with the days before them read only to count streaks.
+    Without streak tiers just the activities on ``days`` are re-scored.
+    Changes go out like ``rescore``'s, with ranks shifted in place. Returns
+    the number of activities that changed.
+    """
+    rules = rules or get_rules()
+    if user_id is None or not days:
+        return 0
+    reach = rules.streak_bonus[-1][0] if rules.streak_bonus else 1
+    spans = _spans(days, reach)
+    activities = list(get_collection(Activity).find(
+        {'user_id': user_id, '$or': [
+            {'date': {
+                '$gte': datetime.fromordinal(first - reach + 1),
+                '$lt': datetime.fromordinal(last + 1),
+            }}
+            for first, last in spans
+        ]},
+        {name: True for name in SCORED_FIELDS},
+    ))
+    changes = _changes(activities, rules, rescorable=lambda activity: any(
+        first <= day_number(activity['date']) <= last for first, last in spans
+    ))
+    if changes:
+        _write_changes(changes, batch=False)
+    return len(changes)
+
+
+def rescore(version=None, user_ids=None, chunk_size=RESCORE_CHUNK_SIZE, dry_run=False, progress=None):
+    """
+    Re-score stored activities with a rule version, ``chunk_size`` users at
+    a time, and pass the point differences on to everything derived from
+    them.
+
+    Each chunk reads its users' whole histories, so streaks are complete.
+    Leaderboard ranks are recomputed once at the end. With ``dry_run``
+    nothing is written. ``progress``, if given, is called with ``(users
+    done, total users)`` after each chunk. Returns a ``RescoreReport``.
+
+    Activities written for these users while it runs may be scored twice
+    or missed; run it when writes are quiet. An interrupted run can be
+    started again: activities already re-scored have nothing left to change.
+    """
+    rules = get_rules(version)
+    if user_ids is None:
+        users = User.objects.order_by('id').values_list('id', flat=True)
+        total = users.count()
+        user_ids = users.iterator()
+    else:
+        user_ids = list(user_ids)
+        total = len(user_ids)
+
+    done = activities = changed = points_delta = 0
+    periods = set()
+    for chunk in _chunks(user_ids, chunk_size):
+        chunk_activities, chunk_changed, chunk_delta, chunk_periods = _rescore_chunk(chunk, rules, dry_run)
+        done += len(chunk)
+        activities += chunk_activities
+        changed += chunk_changed
+        points_delta += chunk_delta
+        periods.update(chunk_periods)
+        if progress is not None:
+            progress(done, total)
+
+    if periods:
+        leaderboard.rerank(sorted(periods, key=leaderboard.PERIODS.index))
+    return RescoreReport(rules.version, done, activities, changed, points_delta)
@@ -0,0 +1,196 @@
+"""
+Full-text and faceted workout search from an in-memory inverted index.
+
+``WorkoutSearchIndex`` extends the recommendation index, so it holds the
+same feature arrays and follows workout writes and reloads the same way. It
+adds postings: for each word of a workout's title, activity type,
+description, exercises and target muscles, the rows containing it with a
+weight for where it appears. A query sums the postings of its words, keeps
+the rows that have them all, and counts the facets (difficulty, activity
+type and equipment) over those rows with array reductions in the same pass.
+Nothing goes to the database until the page of results is read.
+
+Each facet is counted with every other selected facet applied but not its
+own, so the counts tell how many results picking another value would give.
+
+The module-level ``index`` is the only copy of the catalogue in a process;
+recommendations rank from it too.
+"""
+import json
+import re
+from itertools import chain
+
+import numpy as np
+
+from .recommendations import DIFFICULTIES, FIELDS, WorkoutIndex
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+
+# Weight of a word by the field it appears in; whole numbers, so recency
+# can break ties without reordering different scores
+FIELD_WEIGHTS = {'title': 3, 'activity_type': 2, 'exercises': 2, 'target_muscles': 2, 'description': 1}
+JSON_FIELDS = ('exercises', 'target_muscles')
+
+WORD = re.compile(r'[a-z0-9]+')
+
+
+def tokenize(text):
+    return WORD.findall(text.lower())
+
+
+def _strings(value):
+    """Every string in a JSON value, however nested"""
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _strings(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _strings(item)
+
+
+def document_words(document):
+    """Word -> weight for one workout document"""
+    words = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        value = document.get(field)
+        if field in JSON_FIELDS and isinstance(value, str):
+            # Older documents may hold the JSON fields as encoded strings
+            value = json.loads(value or '[]')
+        for word in set(tokenize(' '.join(_strings(value)))):
+            words[word] = words.get(word, 0) + weight
+    return words
+
+
+def _counts(values, counts):
+    """Facet counts as ``[{'value', 'count'}]``, most common first, zeros left out"""
+    facet = [{'value': value, 'count': int(count)} for value, count in zip(values, counts) if count]
+    facet.sort(key=lambda item: (-item['count'], str(item['value'])))
+    return facet
+
+
+class WorkoutSearchIndex(WorkoutIndex):
+    """The recommendation index plus postings of the workouts' words"""
+
+    fields = FIELDS + ('title', 'description', 'exercises')
+
+    def _allocate(self, capacity):
+        super()._allocate(capacity)
+        self.postings = {}
+        self.row_words = {}
+        # Postings as (rows, weights) arrays, built on first query of the word
+        self._arrays = {}
+
+    def _index_document(self, row, document):
+        previous = self.row_words.pop(row, ())
+        for word in previous:
+            posting = self.postings[word]
+            del posting[row]
+            if not posting:
+                del self.postings[word]
+        words = document_words(document)
+        for word, weight in words.items():
+            self.postings.setdefault(word, {})[row] = weight
+        self.row_words[row] = list(words)
+        if self._arrays:
+            for word in chain(previous, words):
+                self._arrays.pop(word, None)
+
+    def _posting_arrays(self, word):
+        arrays = self._arrays.get(word)
+        if arrays is None:
+            posting = self.postings.get(word, {})
+            arrays = (
+                np.fromiter(posting.keys(), dtype=np.int64, count=len(posting)),
+                np.fromiter(posting.values(), dtype=np.float64, count=len(posting)),
+            )
+            self._arrays[word] = arrays
+        return arrays
+
+    def _facet_masks(self, size, difficulty, activity_type, equipment):
+        masks = {}
+        if difficulty:
+            masks['difficulty'] = (
+                self.difficulty[:size] == DIFFICULTIES.index(difficulty)
+                if difficulty in DIFFICULTIES else np.zeros(size, dtype=bool)
+            )
+        if activity_type:
+            code = self.activity_types.get(activity_type)
+            masks['activity_type'] = (
+                self.activity_type[:size] == code if code is not None else np.zeros(size, dtype=bool)
+            )
+        if equipment:
+            code = self.equipment.get(equipment)
+            masks['equipment'] = (
+                self.equipment_flags[code, :size] if code is not None else np.zeros(size, dtype=bool)
+            )
+        return masks
+
+    def search(self, query='', difficulty=None, activity_type=None, equipment=None,
+               limit=DEFAULT_LIMIT, offset=0):
+        """
+        Return ``(count, [(workout id, score)], facets)`` for a page of matches.
+
+        Every word of ``query`` must appear; an empty query matches every
+        workout, newest first. ``difficulty``, ``activity_type`` and
+        ``equipment`` select one facet value each. A ``limit`` of None
+        returns every match.
+        """
+        self.ensure_loaded()
+        with self._lock:
+            size = self.size
+            scores = np.zeros(size)
+            matched = self.active[:size].copy()
+            words = set(tokenize(query or ''))
+            if words:
+                hits = np.zeros(size, dtype=np.int32)
+                for word in words:
+                    rows, weights = self._posting_arrays(word)
+                    scores[rows] += weights
+                    hits[rows] += 1
+                matched &= hits == len(words)
+
+            masks = self._facet_masks(size, difficulty, activity_type, equipment)
+
+            def selected(excluding=None):
+                mask = matched.copy()
+                for name, facet_mask in masks.items():
+                    if name != excluding:
+                        mask &= facet_mask
+                return mask
+
+            with_equipment = selected('equipment')
+            facets = {
+                'difficulty': _counts(
+                    DIFFICULTIES,
+                    np.bincount(self.difficulty[:size][selected('difficulty')] + 1,
+                                minlength=len(DIFFICULTIES) + 1)[1:],
+                ),
+                'activity_type': _counts(
+                    list(self.activity_types.codes),
+                    np.bincount(self.activity_type[:size][selected('activity_type')],
+                                minlength=len(self.activity_types)),
+                ),
+                'equipment': _counts(
+                    list(self.equipment.codes),
+                    [np.count_nonzero(flags[:size] & with_equipment) for flags in self.equipment_flags],
+                ),
+            }
+
+            rows = np.flatnonzero(selected())
+            count = len(rows)
+            end = count if limit is None else min(offset + limit, count)
+            if offset >= end:
+                return count, [], facets
+            created = self.created[rows]
+            span = created.max() - created.min()
+            # Recency adds less than the smallest difference between two scores
+            keys = scores[rows] + (0.5 * (created - created.min()) / span if span else 0)
+            top = np.argpartition(-keys, end - 1)[:end]
+            top = top[np.argsort(-keys[top], kind='stable')][offset:]
+            return count, [(self.ids[rows[row]], float(scores[rows[row]])) for row in top], facets
+
+
+index = WorkoutSearchIndex()
@@ -1,7 +1,14 @@
 from rest_framework import serializers
+from rest_framework.permissions import SAFE_METHODS
 from django.contrib.auth.models import User
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Manager
+from django.db.models.constants import LOOKUP_SEP
 from bson import ObjectId
+from . import teams
 from .models import UserProfile, Team, Activity, Leaderboard, Workout
+from .points import credit_points
+from .scoring import day_number, get_rules, rescore_around, score_new_activities
 
 
 class ObjectIdField(serializers.Field):
@@ -16,55 +23,306 @@ class ObjectIdField(serializers.Field):
             raise serializers.ValidationError('Invalid ObjectId')
 
 
-class UserSerializer(serializers.ModelSerializer):
+class UserTeamMap:
+    """
+    Per-request cache of each user's team.
+
+    Users are looked up in batches, so serializing a list of users costs two
+    queries in total instead of two per user.
+    """
+
+    def __init__(self):
+        self._teams = {}
+
+    def prime(self, user_ids):
+        """Load the teams of every user not already cached"""
+        missing = {pk for pk in user_ids if pk is not None and pk not in self._teams}
+        if not missing:
+            return
+
+        # Match obj.teams.first(): the team with the lowest primary key
+        memberships = {}
+        rows = Team.members.through.objects.filter(user_id__in=missing).values_list('user_id', 'team_id')
+        for user_id, team_id in rows:
+            if user_id not in memberships or team_id < memberships[user_id]:
+                memberships[user_id] = team_id
+
+        names = {}
+        if memberships:
+            names = dict(Team.objects.filter(_id__in=set(memberships.values())).values_list('_id', 'name'))
+
+        for user_id in missing:
+            team_id = memberships.get(user_id)
+            self._teams[user_id] = (team_id, names[team_id]) if team_id in names else None
+
+    def get(self, user):
+        """Return ``(team_id, team_name)`` for a user, or None"""
+        self.prime([user.pk])
+        return self._teams[user.pk]
+
+
+def get_team_map(context):
+    """Return the team map shared by every serializer in this context"""
+    return context.setdefault('team_map', UserTeamMap())
+
+
+class TeamMapListSerializer(serializers.ListSerializer):
+    """List serializer that loads the teams of all nested users up front"""
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, Manager) else data)
+        get_team_map(self.context).prime(self.child.get_team_user_ids(items))
+        return super().to_representation(items)
+
+
+class NestedUserTeamsMixin:
+    """
+    Declares which user ids a serializer nests, so lists can prime the team map.
+
+    ``team_user_fields`` maps each field that shows a user's team to the
+    attribute holding that user's id. Fields trimmed by ``?fields=`` or not
+    expanded don't prime the map.
+
+    Serializers using it set ``list_serializer_class = TeamMapListSerializer``.
+    """
+    team_user_fields = {}
+
+    def reads_teams(self, name):
+        """Whether the field ``name``, as trimmed, shows team names or ids"""
+        field = self.fields.get(name)
+        nested = getattr(field, 'child', field)
+        if isinstance(nested, NestedUserTeamsMixin):
+            return any(nested.reads_teams(nested_name) for nested_name in nested.team_user_fields)
+        return field is not None and not isinstance(field, serializers.RelatedField)
+
+    def get_team_user_ids(self, instances):
+        attributes = {
+            attribute for name, attribute in self.team_user_fields.items() if self.reads_teams(name)
+        }
+        return [getattr(obj, attribute) for obj in instances for attribute in attributes]
+
+
+def parse_paths(value):
+    """Turn ``'a,b.c,b.d'`` into ``{'a': {}, 'b': {'c': {}, 'd': {}}}``"""
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for part in path.strip().split('.'):
+            if part:
+                node = node.setdefault(part, {})
+    return tree
+
+
+class SparseFieldsMixin:
+    """
+    Trims read responses to the request's ``?fields=`` and ``?expand=``.
+
+    ``fields`` lists the fields to return; a dotted name picks fields of a
+    nested object, e.g. ``fields=_id,user.username``. ``expand`` lists the
+    nested relations to return as objects. Once either parameter is given,
+    relations that aren't expanded come back as primary keys. Without them
+    the output is unchanged.
+
+    Fields in ``expand_only``, such as large relations, are left out unless
+    one of the parameters names them.
+
+    Trimmed fields are dropped before serialization, so nothing computes
+    them, and ``project()`` narrows a queryset to the columns and joins the
+    remaining fields read. Writes always keep every field.
+    """
+    expand_only = ()
+    sparse_selection = None
+
+    def is_nested(self):
+        parent = getattr(self, 'parent', None)
+        if isinstance(parent, serializers.ListSerializer):
+            parent = parent.parent
+        return parent is not None
+
+    def get_sparse_selection(self):
+        """``(selected fields or None for all, expanded relations)``, or None"""
+        if self.is_nested():
+            # Set by the parent while trimming its own fields
+            return self.sparse_selection
+        request = self.context.get('request')
+        if request is None or request.method not in SAFE_METHODS:
+            return None
+        params = request.query_params
+        if 'fields' not in params and 'expand' not in params:
+            return None
+        return parse_paths(params.get('fields', '')) or None, parse_paths(params.get('expand', ''))
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = self.get_sparse_selection()
+        selected, expand = selection or (None, {})
+        for name in self.expand_only:
+            if name not in expand and name not in (selected or ()):
+                fields.pop(name, None)
+        if selection is None:
+            return fields
+
+        for name, field in list(fields.items()):
+            if field.write_only:
+                continue
+            if selected is not None and name not in selected:
+                del fields[name]
+                continue
+            if not isinstance(field, serializers.BaseSerializer):
+                continue
+            subfields = selected.get(name) if selected else None
+            if name in expand or subfields:
+                nested = getattr(field, 'child', field)
+                nested.sparse_selection = (subfields or None, expand.get(name, {}))
+            else:
+                fields[name] = serializers.PrimaryKeyRelatedField(
+                    read_only=True,
+                    many=isinstance(field, serializers.ListSerializer),
+                    source=field.source,
+                )
+        return fields
+
+    def project(self, queryset, extra=()):
+        """
+        Narrow ``queryset`` to what the trimmed fields read.
+
+        Only the columns of the remaining fields (plus ``extra``) are loaded,
+        and only the relations they show are joined or prefetched. The
+        queryset is returned as is when nothing is trimmed or a field reads
+        something other than a model field.
+        """
+        if self.get_sparse_selection() is None:
+            return queryset
+        paths = _read_paths(self, queryset.model)
+        if paths is None:
+            return queryset
+        columns, joins, prefetches = paths
+
+        queryset = queryset.select_related(None)
+        if joins:
+            queryset = queryset.select_related(*joins)
+        lookups = [
+            lookup for lookup in queryset._prefetch_related_lookups
+            if getattr(lookup, 'prefetch_to', lookup).split(LOOKUP_SEP)[0] in prefetches
+        ]
+        queryset = queryset.prefetch_related(None).prefetch_related(*lookups)
+        return queryset.only(*columns, *extra)
+
+
+def _read_paths(serializer, model, prefix=''):
+    """``(columns, joins, prefetches)`` a serializer's fields read, or None if unknown"""
+    columns = {prefix + model._meta.pk.name}
+    joins = set()
+    prefetches = set()
+    for field in serializer.fields.values():
+        if field.write_only or isinstance(field, serializers.SerializerMethodField):
+            continue
+        nested = getattr(field, 'child', field)
+        if isinstance(field, (serializers.ListSerializer, serializers.ManyRelatedField)):
+            prefetches.add(prefix + field.source)
+            continue
+        if isinstance(nested, serializers.BaseSerializer):
+            relation = model._meta.get_field(field.source)
+            paths = _read_paths(nested, relation.related_model, f'{prefix}{field.source}{LOOKUP_SEP}')
+            if paths is None:
+                return None
+            joins.add(prefix + field.source)
+            columns |= paths[0]
+            joins |= paths[1]
+            continue
+
+        if not field.source_attrs:
+            return None
+        # Follow dotted sources like user.username through foreign keys
+        current = model
+        path = prefix
+        for attribute in field.source_attrs[:-1]:
+            try:
+                relation = current._meta.get_field(attribute)
+            except FieldDoesNotExist:
+                return None
+            if not relation.many_to_one and not relation.one_to_one:
+                return None
+            joins.add(path + attribute)
+            path = f'{path}{attribute}{LOOKUP_SEP}'
+            current = relation.related_model
+        try:
+            current._meta.get_field(field.source_attrs[-1])
+        except FieldDoesNotExist:
+            return None
+        columns.add(path + field.source_attrs[-1])
+    return columns, joins, prefetches
+
+
+class UserSerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     team_name = serializers.SerializerMethodField()
     team_id = serializers.SerializerMethodField()
+    team_user_fields = {'team_name': 'pk', 'team_id': 'pk'}
     
     class Meta:
         model = User
         fields = ['id', 'username', 'email', 'first_name', 'last_name', 'team_name', 'team_id', 'date_joined']
         read_only_fields = ['id', 'date_joined']
+        list_serializer_class = TeamMapListSerializer
     
     def get_team_name(self, obj):
-        team = obj.teams.first()
-        return team.name if team else None
+        team = get_team_map(self.context).get(obj)
+        return team[1] if team else None
     
     def get_team_id(self, obj):
-        team = obj.teams.first()
-        return str(team._id) if team else None
+        team = get_team_map(self.context).get(obj)
+        return str(team[0]) if team else None
 
 
-class UserProfileSerializer(serializers.ModelSerializer):
+class UserProfileSerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     _id = ObjectIdField(read_only=True)
     user = UserSerializer(read_only=True)
     username = serializers.CharField(source='user.username', read_only=True)
+    team_user_fields = {'user': 'user_id'}
 
     class Meta:
         model = UserProfile
         fields = ['_id', 'user', 'username', 'bio', 'fitness_level', 'points', 'created_at', 'updated_at']
         read_only_fields = ['_id', 'points', 'created_at', 'updated_at']
+        list_serializer_class = TeamMapListSerializer
+
+    def update(self, instance, validated_data):
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        # Points are credited with $inc; a full save would write back the
+        # value loaded with the instance and lose increments made since
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
 
 
-class TeamSerializer(serializers.ModelSerializer):
+class TeamSerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     _id = ObjectIdField(read_only=True)
     members = UserSerializer(many=True, read_only=True)
     captain = UserSerializer(read_only=True)
-    member_count = serializers.SerializerMethodField()
     member_ids = serializers.ListField(
         child=serializers.IntegerField(),
         write_only=True,
         required=False
     )
     captain_id = serializers.IntegerField(write_only=True, required=False)
+    team_user_fields = {'captain': 'captain_id'}
+    # Teams can have thousands of members; page them at /api/teams/{id}/members/
+    expand_only = ('members',)
 
     class Meta:
         model = Team
         fields = ['_id', 'name', 'description', 'members', 'captain', 'member_count', 'total_points', 
+                  'total_activities', 'total_duration', 'total_distance',
                   'created_at', 'updated_at', 'member_ids', 'captain_id']
-        read_only_fields = ['_id', 'member_count', 'total_points', 'created_at', 'updated_at']
-    
-    def get_member_count(self, obj):
-        return obj.members.count()
+        read_only_fields = ['_id', 'member_count', 'total_points', 'total_activities',
+                            'total_duration', 'total_distance', 'created_at', 'updated_at']
+        list_serializer_class = TeamMapListSerializer
+
+    def get_team_user_ids(self, instances):
+        member_ids = []
+        if self.reads_teams('members'):
+            member_ids = [member.pk for team in instances for member in team.members.all()]
+        return super().get_team_user_ids(instances) + member_ids
 
     def create(self, validated_data):
         member_ids = validated_data.pop('member_ids', [])
@@ -77,72 +335,83 @@ class TeamSerializer(serializers.ModelSerializer):
         
         if captain_id:
             team.captain = User.objects.get(id=captain_id)
-            team.save()
+            team.save(update_fields=['captain', 'updated_at'])
+        
+        if member_ids:
+            # Counted and totalled by the membership signal
+            team.refresh_from_db(fields=teams.MATERIALIZED_FIELDS)
         
         return team
 
+    def update(self, instance, validated_data):
+        # Membership changes go through join, leave and members/bulk
+        validated_data.pop('member_ids', None)
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        teams.save_team(instance)
+        return instance
 
-class ActivitySerializer(serializers.ModelSerializer):
+
+class ActivitySerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     _id = ObjectIdField(read_only=True)
     user = UserSerializer(read_only=True)
     username = serializers.CharField(source='user.username', read_only=True)
+    team_user_fields = {'user': 'user_id'}
 
     class Meta:
         model = Activity
         fields = ['_id', 'user', 'username', 'activity_type', 'duration', 'distance', 
                   'calories', 'points_earned', 'notes', 'date', 'created_at']
         read_only_fields = ['_id', 'user', 'points_earned', 'created_at']
+        list_serializer_class = TeamMapListSerializer
 
     def create(self, validated_data):
-        # Calculate points based on duration and activity type
-        duration = validated_data.get('duration', 0)
-        activity_type = validated_data.get('activity_type', '')
-        
-        # Points calculation logic
-        base_points = duration * 1  # 1 point per minute
-        
-        # Bonus points for different activity types
-        activity_multipliers = {
-            'running': 1.5,
-            'cycling': 1.3,
-            'swimming': 1.6,
-            'strength_training': 1.4,
-            'walking': 1.0,
-            'yoga': 1.2,
-            'other': 1.0,
-        }
-        
-        multiplier = activity_multipliers.get(activity_type, 1.0)
-        points = int(base_points * multiplier)
+        # Score the activity with the current points rules
+        user = validated_data.get('user')
+        points, = score_new_activities(user.pk if user else None, [validated_data])
         validated_data['points_earned'] = points
         
         activity = Activity.objects.create(**validated_data)
         
         # Update user points
-        user = validated_data.get('user')
         if user:
-            profile = UserProfile.objects.get_or_create(user=user)[0]
-            profile.points += points
-            profile.save()
+            credit_points(user.pk, points)
+            # A new day can extend the streaks of the user's later activities
+            if get_rules().streak_bonus:
+                rescore_around(user.pk, [day_number(activity.date)])
         
         return activity
+    
+    def update(self, instance, validated_data):
+        # Re-score the activity and the streaks of both its old and new day
+        days = [day_number(instance.date)]
+        activity = super().update(instance, validated_data)
+        days.append(day_number(activity.date))
+        if rescore_around(activity.user_id, days):
+            activity.refresh_from_db(fields=['points_earned'])
+        return activity
 
 
-class LeaderboardSerializer(serializers.ModelSerializer):
+class LeaderboardSerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     _id = ObjectIdField(read_only=True)
     user = UserSerializer(read_only=True)
+    # Entries on the leaderboard stream are keyed by user_id too
+    user_id = serializers.IntegerField(read_only=True)
     username = serializers.CharField(source='user.username', read_only=True)
+    team_user_fields = {'user': 'user_id'}
 
     class Meta:
         model = Leaderboard
-        fields = ['_id', 'user', 'username', 'total_points', 'total_activities', 
+        fields = ['_id', 'user', 'user_id', 'username', 'total_points', 'total_activities', 
                   'total_duration', 'total_distance', 'rank', 'period', 'updated_at']
         read_only_fields = ['_id', 'rank', 'updated_at']
+        list_serializer_class = TeamMapListSerializer
 
 
-class WorkoutSerializer(serializers.ModelSerializer):
+class WorkoutSerializer(SparseFieldsMixin, NestedUserTeamsMixin, serializers.ModelSerializer):
     _id = ObjectIdField(read_only=True)
     created_by = UserSerializer(read_only=True)
+    team_user_fields = {'created_by': 'created_by_id'}
 
     class Meta:
         model = Workout
@@ -150,3 +419,4 @@ class WorkoutSerializer(serializers.ModelSerializer):
                   'activity_type', 'exercises', 'target_muscles', 'equipment_needed',
                   'created_by', 'created_at', 'updated_at']
         read_only_fields = ['_id', 'created_by', 'created_at', 'updated_at']
+        list_serializer_class = TeamMapListSerializer
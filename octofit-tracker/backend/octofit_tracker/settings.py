@@ -52,6 +52,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Opt-in; inactive unless PROFILING_ENABLED is set
+    'octofit_tracker.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -140,6 +142,84 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Django REST Framework
+# List endpoints page with keyset cursors; see octofit_tracker/pagination.py
+
+REST_FRAMEWORK = {
+    'DEFAULT_PAGINATION_CLASS': 'octofit_tracker.pagination.KeysetPagination',
+}
+
+# Points accrual
+# With write-behind enabled, profile point increments are merged in memory per
+# user and flushed in bulk; see octofit_tracker/points.py
+
+POINTS_WRITE_BEHIND = os.environ.get('POINTS_WRITE_BEHIND') == '1'
+POINTS_FLUSH_INTERVAL = 1.0  # seconds
+POINTS_FLUSH_SIZE = 500  # users pending
+
+# Points scoring
+# Version of the rule table new activities are scored with; see
+# octofit_tracker/scoring.py. After changing it, re-score the history with
+# `manage.py rescore_activities`.
+POINTS_RULES_VERSION = 1
+
+# Caching
+# Leaderboard and workout list responses are cached until the data behind
+# them changes; see octofit_tracker/caching.py. Cache versions live in Mongo,
+# so every process sees invalidations; a shared backend would also share the
+# entries themselves.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'octofit-tracker',
+        'OPTIONS': {
+            # One time series request alone can cache up to 400 buckets
+            'MAX_ENTRIES': 100000,
+        },
+    }
+}
+RESPONSE_CACHE_TIMEOUT = 300  # seconds
+# Closed time series buckets; see octofit_tracker/timeseries.py
+TIMESERIES_CACHE_TIMEOUT = 24 * 60 * 60  # seconds
+
+# Profiling
+# Per-request ORM, Mongo and serialization timings as Server-Timing headers,
+# summarised at /api/profiling/; see octofit_tracker/profiling.py
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED') == '1'
+PROFILING_WINDOW = 1000  # requests kept for the summary
+
+# Async read paths
+# Under ASGI the leaderboard list, my_activities, activity stats and the
+# activity time series run on a bounded thread pool; see
+# octofit_tracker/async_views.py. 0 disables the pool.
+ASYNC_READ_POOL_SIZE = int(os.environ.get('ASYNC_READ_POOL_SIZE', '16'))
+ASYNC_READ_MAX_PENDING = 10000  # waiting requests before answering 503
+
+# Leaderboard streaming
+# Rank deltas pushed over Server-Sent Events at /api/leaderboard/stream/ under
+# ASGI; see octofit_tracker/realtime.py. Changes written by other processes,
+# e.g. rebuilds on a run_jobs worker, are picked up every
+# LEADERBOARD_STREAM_POLL seconds; a shared LEADERBOARD_BROKER delivers them
+# at once instead.
+LEADERBOARD_BROKER = 'octofit_tracker.realtime.LocalBroker'
+LEADERBOARD_STREAM_SIZE = 100  # top entries streamed per period
+LEADERBOARD_STREAM_COALESCE = 0.25  # seconds of changes merged into one delta
+LEADERBOARD_STREAM_POLL = 2.0  # seconds between checks for changes made by other processes
+
+# Background jobs
+# Leaderboard rebuilds and other slow work queue in the jobs collection and
+# run on `manage.py run_jobs` workers; see octofit_tracker/jobs.py.
+JOBS_POLL_INTERVAL = 1.0  # seconds an idle worker waits between checks
+JOBS_HEARTBEAT_INTERVAL = 30  # seconds between a running job's heartbeats
+JOBS_STALE_AFTER = 300  # seconds without a heartbeat before a job is requeued
+
+# Workout recommendations and search
+# Each process ranks and searches workouts from one in-memory index of the
+# catalogue; see octofit_tracker/recommendations.py and search.py. Writes made
+# in the process update it at once, writes made elsewhere show up when it
+# reloads in the background.
+RECOMMENDATION_INDEX_TTL = 300  # seconds between full reloads of the index
+
 # CORS Configuration
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOW_METHODS = [
@@ -160,4 +240,7 @@ CORS_ALLOW_HEADERS = [
     'user-agent',
     'x-csrftoken',
     'x-requested-with',
+    'if-none-match',
+    'if-modified-since',
 ]
+CORS_EXPOSE_HEADERS = ['etag', 'last-modified', 'server-timing']
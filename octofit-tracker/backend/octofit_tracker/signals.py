@@ -0,0 +1,144 @@
+"""
+Model signal handlers that keep derived data in step with activity writes,
+and drop cached responses when the models behind them change.
+"""
+import sys
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from . import caching, leaderboard, realtime, rollups, search, teams, timeseries
+from .models import Activity, Leaderboard, Team, Workout
+
+# Sent with ``instances`` after activities are inserted in bulk, bypassing
+# save() and therefore post_save
+activities_created = Signal()
+
+
+@receiver(pre_save, sender=Activity)
+def capture_previous_activity(sender, instance, raw=False, **kwargs):
+    """Remember the stored version of an activity before it is overwritten"""
+    instance._previous_snapshot = None
+    if raw or instance._state.adding:
+        return
+    previous = Activity.objects.filter(pk=instance.pk).first()
+    if previous is not None:
+        instance._previous_snapshot = leaderboard.snapshot(previous)
+
+
+@receiver(post_save, sender=Activity)
+def activity_saved(sender, instance, raw=False, **kwargs):
+    """Apply the activity's contribution to the leaderboard, team totals and the user's rollup"""
+    if raw:
+        return
+    previous = getattr(instance, '_previous_snapshot', None)
+    current = leaderboard.snapshot(instance)
+    leaderboard.apply_activity_change(previous, current)
+    teams.apply_activity_change(previous, current)
+    rollups.apply_activity_change(previous, current)
+    timeseries.apply_activity_changes([previous, current])
+
+
+@receiver(post_delete, sender=Activity)
+def activity_deleted(sender, instance, **kwargs):
+    """Withdraw a deleted activity's contribution from the leaderboard, team totals and rollup"""
+    previous = leaderboard.snapshot(instance)
+    leaderboard.apply_activity_change(previous, None)
+    teams.apply_activity_change(previous, None)
+    rollups.apply_activity_change(previous, None)
+    timeseries.apply_activity_changes([previous])
+
+
+@receiver(activities_created)
+def activities_bulk_created(sender, instances, **kwargs):
+    """Apply a bulk insert's contribution to the leaderboard, team totals and rollups"""
+    snapshots = [leaderboard.snapshot(instance) for instance in instances]
+    leaderboard.apply_activity_batch(snapshots)
+    teams.apply_activity_batch(snapshots)
+    rollups.apply_activity_batch(snapshots)
+    timeseries.apply_activity_changes(snapshots)
+
+
+@receiver(m2m_changed, sender=Team.members.through)
+def team_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Count joining members and add their totals to their teams; undo both for leaving members"""
+    if action == 'pre_clear':
+        related = instance.teams if reverse else instance.members
+        instance._cleared_pks = set(related.values_list('pk', flat=True))
+        return
+    if action == 'pre_remove':
+        # remove() reports every pk passed to it, members or not
+        if reverse:
+            instance._removed_pks = {
+                team_id for team_id in pk_set if teams.existing_members(team_id, [instance.pk])
+            }
+        else:
+            instance._removed_pks = teams.existing_members(instance.pk, pk_set)
+        return
+    if action == 'post_clear':
+        pk_set = getattr(instance, '_cleared_pks', set())
+    elif action == 'post_remove':
+        pk_set = getattr(instance, '_removed_pks', pk_set)
+    elif action != 'post_add':
+        return
+    sign = 1 if action == 'post_add' else -1
+    if reverse:
+        # user.teams.add(...): one user, several teams
+        for team_id in pk_set:
+            teams.add_members(team_id, [instance.pk], sign)
+    else:
+        teams.add_members(instance.pk, pk_set, sign)
+
+
+@receiver(leaderboard.changed)
+def leaderboard_moved(sender, periods, **kwargs):
+    """Queue rank deltas for anyone streaming these periods"""
+    realtime.get_publisher().mark_dirty(periods)
+
+
+@receiver(post_save, sender=Leaderboard)
+@receiver(post_delete, sender=Leaderboard)
+def leaderboard_changed(sender, **kwargs):
+    caching.invalidate(caching.LEADERBOARD)
+
+
+@receiver(post_save, sender=Workout)
+@receiver(post_delete, sender=Workout)
+def workout_changed(sender, **kwargs):
+    caching.invalidate(caching.WORKOUTS)
+
+
+@receiver(post_save, sender=Workout)
+def workout_saved(sender, instance, raw=False, **kwargs):
+    """Index the workout for recommendations and search"""
+    if not raw:
+        search.index.update(instance)
+
+
+@receiver(post_delete, sender=Workout)
+def workout_deleted(sender, instance, **kwargs):
+    search.index.remove(instance.pk)
+
+
+@receiver(post_save, sender=Team)
+@receiver(post_delete, sender=Team)
+@receiver(m2m_changed, sender=Team.members.through)
+def nested_user_changed(sender, **kwargs):
+    """Teams appear on every nested user"""
+    caching.invalidate(caching.LEADERBOARD, caching.WORKOUTS)
+
+
+def sync_indexes(sender, using='default', verbosity=1, stdout=None, **kwargs):
+    """
+    Create any declared MongoDB indexes missing after a migrate, reporting
+    to the migrate command's output
+    """
+    from .indexes import ensure_indexes
+
+    stdout = stdout or sys.stdout
+    created, failed = ensure_indexes(using)
+    if verbosity >= 2:
+        for name in created:
+            stdout.write(f'  Created index {name}\n')
+    for name, error in failed:
+        stdout.write(f'  Could not create index {name}: {error}\n')
@@ -0,0 +1,269 @@
+"""
+Synthetic data at production scale, for load tests and query plans.
+
+Users are generated in fixed-size chunks of consecutive ids. Every chunk
+draws from its own ``random.Random`` seeded from the run's seed and the
+chunk's position, so a given ``--seed`` produces the same data whether the
+chunks run in one process or across a pool, in any order.
+
+The distributions are skewed the way real usage is: activity counts per
+user are log-normal (most users log a few, a long tail logs hundreds),
+activity dates cluster around the present, durations are log-normal and
+distances follow each sport's typical pace. Team sizes fall off with team
+rank.
+
+Documents are written straight to the collections with unordered
+``insert_many`` batches, bypassing the per-activity signals on purpose.
+Profile points and leaderboard day buckets are summed while each chunk is
+generated; leaderboard entries, team totals and activity rollups are rebuilt
+once at the end.
+"""
+import math
+import random
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from multiprocessing import get_context
+
+import django
+from bson import ObjectId
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.utils import timezone
+
+from . import leaderboard, rollups, teams
+from .models import Activity, Leaderboard, LeaderboardBucket, LeaderboardWindow, Team, UserProfile
+from .mongo import BULK_BATCH_SIZE, get_collection, reserve_ids, to_mongo_datetime
+from .scoring import score_documents
+
+CHUNK_SIZE = 10000
+DEFAULT_PASSWORD = 'test123'
+MEMBERS_PER_TEAM = 50
+TEAM_MEMBERSHIP_RATE = 0.6
+HISTORY_DAYS = 365
+
+ACTIVITY_WEIGHTS = {
+    'running': 30,
+    'walking': 25,
+    'cycling': 15,
+    'strength_training': 12,
+    'yoga': 8,
+    'swimming': 6,
+    'other': 4,
+}
+
+# Kilometres per minute; types without an entry have no distance
+PACES = {
+    'running': 0.16,
+    'walking': 0.08,
+    'cycling': 0.4,
+    'swimming': 0.04,
+}
+
+FITNESS_WEIGHTS = {
+    'beginner': 50,
+    'intermediate': 35,
+    'advanced': 15,
+}
+
+ChunkSpec = namedtuple('ChunkSpec', [
+    'index', 'user_ids', 'membership_ids', 'team_ids', 'activities_per_user',
+    'seed', 'password', 'now', 'batch_size',
+])
+
+
+def _log_normal(rng, mean, sigma):
+    """A log-normal draw with the given mean (not median)"""
+    return rng.lognormvariate(math.log(mean) - sigma * sigma / 2, sigma)
+
+
+class ChunkGenerator:
+    """Builds the documents for one chunk of users"""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = random.Random(f'{spec.seed}:{spec.index}')
+        self.activity_types = list(ACTIVITY_WEIGHTS)
+        self.activity_weights = list(ACTIVITY_WEIGHTS.values())
+        self.fitness_levels = list(FITNESS_WEIGHTS)
+        self.fitness_weights = list(FITNESS_WEIGHTS.values())
+        # Team popularity falls off with rank (Zipf, s=1)
+        self.team_weights = [1 / rank for rank in range(1, len(spec.team_ids) + 1)]
+
+    def user(self, user_id):
+        return {
+            'id': user_id,
+            'password': self.spec.password,
+            'last_login': None,
+            'is_superuser': False,
+            'username': f'synthetic{user_id}',
+            'first_name': '',
+            'last_name': '',
+            'email': f'synthetic{user_id}@example.com',
+            'is_staff': False,
+            'is_active': True,
+            'date_joined': self.spec.now - timedelta(days=self.rng.randint(0, HISTORY_DAYS)),
+        }
+
+    def activities(self, user_id):
+        rng = self.rng
+        count = round(_log_normal(rng, self.spec.activities_per_user, 1.0)) if self.spec.activities_per_user else 0
+        types = rng.choices(self.activity_types, self.activity_weights, k=count)
+        documents = []
+        for activity_type in types:
+            duration = min(240, max(5, round(_log_normal(rng, 40, 0.5))))
+            pace = PACES.get(activity_type)
+            # Recent days are busier: exponential decay over the history
+            days_ago = min(HISTORY_DAYS, rng.expovariate(8 / HISTORY_DAYS))
+            documents.append({
+                'user_id': user_id,
+                'activity_type': activity_type,
+                'duration': duration,
+                'distance': round(duration * pace * rng.uniform(0.7, 1.3), 2) if pace else None,
+                'calories': round(duration * rng.uniform(5, 12)),
+                'notes': None,
+                'date': self.spec.now - timedelta(days=days_ago),
+                'created_at': self.spec.now,
+            })
+        # The documents are the user's whole history, so streaks come out right
+        for document, points in zip(documents, score_documents(documents)):
+            document['points_earned'] = points
+        return documents
+
+    def buckets(self, user_id, activities):
+        """The user's leaderboard day buckets for the retained days"""
+        retention_start = leaderboard.bucket_day(self.spec.now) - timedelta(days=leaderboard.BUCKET_RETENTION_DAYS)
+        buckets = {}
+        for activity in activities:
+            day = leaderboard.bucket_day(activity['date'])
+            if day < retention_start:
+                continue
+            bucket = buckets.setdefault(day, {
+                'user_id': user_id, 'day': day, **dict.fromkeys(leaderboard.STAT_FIELDS, 0),
+            })
+            bucket['total_points'] += activity['points_earned']
+            bucket['total_activities'] += 1
+            bucket['total_duration'] += activity['duration']
+            bucket['total_distance'] += activity['distance'] or 0
+        return list(buckets.values())
+
+    def documents(self):
+        """Return ``(users, profiles, memberships, activities, buckets)`` for the chunk"""
+        rng = self.rng
+        users, profiles, memberships, activities, buckets = [], [], [], [], []
+        membership_ids = iter(self.spec.membership_ids)
+        for user_id in self.spec.user_ids:
+            users.append(self.user(user_id))
+            user_activities = self.activities(user_id)
+            activities.extend(user_activities)
+            buckets.extend(self.buckets(user_id, user_activities))
+            profiles.append({
+                '_id': ObjectId(),
+                'user_id': user_id,
+                'bio': None,
+                'fitness_level': rng.choices(self.fitness_levels, self.fitness_weights)[0],
+                'points': sum(activity['points_earned'] for activity in user_activities),
+                'created_at': self.spec.now,
+                'updated_at': self.spec.now,
+            })
+            if self.spec.team_ids and rng.random() < TEAM_MEMBERSHIP_RATE:
+                memberships.append({
+                    'id': next(membership_ids),
+                    'team_id': rng.choices(self.spec.team_ids, self.team_weights)[0],
+                    'user_id': user_id,
+                })
+        return users, profiles, memberships, activities, buckets
+
+
+def _insert(collection, documents, batch_size):
+    for start in range(0, len(documents), batch_size):
+        collection.insert_many(documents[start:start + batch_size], ordered=False)
+    return len(documents)
+
+
+def populate_chunk(spec):
+    """Generate and insert one chunk; returns ``{collection: documents inserted}``"""
+    users, profiles, memberships, activities, buckets = ChunkGenerator(spec).documents()
+    counts = {}
+    for model, documents in (
+        (User, users),
+        (UserProfile, profiles),
+        (Team.members.through, memberships),
+        (Activity, activities),
+        (LeaderboardBucket, buckets),
+    ):
+        counts[model._meta.db_table] = _insert(get_collection(model), documents, spec.batch_size)
+    return counts
+
+
+def clear():
+    """Empty every collection the generator writes, without per-row signals"""
+    for model in (Activity, UserProfile, Team.members.through, Team, User,
+                  Leaderboard, LeaderboardBucket, LeaderboardWindow):
+        get_collection(model).delete_many({})
+    rollups.get_rollups_collection().delete_many({})
+
+
+def generate(users, activities_per_user, seed=0, workers=1, chunk_size=CHUNK_SIZE,
+             batch_size=BULK_BATCH_SIZE, progress=None):
+    """
+    Insert ``users`` synthetic users with about ``activities_per_user``
+    activities each, then rebuild the derived collections.
+
+    With ``workers > 1`` chunks are inserted from a pool of spawned
+    processes, each with its own Mongo connection. ``progress(counts)`` is
+    called after every chunk. Returns the total documents per collection.
+    """
+    now = to_mongo_datetime(timezone.now())
+    team_count = max(1, users // MEMBERS_PER_TEAM)
+    team_ids = [ObjectId() for _ in range(team_count)]
+    get_collection(Team).insert_many([
+        {
+            '_id': team_id, 'name': f'Synthetic Team {index}', 'description': None,
+            'captain_id': None, 'total_points': 0, 'total_activities': 0,
+            'total_duration': 0, 'total_distance': 0, 'created_at': now, 'updated_at': now,
+        }
+        for index, team_id in enumerate(team_ids, start=1)
+    ])
+
+    user_ids = reserve_ids(User, users)
+    # At most one team per user, so this covers every membership
+    membership_ids = reserve_ids(Team.members.through, users)
+    password = make_password(DEFAULT_PASSWORD)
+    specs = (
+        ChunkSpec(
+            index=index,
+            user_ids=user_ids[start:start + chunk_size],
+            membership_ids=membership_ids[start:start + chunk_size],
+            team_ids=team_ids,
+            activities_per_user=activities_per_user,
+            seed=seed,
+            password=password,
+            now=now,
+            batch_size=batch_size,
+        )
+        for index, start in enumerate(range(0, users, chunk_size))
+    )
+
+    totals = {Team._meta.db_table: team_count}
+
+    def collect(counts):
+        for name, count in counts.items():
+            totals[name] = totals.get(name, 0) + count
+        if progress is not None:
+            progress(counts)
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('spawn'),
+                                 initializer=django.setup) as pool:
+            for counts in pool.map(populate_chunk, specs):
+                collect(counts)
+    else:
+        for spec in specs:
+            collect(populate_chunk(spec))
+
+    for period in leaderboard.PERIODS:
+        leaderboard.rebuild(period)
+    teams.rebuild_totals()
+    rollups.rebuild()
+    return totals
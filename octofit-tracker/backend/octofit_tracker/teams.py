@@ -0,0 +1,236 @@
+"""
+Materialized team totals.
+
+Each Team document carries its member count and the summed points,
+activities, duration and distance of its members' activities. Activity
+writes add their delta to every team the user belongs to with one bulk
+$inc, and a member joining or leaving adjusts the count and adds or
+withdraws that member's lifetime totals, so neither listing teams nor
+reading a team's stats touches the membership table.
+
+Membership changes made through ``join`` and ``leave`` go straight to the
+membership collection: each one is an indexed upsert or delete on
+(team_id, user_id), so checking and changing a membership never loads the
+team's member list, and a roster of thousands is one bulk write. Changes
+made through ``team.members`` reach the same counters via the m2m signal.
+
+``rebuild_totals`` recomputes every team from the membership and
+activities collections, for backfills and repairs.
+"""
+from datetime import timedelta
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from . import caching, leaderboard
+from .models import Team
+from .mongo import IdPool, bulk_write, get_collection, now
+from .repositories import ActivityRepository
+
+TOTAL_FIELDS = ('total_points', 'total_activities', 'total_duration', 'total_distance')
+# Every field kept up to date outside of Team.save(); see save_team
+MATERIALIZED_FIELDS = ('member_count',) + TOTAL_FIELDS
+
+# Largest roster accepted by one bulk membership change
+MAX_ROSTER_SIZE = 10000
+
+DUPLICATE_KEY_ERROR = 11000
+
+# A batch removal claims its rows before deleting them; a claim this old
+# was left by a process that died in between and may be taken over
+LEAVE_CLAIM_TIMEOUT = timedelta(minutes=5)
+
+_membership_ids = IdPool(Team.members.through)
+
+
+def _teams_by_user(user_ids):
+    memberships = get_collection(Team.members.through).find(
+        {'user_id': {'$in': list(user_ids)}},
+        {'_id': False, 'team_id': True, 'user_id': True},
+    )
+    teams = {}
+    for membership in memberships:
+        teams.setdefault(membership['user_id'], []).append(membership['team_id'])
+    return teams
+
+
+def _add_to_teams(user_deltas):
+    team_deltas = {}
+    for user_id, team_ids in _teams_by_user(user_deltas).items():
+        for team_id in team_ids:
+            delta = team_deltas.setdefault(team_id, dict.fromkeys(TOTAL_FIELDS, 0))
+            for field in TOTAL_FIELDS:
+                delta[field] += user_deltas[user_id][field]
+    return bulk_write(get_collection(Team), (
+        UpdateOne({'_id': team_id}, {'$inc': delta})
+        for team_id, delta in team_deltas.items()
+    ))
+
+
+def apply_activity_change(previous, current):
+    """
+    Apply the delta between two activity snapshots to the user's teams.
+
+    Snapshots are the ones taken by ``leaderboard.snapshot``; pass
+    ``previous=None`` for a new activity and ``current=None`` for a deleted
+    one.
+    """
+    apply_activity_changes([(snap, sign) for snap, sign in ((previous, -1), (current, 1)) if snap is not None])
+
+
+def apply_activity_batch(snapshots):
+    """Apply a batch of new activities to their users' teams"""
+    apply_activity_changes([(snap, 1) for snap in snapshots])
+
+
+def apply_activity_changes(changes):
+    """Apply ``(snapshot, sign)`` pairs to the users' teams, one $inc per team"""
+    _add_to_teams(leaderboard.user_deltas(changes))
+
+
+def _members_totals(user_ids):
+    totals = ActivityRepository().totals_by_user({'user_id': {'$in': list(user_ids)}})
+    return {
+        field: sum(user_totals[field] or 0 for user_totals in totals.values())
+        for field in TOTAL_FIELDS
+    }
+
+
+def existing_members(team_id, user_ids):
+    """The subset of ``user_ids`` that are members of the team"""
+    memberships = get_collection(Team.members.through).find(
+        {'team_id': team_id, 'user_id': {'$in': list(user_ids)}},
+        {'_id': False, 'user_id': True},
+    )
+    return {membership['user_id'] for membership in memberships}
+
+
+def add_members(team_id, user_ids, sign=1):
+    """
+    Count new members of a team and add their lifetime totals, or withdraw
+    both with ``sign=-1``.
+    """
+    if not user_ids:
+        return
+    increments = {field: sign * value for field, value in _members_totals(user_ids).items()}
+    increments['member_count'] = sign * len(user_ids)
+    get_collection(Team).update_one({'_id': team_id}, {'$inc': increments, '$set': {'updated_at': now()}})
+
+
+def _memberships_changed(team_id, user_ids, sign):
+    if user_ids:
+        add_members(team_id, user_ids, sign)
+        # The m2m signal isn't sent for native writes
+        caching.invalidate(caching.LEADERBOARD, caching.WORKOUTS)
+
+
+def join(team_id, user_ids):
+    """
+    Add users to a team, skipping existing members; returns the ids added.
+
+    Every membership is an upsert on (team_id, user_id), sent together in
+    one unordered bulk write. The unique index on the pair settles
+    concurrent joins of the same user.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    if not user_ids:
+        return []
+    # Choose each new row's _id up front to tell afterwards which were inserted
+    document_ids = {ObjectId(): user_id for user_id in user_ids}
+    membership_ids = _membership_ids.take(len(user_ids))
+    operations = [
+        UpdateOne(
+            {'team_id': team_id, 'user_id': user_id},
+            {'$setOnInsert': {'_id': document_id, 'id': membership_id}},
+            upsert=True,
+        )
+        for (document_id, user_id), membership_id in zip(document_ids.items(), membership_ids)
+    ]
+    try:
+        upserted = get_collection(Team.members.through).bulk_write(operations, ordered=False).upserted_ids.values()
+    except BulkWriteError as exc:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in exc.details['writeErrors']):
+            raise
+        # Another request added some of the same users first
+        upserted = [row['_id'] for row in exc.details['upserted']]
+    added = [document_ids[document_id] for document_id in upserted]
+    _memberships_changed(team_id, added, 1)
+    return added
+
+
+def leave(team_id, user_ids):
+    """
+    Remove users from a team, skipping non-members; returns the ids removed.
+
+    A single user is one find-and-delete. A batch is first marked with a
+    token, so a concurrent removal can't withdraw the same member's totals
+    twice, then read back and deleted. Claims older than
+    ``LEAVE_CLAIM_TIMEOUT`` count as unclaimed, so rows left claimed by a
+    crash are removed by the next batch that includes them.
+    """
+    user_ids = list(dict.fromkeys(user_ids))
+    memberships = get_collection(Team.members.through)
+    if len(user_ids) == 1:
+        membership = memberships.find_one_and_delete(
+            {'team_id': team_id, 'user_id': user_ids[0]}, {'user_id': True}
+        )
+        removed = [membership['user_id']] if membership else []
+    elif user_ids:
+        token = ObjectId()
+        timestamp = now()
+        memberships.update_many(
+            {
+                'team_id': team_id,
+                'user_id': {'$in': user_ids},
+                '$or': [
+                    {'leaving': {'$exists': False}},
+                    {'leaving_at': {'$lt': timestamp - LEAVE_CLAIM_TIMEOUT}},
+                ],
+            },
+            {'$set': {'leaving': token, 'leaving_at': timestamp}},
+        )
+        claimed = {'team_id': team_id, 'leaving': token}
+        removed = [membership['user_id'] for membership in memberships.find(claimed, {'user_id': True})]
+        memberships.delete_many(claimed)
+    else:
+        removed = []
+    _memberships_changed(team_id, removed, -1)
+    return removed
+
+
+def save_team(team):
+    """
+    Save a changed team's own fields. The materialized fields are left out:
+    the values loaded with the team would overwrite increments made since.
+    """
+    team.save(update_fields=[
+        field.name for field in Team._meta.concrete_fields
+        if not field.primary_key and field.name not in MATERIALIZED_FIELDS
+    ])
+
+
+def team_stats(team):
+    """Stats for a team, read from its materialized totals"""
+    return {field: getattr(team, field) for field in TOTAL_FIELDS}
+
+
+def rebuild_totals():
+    """Recompute every team's member count and totals"""
+    members = {}
+    for membership in get_collection(Team.members.through).find({}, {'_id': False}):
+        members.setdefault(membership['team_id'], []).append(membership['user_id'])
+    totals = ActivityRepository().totals_by_user()
+
+    def operations():
+        empty = dict.fromkeys(TOTAL_FIELDS, 0)
+        for team in get_collection(Team).find({}, {'_id': True}):
+            team_id = team['_id']
+            team_totals = dict(empty)
+            for user_id in members.get(team_id, ()):
+                for field in TOTAL_FIELDS:
+                    team_totals[field] += totals.get(user_id, empty)[field] or 0
+            team_totals['member_count'] = len(members.get(team_id, ()))
+            yield UpdateOne({'_id': team_id}, {'$set': team_totals})
+
+    return bulk_write(get_collection(Team), operations())
@@ -1,9 +1,33 @@
-from django.test import TestCase
+from unittest import mock
+from bson import ObjectId
+from django.contrib import admin
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import connection
 from django.contrib.auth.models import User
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
-from datetime import datetime
+from datetime import datetime, timedelta
+import asyncio
+import csv
+import json
+import os
+import tempfile
+import time
+from io import BytesIO, StringIO
+from . import (
+    caching, export, jobs, leaderboard, profiling, realtime, recommendations, rollups, scoring, search,
+    teams, timeseries
+)
+from .indexes import DECLARED_INDEXES, ensure_indexes
+from .mongo import get_collection
+from .points import PointsBuffer, write_increments
 from .models import UserProfile, Team, Activity, Leaderboard, Workout
+from .admin import TeamAdmin
+from .serializers import TeamSerializer, UserProfileSerializer
 
 
 class UserProfileModelTest(TestCase):
@@ -101,6 +125,17 @@ class UserProfileAPITest(APITestCase):
         """Test getting current user's profile"""
         response = self.client.get('/api/profiles/my_profile/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_update_keeps_points_credited_meanwhile(self):
+        """Test that editing a profile doesn't write back the points it was loaded with"""
+        profile = UserProfile.objects.create(user=self.user, points=10)
+        serializer = UserProfileSerializer(profile, data={'bio': 'Trail runner'}, partial=True)
+        write_increments({self.user.pk: 5})
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        
+        profile.refresh_from_db()
+        self.assertEqual((profile.bio, profile.points), ('Trail runner', 15))
 
 
 class TeamAPITest(APITestCase):
@@ -132,13 +167,227 @@ class TeamAPITest(APITestCase):
         
         response = self.client.get('/api/teams/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(response.data), 2)
+        self.assertEqual(len(response.data['results']), 2)
+    
+    def test_team_stats(self):
+        """Test totals across a team's members"""
+        team = Team.objects.create(name='Team 1')
+        team.members.add(self.user)
+        Activity.objects.create(
+            user=self.user,
+            activity_type='cycling',
+            duration=40,
+            points_earned=52,
+            date=datetime.now()
+        )
+        
+        response = self.client.get(f'/api/teams/{team._id}/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_activities'], 1)
+        self.assertEqual(response.data['total_points'], 52)
+        self.assertEqual(response.data['total_duration'], 40)
+        self.assertEqual(response.data['total_distance'], 0)
+    
+    def test_team_totals_follow_activity_writes(self):
+        """Test that updating and deleting activities adjusts team totals"""
+        team = Team.objects.create(name='Team 1')
+        team.members.add(self.user)
+        activity = Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=30,
+            distance=5.0,
+            points_earned=45,
+            date=datetime.now()
+        )
+        activity.points_earned = 60
+        activity.save()
+        team.refresh_from_db()
+        self.assertEqual(team.total_points, 60)
+        self.assertEqual(team.total_activities, 1)
+        self.assertEqual(team.total_distance, 5.0)
+        
+        activity.delete()
+        team.refresh_from_db()
+        self.assertEqual(team.total_points, 0)
+        self.assertEqual(team.total_activities, 0)
+    
+    def test_join_and_leave_move_member_totals(self):
+        """Test that members bring their totals when joining and take them when leaving"""
+        team = Team.objects.create(name='Team 1')
+        Activity.objects.create(
+            user=self.user,
+            activity_type='cycling',
+            duration=40,
+            points_earned=52,
+            date=datetime.now()
+        )
+        
+        response = self.client.post(f'/api/teams/{team._id}/join/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_points'], 52)
+        self.assertEqual(response.data['total_activities'], 1)
+        
+        response = self.client.post(f'/api/teams/{team._id}/leave/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        team.refresh_from_db()
+        self.assertEqual(team.total_points, 0)
+        self.assertEqual(team.total_duration, 0)
+    
+    def test_member_count_follows_membership(self):
+        """Test that joining, leaving and removing keep member_count current"""
+        other = User.objects.create_user(username='other', password='pass123')
+        team = Team.objects.create(name='Team 1')
+        
+        response = self.client.post(f'/api/teams/{team._id}/join/')
+        self.assertEqual(response.data['member_count'], 1)
+        team.members.add(other)
+        team.members.remove(User.objects.create_user(username='outsider', password='pass123'))
+        team.refresh_from_db()
+        self.assertEqual(team.member_count, 2)
+        
+        self.client.post(f'/api/teams/{team._id}/leave/')
+        team.refresh_from_db()
+        self.assertEqual(team.member_count, 1)
+        other.teams.clear()
+        team.refresh_from_db()
+        self.assertEqual(team.member_count, 0)
+    
+    def test_join_twice_and_leave_twice(self):
+        """Test that joining or leaving twice is rejected without changing the count"""
+        team = Team.objects.create(name='Team 1')
+        self.assertEqual(self.client.post(f'/api/teams/{team._id}/join/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.post(f'/api/teams/{team._id}/join/').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(team.members.all()), [self.user])
+        
+        self.assertEqual(self.client.post(f'/api/teams/{team._id}/leave/').status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.post(f'/api/teams/{team._id}/leave/').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(list(team.members.all()), [])
+        team.refresh_from_db()
+        self.assertEqual(team.member_count, 0)
+    
+    def test_bulk_members(self):
+        """Test adding and removing a roster in one request"""
+        team = Team.objects.create(name='Team 1', captain=self.user)
+        roster = [User.objects.create_user(username=f'member{index}', password='pass123') for index in range(5)]
+        Activity.objects.create(
+            user=roster[0],
+            activity_type='running',
+            duration=30,
+            points_earned=40,
+            date=datetime.now()
+        )
+        team.members.add(roster[0])
+        
+        url = f'/api/teams/{team._id}/members/bulk/'
+        response = self.client.post(url, {'add': [user.pk for user in roster] + [99999]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {'added': 4, 'removed': 0, 'unknown': [99999], 'member_count': 5})
+        
+        response = self.client.post(url, {'remove': [roster[0].pk, roster[1].pk, self.user.pk]}, format='json')
+        self.assertEqual(response.data['removed'], 2)
+        self.assertEqual(response.data['member_count'], 3)
+        team.refresh_from_db()
+        self.assertEqual(team.total_points, 0)
+        self.assertEqual(set(team.members.values_list('id', flat=True)), {user.pk for user in roster[2:]})
+        
+        response = self.client.post(url, {'add': [True]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_bulk_leave_takes_over_stale_claims(self):
+        """Test that rows left claimed by a crashed removal are removed by the next one"""
+        team = Team.objects.create(name='Team 1')
+        roster = [User.objects.create_user(username=f'member{index}', password='pass123') for index in range(3)]
+        teams.join(team.pk, [user.pk for user in roster])
+        memberships = get_collection(Team.members.through)
+        memberships.update_one(
+            {'team_id': team.pk, 'user_id': roster[0].pk},
+            {'$set': {'leaving': ObjectId(), 'leaving_at': datetime.utcnow() - timedelta(hours=1)}},
+        )
+        memberships.update_one(
+            {'team_id': team.pk, 'user_id': roster[1].pk},
+            {'$set': {'leaving': ObjectId(), 'leaving_at': datetime.utcnow()}},
+        )
+        
+        removed = teams.leave(team.pk, [user.pk for user in roster])
+        self.assertEqual(sorted(removed), [roster[0].pk, roster[2].pk])
+        team.refresh_from_db()
+        self.assertEqual(team.member_count, 1)
+    
+    def test_bulk_members_requires_captain(self):
+        """Test that only the captain or an admin can change the roster"""
+        team = Team.objects.create(name='Team 1')
+        response = self.client.post(f'/api/teams/{team._id}/members/bulk/', {'add': [self.user.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+    
+    def test_list_does_not_embed_members(self):
+        """Test that team lists leave members out unless asked for"""
+        team = Team.objects.create(name='Team 1')
+        team.members.add(self.user)
+        
+        response = self.client.get('/api/teams/')
+        self.assertNotIn('members', response.data['results'][0])
+        self.assertEqual(response.data['results'][0]['member_count'], 1)
+        
+        response = self.client.get('/api/teams/?expand=members')
+        self.assertEqual(response.data['results'][0]['members'][0]['username'], 'testuser')
+    
+    def test_members_endpoint_pages_members(self):
+        """Test paging through a team's members"""
+        team = Team.objects.create(name='Team 1')
+        members = [User.objects.create_user(username=f'member{index}', password='pass123') for index in range(3)]
+        team.members.add(*members)
+        
+        response = self.client.get(f'/api/teams/{team._id}/members/?page_size=2')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([user['username'] for user in response.data['results']], ['member0', 'member1'])
+        
+        response = self.client.get(response.data['next'])
+        self.assertEqual([user['username'] for user in response.data['results']], ['member2'])
+        self.assertIsNone(response.data['next'])
+    
+    def test_rebuild_team_totals(self):
+        """Test that a rebuild repairs drifted totals"""
+        team = Team.objects.create(name='Team 1')
+        team.members.add(self.user)
+        Activity.objects.create(
+            user=self.user,
+            activity_type='cycling',
+            duration=40,
+            points_earned=52,
+            date=datetime.now()
+        )
+        get_collection(Team).update_one({'_id': team._id}, {'$set': {'total_points': 999, 'member_count': 7}})
+        
+        teams.rebuild_totals()
+        team.refresh_from_db()
+        self.assertEqual(team.total_points, 52)
+        self.assertEqual(team.member_count, 1)
+        self.assertEqual(team.total_activities, 1)
+    
+    def test_team_edits_keep_concurrent_totals(self):
+        """Test that API and admin edits don't write back stale counts and totals"""
+        team = Team.objects.create(name='Team 1', description='Old')
+        serializer = TeamSerializer(team, data={'description': 'New', 'member_ids': [self.user.pk]}, partial=True)
+        get_collection(Team).update_one({'_id': team._id}, {'$inc': {'total_points': 40, 'member_count': 1}})
+        self.assertTrue(serializer.is_valid())
+        serializer.save()
+        
+        team.name = 'Team One'
+        get_collection(Team).update_one({'_id': team._id}, {'$inc': {'total_points': 2}})
+        TeamAdmin(Team, admin.site).save_model(None, team, None, True)
+        
+        team.refresh_from_db()
+        self.assertEqual((team.name, team.description), ('Team One', 'New'))
+        self.assertEqual((team.total_points, team.member_count), (42, 1))
 
 
 class ActivityAPITest(APITestCase):
     """Test cases for Activity API endpoints"""
     
     def setUp(self):
+        cache.clear()
+        rollups.get_rollups_collection().delete_many({})
         self.client = APIClient()
         self.user = User.objects.create_user(
             username='testuser',
@@ -163,6 +412,23 @@ class ActivityAPITest(APITestCase):
         # Check that points were calculated and added
         activity = Activity.objects.first()
         self.assertGreater(activity.points_earned, 0)
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.points, activity.points_earned)
+    
+    def test_create_activity_creates_missing_profile(self):
+        """Test that points are credited to a new profile"""
+        UserProfile.objects.filter(user=self.user).delete()
+        data = {
+            'activity_type': 'walking',
+            'duration': 20,
+            'date': datetime.now().isoformat()
+        }
+        response = self.client.post('/api/activities/', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        
+        profile = UserProfile.objects.get(user=self.user)
+        self.assertEqual(profile.points, 20)
+        self.assertEqual(profile.fitness_level, 'beginner')
     
     def test_list_my_activities(self):
         """Test listing current user's activities"""
@@ -175,12 +441,247 @@ class ActivityAPITest(APITestCase):
         
         response = self.client.get('/api/activities/my_activities/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_list_activities_by_cursor(self):
+        """Test walking the activity list one page at a time"""
+        now = datetime.now()
+        for days in [3, 1, 4, 1, 5]:
+            Activity.objects.create(
+                user=self.user,
+                activity_type='running',
+                duration=30,
+                date=now - timedelta(days=days)
+            )
+        
+        ids = []
+        dates = []
+        url = '/api/activities/?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(response.data['results']), 2)
+            ids.extend(item['_id'] for item in response.data['results'])
+            dates.extend(item['date'] for item in response.data['results'])
+            url = response.data['next']
+        
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(dates, sorted(dates, reverse=True))
+    
+    def test_stats(self):
+        """Test the current user's activity totals"""
+        response = self.client.get('/api/activities/stats/')
+        self.assertEqual(response.data['total_activities'], 0)
+        self.assertIsNone(response.data['total_points'])
+        
+        for distance in [5.0, None]:
+            Activity.objects.create(
+                user=self.user,
+                activity_type='running',
+                duration=30,
+                distance=distance,
+                points_earned=45,
+                date=datetime.now()
+            )
+        
+        response = self.client.get('/api/activities/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data, {
+            'total_activities': 2,
+            'total_points': 90,
+            'total_duration': 60,
+            'total_distance': 5.0,
+        })
+    
+    def test_stats_breakdowns(self):
+        """Test the activity totals by type and by month"""
+        for activity_type, day, duration in [
+            ('running', datetime(2026, 9, 30, 23), 30),
+            ('running', datetime(2026, 10, 1, 7), 20),
+            ('yoga', datetime(2026, 10, 2, 7), 40),
+        ]:
+            Activity.objects.create(
+                user=self.user,
+                activity_type=activity_type,
+                duration=duration,
+                points_earned=duration,
+                date=day
+            )
+        
+        response = self.client.get('/api/activities/stats/?breakdown=type,month')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['total_duration'], 90)
+        self.assertEqual(response.data['by_type'], {
+            'running': {'total_activities': 2, 'total_points': 50, 'total_duration': 50, 'total_distance': None},
+            'yoga': {'total_activities': 1, 'total_points': 40, 'total_duration': 40, 'total_distance': None},
+        })
+        self.assertEqual(list(response.data['by_month']), ['2026-09', '2026-10'])
+        self.assertEqual(response.data['by_month']['2026-10']['total_activities'], 2)
+        
+        response = self.client.get('/api/activities/stats/?breakdown=week')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_stats_follow_edits_and_deletes(self):
+        """Test that editing or deleting an activity moves the rollup totals"""
+        activity = Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=30,
+            distance=5.0,
+            points_earned=45,
+            date=datetime(2026, 9, 15)
+        )
+        activity.activity_type = 'cycling'
+        activity.duration = 50
+        activity.date = datetime(2026, 10, 15)
+        activity.save()
+        
+        response = self.client.get('/api/activities/stats/?breakdown=type,month')
+        self.assertEqual(response.data['total_activities'], 1)
+        self.assertEqual(response.data['total_duration'], 50)
+        self.assertEqual(list(response.data['by_type']), ['cycling'])
+        self.assertEqual(list(response.data['by_month']), ['2026-10'])
+        
+        activity.delete()
+        response = self.client.get('/api/activities/stats/?breakdown=type')
+        self.assertEqual(response.data['total_activities'], 0)
+        self.assertIsNone(response.data['total_distance'])
+        self.assertEqual(response.data['by_type'], {})
+    
+    def test_timeseries(self):
+        """Test weekly totals as columns, with empty weeks filled in"""
+        for activity_type, day, duration, distance in [
+            ('running', datetime(2024, 9, 2, 7), 30, 5.0),
+            ('running', datetime(2024, 9, 8, 22), 20, None),
+            ('yoga', datetime(2024, 9, 18, 7), 40, None),
+        ]:
+            Activity.objects.create(
+                user=self.user,
+                activity_type=activity_type,
+                duration=duration,
+                distance=distance,
+                points_earned=duration,
+                date=day
+            )
+        
+        url = '/api/activities/timeseries/?interval=week&since=2024-09-04&until=2024-09-23'
+        response = self.client.get(url + '&metric=duration')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['buckets'], ['2024-09-02', '2024-09-09', '2024-09-16'])
+        self.assertEqual(response.data['values'], [50, 0, 40])
+        self.assertEqual(response.data['activities'], [2, 0, 1])
+        
+        response = self.client.get(url + '&metric=distance&type=running')
+        self.assertEqual(response.data['values'], [5.0, 0, 0])
+        
+        response = self.client.get('/api/activities/timeseries/?interval=month&since=2024-08-15&until=2024-10-01')
+        self.assertEqual(response.data['buckets'], ['2024-08-01', '2024-09-01'])
+        self.assertEqual(response.data['values'], [0, 90])
+    
+    def test_timeseries_default_range(self):
+        """Test that the default series ends with today's bucket"""
+        Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=30,
+            points_earned=45,
+            date=datetime.now()
+        )
+        response = self.client.get('/api/activities/timeseries/')
+        self.assertEqual(response.data['interval'], 'day')
+        self.assertEqual(len(response.data['buckets']), timeseries.DEFAULT_BUCKETS['day'])
+        self.assertEqual(response.data['buckets'][-1], timeseries.today().isoformat())
+        self.assertEqual(response.data['values'][-1], 45)
+        self.assertEqual(sum(response.data['values']), 45)
+    
+    def test_timeseries_caches_closed_buckets(self):
+        """Test that closed buckets are cached until a backdated write"""
+        url = '/api/activities/timeseries/?interval=day&since=2024-09-01&until=2024-09-03'
+        self.assertEqual(self.client.get(url).data['values'], [0, 0])
+        
+        # Written behind the signals' back, so the cached buckets stay
+        get_collection(Activity).insert_one({
+            'user_id': self.user.pk, 'activity_type': 'running', 'duration': 10,
+            'points_earned': 10, 'distance': None, 'date': datetime(2024, 9, 1, 12),
+        })
+        self.assertEqual(self.client.get(url).data['values'], [0, 0])
+        
+        # A version bumped in Mongo, as any other process would bump it
+        get_collection(caching.VERSIONS_COLLECTION).update_one(
+            {'_id': f'timeseries:{self.user.pk}'}, {'$inc': {'version': 1}}, upsert=True
+        )
+        self.assertEqual(self.client.get(url).data['values'], [10, 0])
+        
+        Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=20,
+            points_earned=20,
+            date=datetime(2024, 9, 2, 12)
+        )
+        self.assertEqual(self.client.get(url).data['values'], [10, 20])
+    
+    def test_timeseries_invalid_params(self):
+        """Test that unknown intervals, metrics and bad ranges are rejected"""
+        for query in [
+            'interval=year',
+            'metric=calories',
+            'since=yesterday',
+            'since=2024-09-10&until=2024-09-01',
+            'interval=day&since=2000-01-01&until=2024-01-01',
+        ]:
+            response = self.client.get(f'/api/activities/timeseries/?{query}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST, query)
+    
+    def test_bulk_create_activities(self):
+        """Test ingesting a JSON batch with one invalid item"""
+        date = datetime.now().isoformat()
+        data = [
+            {'activity_type': 'running', 'duration': 30, 'date': date},
+            {'activity_type': 'walking', 'duration': 20, 'distance': 2.5, 'date': date},
+            {'activity_type': 'flying', 'duration': 10, 'date': date},
+        ]
+        response = self.client.post('/api/activities/bulk/', data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_207_MULTI_STATUS)
+        self.assertEqual(response.data['created'], 2)
+        self.assertEqual(response.data['errors'][0]['index'], 2)
+        self.assertIn('activity_type', response.data['errors'][0]['errors'])
+        
+        self.assertEqual(Activity.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 65)
+        entry = Leaderboard.objects.get(user=self.user, period='all_time')
+        self.assertEqual(entry.total_points, 65)
+        self.assertEqual(entry.total_activities, 2)
+        
+        response = self.client.get('/api/activities/stats/?breakdown=type')
+        self.assertEqual(response.data['total_points'], 65)
+        self.assertEqual(response.data['by_type']['walking']['total_distance'], 2.5)
+    
+    def test_bulk_create_activities_from_ndjson(self):
+        """Test ingesting a newline-delimited JSON batch"""
+        date = datetime.now().isoformat()
+        body = '\n'.join(
+            json.dumps({'activity_type': 'yoga', 'duration': 10, 'date': date})
+            for _ in range(3)
+        )
+        response = self.client.post(
+            '/api/activities/bulk/', body, content_type='application/x-ndjson'
+        )
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['created'], 3)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 36)
+    
+    def test_invalid_cursor(self):
+        """Test that a malformed cursor is rejected"""
+        response = self.client.get('/api/activities/?cursor=not-a-cursor')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
 class WorkoutAPITest(APITestCase):
     """Test cases for Workout API endpoints"""
     
     def setUp(self):
+        search.index.clear()
         self.client = APIClient()
         self.user = User.objects.create_user(
             username='testuser',
@@ -219,4 +720,1216 @@ class WorkoutAPITest(APITestCase):
         
         response = self.client.get('/api/workouts/recommended/')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertGreater(len(response.data), 0)
+        self.assertGreater(len(response.data['results']), 0)
+    
+    def create_workout(self, title, **fields):
+        values = {'description': 'Workout', 'difficulty': 'beginner', 'duration': 30,
+                  'activity_type': 'running', 'created_by': self.user}
+        values.update(fields)
+        return Workout.objects.create(title=title, **values)
+    
+    def test_recommended_workouts_follow_recent_activity(self):
+        """Test that recommendations rank workouts by the user's activity mix"""
+        UserProfile.objects.create(user=self.user, fitness_level='beginner')
+        for activity_type, duration in (('cycling', 40), ('cycling', 50), ('yoga', 20)):
+            Activity.objects.create(user=self.user, activity_type=activity_type,
+                                    duration=duration, date=datetime.now())
+        # Outside the window the mix is taken from
+        Activity.objects.create(user=self.user, activity_type='running', duration=300,
+                                date=datetime.now() - timedelta(days=recommendations.RECENT_DAYS + 5))
+        self.create_workout('Run', activity_type='running')
+        self.create_workout('Yoga', activity_type='yoga')
+        self.create_workout('Ride', activity_type='cycling', duration=40)
+        self.create_workout('Hard ride', activity_type='cycling', difficulty='advanced')
+        
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        titles = [workout['title'] for workout in response.data['results']]
+        self.assertEqual(titles, ['Ride', 'Yoga', 'Run'])
+        scores = [workout['score'] for workout in response.data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+        
+        response = self.client.get('/api/workouts/recommended/?limit=1&fields=title')
+        self.assertEqual(response.data['results'], [{'title': 'Ride', 'score': scores[0]}])
+    
+    def test_recommended_workouts_muscles_and_equipment(self):
+        """Test boosting target muscles and leaving out equipment the user lacks"""
+        self.create_workout('Squats', target_muscles=['legs'], equipment_needed=['barbell'])
+        self.create_workout('Lunges', target_muscles=['legs'])
+        self.create_workout('Plank', target_muscles=['core'], equipment_needed=['mat'])
+        
+        response = self.client.get('/api/workouts/recommended/?muscles=core')
+        titles = [workout['title'] for workout in response.data['results']]
+        self.assertEqual(titles[0], 'Plank')
+        self.assertEqual(len(titles), 3)
+        
+        response = self.client.get('/api/workouts/recommended/?muscles=legs&equipment=mat')
+        titles = [workout['title'] for workout in response.data['results']]
+        self.assertEqual(titles, ['Lunges', 'Plank'])
+        
+        response = self.client.get('/api/workouts/recommended/?equipment=')
+        titles = [workout['title'] for workout in response.data['results']]
+        self.assertEqual(titles, ['Lunges'])
+    
+    def test_recommendation_index_follows_workout_writes(self):
+        """Test that saves and deletes update the loaded index"""
+        first = self.create_workout('First')
+        self.client.get('/api/workouts/recommended/')
+        self.assertIsNotNone(search.index.loaded_at)
+        
+        second = self.create_workout('Second')
+        first.difficulty = 'advanced'
+        first.save()
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Second'])
+        
+        second.delete()
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual(response.data['results'], [])
+    
+    def test_failed_index_reload_backs_off(self):
+        """Test that a failed background reload isn't retried on every request"""
+        index = recommendations.WorkoutIndex(ttl=0)
+        index.load([])
+        attempts = []
+        
+        def unavailable():
+            attempts.append(time.monotonic())
+            raise ConnectionError('down')
+        
+        def wait_for_reload():
+            # Taken by ensure_loaded and released when the reload thread is done
+            with index._load_lock:
+                pass
+        
+        index.stored_documents = unavailable
+        with self.assertLogs('octofit_tracker.recommendations', 'ERROR'):
+            index.ensure_loaded()
+            wait_for_reload()
+        index.ensure_loaded()
+        wait_for_reload()
+        self.assertEqual(len(attempts), 1)
+        
+        del index.stored_documents
+        self.create_workout('First')
+        index._reload_failed_at -= recommendations.RELOAD_RETRY_INTERVAL
+        index.ensure_loaded()
+        wait_for_reload()
+        self.assertEqual(index.size, 1)
+        self.assertIsNone(index._reload_failed_at)
+    
+    def test_recommended_workouts_rejects_bad_limit(self):
+        """Test that limit must be a number within bounds"""
+        for limit in ('0', 'ten', str(recommendations.MAX_LIMIT + 1)):
+            response = self.client.get(f'/api/workouts/recommended/?limit={limit}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_search_workouts(self):
+        """Test that every word must match and title matches rank first"""
+        self.create_workout('Squats ladder', description='Bodyweight squats', difficulty='advanced',
+                            exercises=[{'name': 'squats', 'reps': 20}])
+        self.create_workout('Leg day', description='Squats and lunges', exercises=['lunges'],
+                            target_muscles=['legs'], equipment_needed=['barbell'])
+        self.create_workout('Easy jog', description='A gentle run')
+        
+        response = self.client.get('/api/workouts/search/?q=SQUATS')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Squats ladder', 'Leg day'])
+        
+        response = self.client.get('/api/workouts/search/?q=squats+legs')
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Leg day'])
+        
+        response = self.client.get('/api/workouts/search/?q=gentle&fields=title')
+        self.assertEqual(response.data['results'], [{'title': 'Easy jog', 'score': 1.0}])
+        
+        response = self.client.get('/api/workouts/search/?q=pilates')
+        self.assertEqual(response.data['count'], 0)
+        self.assertEqual(response.data['results'], [])
+    
+    def test_search_workouts_facets(self):
+        """Test facet counts, with each facet ignoring its own selection"""
+        self.create_workout('Run one', equipment_needed=['shoes'])
+        self.create_workout('Run two', difficulty='advanced', equipment_needed=['shoes', 'watch'])
+        self.create_workout('Swim', activity_type='swimming', equipment_needed=['goggles'])
+        
+        response = self.client.get('/api/workouts/search/')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual(response.data['facets'], {
+            'difficulty': [{'value': 'beginner', 'count': 2}, {'value': 'advanced', 'count': 1}],
+            'activity_type': [{'value': 'running', 'count': 2}, {'value': 'swimming', 'count': 1}],
+            'equipment': [{'value': 'shoes', 'count': 2}, {'value': 'goggles', 'count': 1},
+                          {'value': 'watch', 'count': 1}],
+        })
+        
+        response = self.client.get('/api/workouts/search/?difficulty=beginner&equipment=shoes')
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Run one'])
+        self.assertEqual(response.data['facets'], {
+            'difficulty': [{'value': 'advanced', 'count': 1}, {'value': 'beginner', 'count': 1}],
+            'activity_type': [{'value': 'running', 'count': 1}],
+            'equipment': [{'value': 'goggles', 'count': 1}, {'value': 'shoes', 'count': 1}],
+        })
+    
+    def test_search_workouts_pages(self):
+        """Test that an empty query pages through every workout, newest first"""
+        for number in range(3):
+            self.create_workout(f'Workout {number}')
+        response = self.client.get('/api/workouts/search/?limit=2')
+        self.assertEqual(response.data['count'], 3)
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Workout 2', 'Workout 1'])
+        response = self.client.get('/api/workouts/search/?limit=2&offset=2')
+        self.assertEqual([workout['title'] for workout in response.data['results']], ['Workout 0'])
+        
+        for params in ('limit=0', 'offset=-1', 'limit=many'):
+            response = self.client.get(f'/api/workouts/search/?{params}')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+    
+    def test_search_index_follows_workout_writes(self):
+        """Test that edits and deletes update the loaded search index"""
+        workout = self.create_workout('Morning stretch')
+        self.assertEqual(self.client.get('/api/workouts/search/?q=stretch').data['count'], 1)
+        
+        workout.title = 'Evening stretch'
+        workout.save()
+        self.assertEqual(self.client.get('/api/workouts/search/?q=morning').data['count'], 0)
+        self.assertEqual(self.client.get('/api/workouts/search/?q=evening').data['count'], 1)
+        
+        workout.delete()
+        self.assertEqual(self.client.get('/api/workouts/search/?q=evening').data['count'], 0)
+    
+    def test_admin_search_uses_index(self):
+        """Test that the workout admin finds whole words through the index"""
+        self.create_workout('Leg day', exercises=['squats'])
+        self.create_workout('Easy jog')
+        User.objects.create_superuser(username='admin', password='adminpass123')
+        self.client.force_authenticate(user=None)
+        self.client.login(username='admin', password='adminpass123')
+        response = self.client.get('/admin/octofit_tracker/workout/?q=squats')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+
+class ActivityExportTest(APITestCase):
+    """Test cases for the streaming activity export"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(username='analyst', password='pass123', is_staff=True)
+        self.runner = User.objects.create_user(username='runner', password='pass123')
+        self.client.force_authenticate(user=self.admin)
+        for day, activity_type in ((1, 'running'), (2, 'cycling'), (3, 'running')):
+            Activity.objects.create(
+                user=self.runner,
+                activity_type=activity_type,
+                duration=10 * day,
+                points_earned=day,
+                date=datetime(2026, 3, day, 12, 0)
+            )
+        Activity.objects.create(
+            user=self.admin,
+            activity_type='running',
+            duration=5,
+            date=datetime(2026, 3, 2, 12, 0)
+        )
+    
+    def fetch_export(self, query):
+        response = self.client.get(f'/api/activities/export/?{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response, b''.join(response.streaming_content)
+    
+    def test_csv_export_with_filters(self):
+        """Test that filters select the exported rows"""
+        response, content = self.fetch_export(f'output=csv&user={self.runner.pk}&type=running&since=2026-03-02')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.DictReader(StringIO(content.decode())))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['duration'], '30')
+        self.assertEqual(rows[0]['date'], '2026-03-03T12:00:00+00:00')
+    
+    def test_columnar_exports(self):
+        """Test Parquet, with one row group per batch, and Arrow exports"""
+        response, content = self.fetch_export('until=2026-03-03')
+        self.assertEqual(response['Content-Type'], 'application/vnd.apache.parquet')
+        table = export.pyarrow.parquet.read_table(BytesIO(content))
+        self.assertEqual(table.num_rows, 3)
+        self.assertEqual(table.column_names, list(export.COLUMNS))
+        
+        chunks = export.export_activities(export.build_filter(user_id=self.runner.pk), 'parquet', batch_size=2)
+        parquet_file = export.pyarrow.parquet.ParquetFile(BytesIO(b''.join(chunks)))
+        self.assertEqual(parquet_file.metadata.num_rows, 3)
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        
+        _, content = self.fetch_export('output=arrow&type=cycling')
+        self.assertEqual(export.pyarrow.ipc.open_stream(content).read_all().num_rows, 1)
+    
+    def test_export_rejects_bad_parameters(self):
+        """Test that unknown formats and dates are rejected"""
+        self.assertEqual(self.client.get('/api/activities/export/?output=xlsx').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/activities/export/?since=March').status_code,
+                         status.HTTP_400_BAD_REQUEST)
+    
+    def test_export_requires_admin(self):
+        """Test that only admins can export"""
+        self.client.force_authenticate(user=self.runner)
+        self.assertEqual(self.client.get('/api/activities/export/').status_code, status.HTTP_403_FORBIDDEN)
+    
+    def test_export_command(self):
+        """Test exporting to a file from the command line"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'activities.csv')
+            call_command('export_activities', path, '--format', 'csv', '--type', 'cycling', stdout=StringIO())
+            with open(path) as exported:
+                rows = list(csv.DictReader(exported))
+        self.assertEqual([row['activity_type'] for row in rows], ['cycling'])
+
+
+class LeaderboardEngineTest(TestCase):
+    """Test cases for the incremental leaderboard engine"""
+    
+    def setUp(self):
+        self.user1 = User.objects.create_user(username='user1', password='pass123')
+        self.user2 = User.objects.create_user(username='user2', password='pass123')
+    
+    def create_activity(self, user, points):
+        return Activity.objects.create(
+            user=user,
+            activity_type='running',
+            duration=30,
+            distance=5.0,
+            points_earned=points,
+            date=datetime.now()
+        )
+    
+    def test_activity_writes_update_entry(self):
+        """Test that creating and deleting activities applies deltas"""
+        activity = self.create_activity(self.user1, 45)
+        self.create_activity(self.user1, 15)
+        
+        entry = Leaderboard.objects.get(user=self.user1, period='all_time')
+        self.assertEqual(entry.total_points, 60)
+        self.assertEqual(entry.total_activities, 2)
+        self.assertEqual(entry.total_duration, 60)
+        
+        activity.delete()
+        entry.refresh_from_db()
+        self.assertEqual(entry.total_points, 15)
+        self.assertEqual(entry.total_activities, 1)
+    
+    def test_ranks_follow_points(self):
+        """Test that ranks shift as users overtake each other"""
+        self.create_activity(self.user1, 50)
+        activity = self.create_activity(self.user2, 20)
+        self.assertEqual(Leaderboard.objects.get(user=self.user1, period='all_time').rank, 1)
+        self.assertEqual(Leaderboard.objects.get(user=self.user2, period='all_time').rank, 2)
+        
+        activity.points_earned = 80
+        activity.save()
+        self.assertEqual(Leaderboard.objects.get(user=self.user1, period='all_time').rank, 2)
+        self.assertEqual(Leaderboard.objects.get(user=self.user2, period='all_time').rank, 1)
+    
+    def test_rebuild_matches_incremental(self):
+        """Test that a full rebuild agrees with the incremental entries"""
+        self.create_activity(self.user1, 50)
+        self.create_activity(self.user2, 20)
+        Leaderboard.objects.filter(user=self.user1).update(total_points=0, rank=0)
+        
+        leaderboard.rebuild('all_time')
+        entry = Leaderboard.objects.get(user=self.user1, period='all_time')
+        self.assertEqual(entry.total_points, 50)
+        self.assertEqual(entry.rank, 1)
+    
+    def test_windowed_periods_only_count_recent_activities(self):
+        """Test that daily, weekly and monthly entries honour their windows"""
+        self.create_activity(self.user1, 30)
+        old_activity = self.create_activity(self.user1, 20)
+        old_activity.date = datetime.now() - timedelta(days=10)
+        old_activity.save()
+        
+        def points(period):
+            return Leaderboard.objects.get(user=self.user1, period=period).total_points
+        
+        self.assertEqual(points('all_time'), 50)
+        self.assertEqual(points('monthly'), 50)
+        self.assertEqual(points('weekly'), 30)
+        self.assertEqual(points('daily'), 30)
+        
+        leaderboard.rebuild('weekly')
+        self.assertEqual(points('weekly'), 30)
+
+
+class LeaderboardAPITest(APITestCase):
+    """Test cases for Leaderboard API endpoints"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(
+            username='admin',
+            password='testpass123',
+            is_staff=True
+        )
+        self.client.force_authenticate(user=self.admin)
+        jobs.get_jobs_collection().delete_many({})
+    
+    def test_update_rankings(self):
+        """Test that a rebuild is queued and done by a worker"""
+        response = self.client.post('/api/leaderboard/update_rankings/', {'period': 'weekly'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = response.data['job']
+        self.assertEqual(job['status'], jobs.QUEUED)
+        self.assertTrue(response['Location'].endswith(f"/api/jobs/{job['id']}/"))
+        self.assertEqual(Leaderboard.objects.filter(user=self.admin, period='weekly').count(), 0)
+        
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(Leaderboard.objects.filter(user=self.admin, period='weekly').count(), 1)
+        
+        response = self.client.get(f"/api/jobs/{job['id']}/")
+        self.assertEqual(response.data['status'], jobs.SUCCEEDED)
+        self.assertEqual(response.data['result'], {'entries_written': 1})
+        self.assertEqual(response.data['progress'], {'done': 1, 'total': 1})
+    
+    def test_update_rankings_deduplicates_queued_rebuilds(self):
+        """Test that repeated requests share the queued rebuild of a period"""
+        first = self.client.post('/api/leaderboard/update_rankings/', {'period': 'weekly'})
+        second = self.client.post('/api/leaderboard/update_rankings/', {'period': 'weekly'})
+        other = self.client.post('/api/leaderboard/update_rankings/', {'period': 'daily'})
+        self.assertEqual(first.data['job']['id'], second.data['job']['id'])
+        self.assertNotEqual(first.data['job']['id'], other.data['job']['id'])
+        
+        # Once a worker has started it, a new request queues a follow-up run
+        jobs.claim('test-worker')
+        third = self.client.post('/api/leaderboard/update_rankings/', {'period': 'weekly'})
+        self.assertNotEqual(first.data['job']['id'], third.data['job']['id'])
+        
+        response = self.client.get('/api/jobs/', {'status': jobs.QUEUED})
+        self.assertEqual(len(response.data), 2)
+    
+    def test_failed_job_records_error(self):
+        """Test that a failing job is marked failed with its error"""
+        job, _ = jobs.enqueue('leaderboard.rebuild', {'period': 'weekly', 'unexpected': 1})
+        with self.assertLogs('octofit_tracker.jobs', 'ERROR'):
+            self.assertEqual(jobs.run_pending(), 1)
+        
+        response = self.client.get(f"/api/jobs/{job['_id']}/")
+        self.assertEqual(response.data['status'], jobs.FAILED)
+        self.assertIn('TypeError', response.data['error'])
+    
+    def test_stale_jobs_are_requeued(self):
+        """Test that jobs left running by a stopped worker go back on the queue"""
+        jobs.enqueue_leaderboard_rebuild('weekly')
+        job = jobs.claim('stopped-worker')
+        self.assertEqual(jobs.requeue_stale(stale_after=60), 0)
+        jobs.get_jobs_collection().update_one(
+            {'_id': job['_id']}, {'$set': {'heartbeat_at': datetime.utcnow() - timedelta(minutes=5)}}
+        )
+        self.assertEqual(jobs.requeue_stale(stale_after=60), 1)
+        self.assertEqual(jobs.run_pending(), 1)
+        self.assertEqual(jobs.get_job(job['_id'])['attempts'], 2)
+    
+    def test_jobs_require_admin(self):
+        """Test that job status is only visible to admins"""
+        user = User.objects.create_user(username='member', password='pass123')
+        self.client.force_authenticate(user=user)
+        self.assertEqual(self.client.get('/api/jobs/').status_code, status.HTTP_403_FORBIDDEN)
+        self.assertEqual(self.client.get('/api/jobs/missing/').status_code, status.HTTP_403_FORBIDDEN)
+    
+    def test_update_rankings_rejects_unknown_period(self):
+        """Test that unknown periods are rejected"""
+        response = self.client.post('/api/leaderboard/update_rankings/', {'period': 'yearly'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class ListQueryCountTest(APITestCase):
+    """Test that list endpoints issue a constant number of queries"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123',
+            is_staff=True
+        )
+        self.client.force_authenticate(user=self.user)
+        UserProfile.objects.create(user=self.user, fitness_level='beginner')
+        search.index.clear()
+        self.rows = 0
+    
+    def add_rows(self, count=1):
+        """Add users that each have a team, profile, activity and workout"""
+        for _ in range(count):
+            self.rows += 1
+            user = User.objects.create_user(username=f'member{self.rows}', password='pass123')
+            team = Team.objects.create(name=f'Team {self.rows}', captain=user)
+            team.members.add(user, self.user)
+            UserProfile.objects.create(user=user)
+            Activity.objects.create(
+                user=user,
+                activity_type='running',
+                duration=30,
+                date=datetime.now()
+            )
+            Activity.objects.create(
+                user=self.user,
+                activity_type='walking',
+                duration=20,
+                date=datetime.now()
+            )
+            Workout.objects.create(
+                title=f'Workout {self.rows}',
+                description='Easy workout',
+                difficulty='beginner',
+                duration=20,
+                activity_type='walking',
+                created_by=user
+            )
+    
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return len(context.captured_queries)
+    
+    def assertConstantQueries(self, url):
+        self.add_rows()
+        baseline = self.count_queries(url)
+        self.add_rows(4)
+        self.assertEqual(self.count_queries(url), baseline, url)
+    
+    def test_users(self):
+        self.assertConstantQueries('/api/users/')
+    
+    def test_profiles(self):
+        self.assertConstantQueries('/api/profiles/')
+    
+    def test_teams(self):
+        self.assertConstantQueries('/api/teams/')
+    
+    def test_activities(self):
+        self.assertConstantQueries('/api/activities/')
+    
+    def test_my_activities(self):
+        self.assertConstantQueries('/api/activities/my_activities/')
+    
+    def test_leaderboard(self):
+        self.assertConstantQueries('/api/leaderboard/')
+    
+    def test_workouts(self):
+        self.assertConstantQueries('/api/workouts/')
+    
+    def test_recommended_workouts(self):
+        self.assertConstantQueries('/api/workouts/recommended/')
+    
+    def test_workout_search(self):
+        self.assertConstantQueries('/api/workouts/search/?q=workout')
+    
+    def test_workouts_by_difficulty(self):
+        self.assertConstantQueries('/api/workouts/by_difficulty/?difficulty=beginner')
+    
+    def test_sparse_fields(self):
+        self.assertConstantQueries('/api/activities/?fields=_id,user.team_name')
+        self.assertConstantQueries('/api/teams/?fields=name,members')
+        self.assertConstantQueries('/api/profiles/?expand=user')
+
+
+class SparseFieldsTest(APITestCase):
+    """Test cases for ?fields= and ?expand= projections"""
+    
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='runner', password='pass123')
+        self.client.force_authenticate(user=self.user)
+        self.team = Team.objects.create(name='Sprinters', captain=self.user)
+        self.team.members.add(self.user)
+        Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=30,
+            points_earned=30,
+            notes='Long notes nobody asked for',
+            date=datetime.now()
+        )
+    
+    def first_activity(self, query):
+        response = self.client.get(f'/api/activities/?{query}')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return response.data['results'][0]
+    
+    def test_default_output_unchanged(self):
+        """Test that responses without parameters keep every field"""
+        activity = self.first_activity('')
+        self.assertEqual(activity['user']['team_name'], 'Sprinters')
+        self.assertEqual(activity['notes'], 'Long notes nobody asked for')
+    
+    def test_fields_select_top_level_fields(self):
+        """Test that only the requested fields are returned"""
+        activity = self.first_activity('fields=_id,username,points_earned')
+        self.assertEqual(set(activity), {'_id', 'username', 'points_earned'})
+        self.assertEqual(activity['username'], 'runner')
+    
+    def test_relations_collapse_unless_expanded(self):
+        """Test that relations come back as ids unless expanded"""
+        self.assertEqual(self.first_activity('fields=_id,user')['user'], self.user.pk)
+        
+        expanded = self.first_activity('fields=_id,user&expand=user')
+        self.assertEqual(expanded['user']['username'], 'runner')
+        
+        nested = self.first_activity('fields=user.username,user.team_name')
+        self.assertEqual(nested['user'], {'username': 'runner', 'team_name': 'Sprinters'})
+    
+    def test_team_members_collapse(self):
+        """Test that team lists can skip embedding members"""
+        response = self.client.get('/api/teams/?fields=name,members,captain')
+        self.assertEqual(
+            response.data['results'][0],
+            {'name': 'Sprinters', 'members': [self.user.pk], 'captain': self.user.pk}
+        )
+    
+    def test_projection_pushed_into_query(self):
+        """Test that unrequested columns and joins are not queried"""
+        with CaptureQueriesContext(connection) as context:
+            self.first_activity('fields=_id,points_earned')
+        sql = ' '.join(query['sql'] for query in context.captured_queries)
+        self.assertIn('points_earned', sql)
+        self.assertNotIn('notes', sql)
+        self.assertNotIn('auth_user', sql)
+    
+    def test_writes_keep_every_field(self):
+        """Test that ?fields= doesn't drop fields from writes"""
+        response = self.client.post('/api/activities/?fields=_id', {
+            'activity_type': 'cycling',
+            'duration': 45,
+            'date': datetime.now().isoformat(),
+        })
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['activity_type'], 'cycling')
+
+
+class ResponseCacheTest(APITestCase):
+    """Test cases for cached list responses"""
+    
+    def setUp(self):
+        cache.clear()
+        search.index.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.client.force_authenticate(user=self.user)
+        Activity.objects.create(
+            user=self.user,
+            activity_type='running',
+            duration=30,
+            points_earned=45,
+            date=datetime.now()
+        )
+        Workout.objects.create(
+            title='Beginner Workout',
+            description='Easy workout',
+            difficulty='beginner',
+            duration=20,
+            activity_type='walking',
+            created_by=self.user
+        )
+    
+    def test_repeat_request_is_served_from_cache(self):
+        """Test that a repeated request issues no queries"""
+        first = self.client.get('/api/leaderboard/')
+        with CaptureQueriesContext(connection) as context:
+            second = self.client.get('/api/leaderboard/')
+        self.assertEqual(len(context.captured_queries), 0)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second['ETag'], first['ETag'])
+    
+    def test_conditional_requests(self):
+        """Test that matching validators get a 304"""
+        response = self.client.get('/api/workouts/by_difficulty/?difficulty=beginner')
+        self.assertIn('Last-Modified', response)
+        
+        response = self.client.get(
+            '/api/workouts/by_difficulty/?difficulty=beginner',
+            HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        
+        response = self.client.get(
+            '/api/workouts/by_difficulty/?difficulty=beginner',
+            HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        
+        response = self.client.get(
+            '/api/workouts/by_difficulty/?difficulty=beginner',
+            HTTP_IF_NONE_MATCH='"stale"'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+    
+    def test_activity_write_invalidates_leaderboard(self):
+        """Test that new activities show up on the next leaderboard request"""
+        first = self.client.get('/api/leaderboard/')
+        self.assertEqual(first.data['results'][0]['total_points'], 45)
+        
+        Activity.objects.create(
+            user=self.user,
+            activity_type='walking',
+            duration=10,
+            points_earned=10,
+            date=datetime.now()
+        )
+        second = self.client.get('/api/leaderboard/', HTTP_IF_NONE_MATCH=first['ETag'])
+        self.assertEqual(second.status_code, status.HTTP_200_OK)
+        self.assertEqual(second.data['results'][0]['total_points'], 55)
+    
+    def test_invalidation_from_another_process(self):
+        """Test that a version bumped in Mongo orphans this process's entries"""
+        self.client.get('/api/leaderboard/')
+        get_collection(Leaderboard).update_many({}, {'$set': {'total_points': 99}})
+        self.assertEqual(self.client.get('/api/leaderboard/').data['results'][0]['total_points'], 45)
+        
+        get_collection(caching.VERSIONS_COLLECTION).update_one(
+            {'_id': f'response:{caching.LEADERBOARD}'}, {'$inc': {'version': 1}}
+        )
+        self.assertEqual(self.client.get('/api/leaderboard/').data['results'][0]['total_points'], 99)
+    
+    def test_workout_and_profile_writes_invalidate_workouts(self):
+        """Test that workout lists follow workout and profile changes"""
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual(len(response.data['results']), 1)
+        
+        Workout.objects.create(
+            title='Another Workout',
+            description='Easy workout',
+            difficulty='beginner',
+            duration=15,
+            activity_type='yoga',
+            created_by=self.user
+        )
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual(len(response.data['results']), 2)
+        
+        UserProfile.objects.create(user=self.user, fitness_level='advanced')
+        response = self.client.get('/api/workouts/recommended/')
+        self.assertEqual(len(response.data['results']), 0)
+
+
+class SyntheticPopulateTest(TestCase):
+    """Test cases for the synthetic populate_db mode"""
+    
+    def populate(self, seed):
+        call_command(
+            'populate_db', users=30, activities_per_user=4, seed=seed,
+            chunk_size=7, stdout=StringIO()
+        )
+        return sorted(
+            (activity.user_id, activity.activity_type, activity.duration, activity.points_earned)
+            for activity in Activity.objects.all()
+        )
+    
+    def test_generates_consistent_data(self):
+        """Test that users, activities and derived totals line up"""
+        activities = self.populate(seed=1)
+        self.assertEqual(User.objects.count(), 30)
+        self.assertEqual(UserProfile.objects.count(), 30)
+        self.assertGreater(len(activities), 0)
+        
+        total_points = sum(points for _, _, _, points in activities)
+        self.assertEqual(sum(UserProfile.objects.values_list('points', flat=True)), total_points)
+        self.assertEqual(
+            sum(Leaderboard.objects.filter(period='all_time').values_list('total_points', flat=True)),
+            total_points
+        )
+        member_points = sum(
+            points for user_id, _, _, points in activities
+            if Team.members.through.objects.filter(user_id=user_id).count()
+        )
+        self.assertEqual(sum(Team.objects.values_list('total_points', flat=True)), member_points)
+        self.assertEqual(rollups.verify().drifted, [])
+        
+        # Ids come from djongo's counter, so ORM inserts don't collide
+        User.objects.create_user(username='after', password='pass123')
+    
+    def test_same_seed_same_data(self):
+        """Test that a seed reproduces the same activities"""
+        first = [row[1:] for row in self.populate(seed=3)]
+        second = [row[1:] for row in self.populate(seed=3)]
+        self.assertEqual(first, second)
+
+
+@override_settings(PROFILING_ENABLED=True)
+class ProfilingMiddlewareTest(APITestCase):
+    """Test cases for the opt-in profiling middleware"""
+    
+    def setUp(self):
+        profiling.log.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(
+            username='testuser',
+            password='testpass123',
+            is_staff=True
+        )
+        self.client.force_authenticate(user=self.user)
+        UserProfile.objects.create(user=self.user)
+    
+    def test_server_timing_header(self):
+        """Test that responses report ORM, Mongo and serialization timings"""
+        response = self.client.get('/api/profiles/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        timing = response['Server-Timing']
+        for metric in ('sql;desc=', 'translate;dur=', 'mongo;desc=', 'serialize;dur=', 'total;dur='):
+            self.assertIn(metric, timing)
+    
+    def test_summary_groups_by_endpoint(self):
+        """Test that the summary lists each endpoint with its request count"""
+        for _ in range(3):
+            self.client.get('/api/profiles/')
+        self.client.get('/api/workouts/')
+        
+        response = self.client.get('/api/profiling/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        endpoints = {row['endpoint']: row for row in response.data['endpoints']}
+        self.assertEqual(endpoints['GET userprofile-list']['requests'], 3)
+        self.assertGreater(endpoints['GET userprofile-list']['sql_count'], 0)
+        self.assertIn('GET workout-list', endpoints)
+        
+        response = self.client.delete('/api/profiling/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(
+            [record['endpoint'] for record in profiling.log.records()],
+            ['DELETE profiling-summary']
+        )
+    
+    def test_summary_requires_staff(self):
+        """Test that only staff can read the summary"""
+        self.client.force_authenticate(
+            user=User.objects.create_user(username='member', password='pass123')
+        )
+        response = self.client.get('/api/profiling/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+    
+    @override_settings(PROFILING_ENABLED=False)
+    def test_disabled_by_default(self):
+        """Test that nothing is recorded or exposed when profiling is off"""
+        response = self.client.get('/api/profiles/')
+        self.assertNotIn('Server-Timing', response)
+        response = self.client.get('/api/profiling/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncReadPathTest(TestCase):
+    """Test cases for the async read endpoints under ASGI"""
+    
+    def setUp(self):
+        cache.clear()
+        rollups.get_rollups_collection().delete_many({})
+        self.user = User.objects.create_user(username='testuser', password='testpass123')
+        self.async_client.force_login(self.user)
+        for duration in (30, 45):
+            Activity.objects.create(
+                user=self.user,
+                activity_type='running',
+                duration=duration,
+                points_earned=duration,
+                date=datetime.now()
+            )
+    
+    async def test_leaderboard_list(self):
+        """Test that the leaderboard is served from the read pool"""
+        response = await self.async_client.get('/api/leaderboard/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        results = response.json()['results']
+        self.assertEqual(results[0]['total_points'], 75)
+        self.assertEqual(results[0]['rank'], 1)
+    
+    async def test_my_activities_and_stats(self):
+        """Test the activity feed and stats over ASGI"""
+        response = await self.async_client.get('/api/activities/my_activities/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.json()['results']), 2)
+        
+        response = await self.async_client.get('/api/activities/stats/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['total_duration'], 75)
+    
+    @override_settings(ASYNC_READ_MAX_PENDING=0)
+    async def test_sheds_load_when_queue_is_full(self):
+        """Test that requests beyond the pending limit get a 503"""
+        response = await self.async_client.get('/api/activities/stats/')
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '1')
+
+
+class LeaderboardStreamTest(TestCase):
+    """Test cases for leaderboard rank deltas and the event stream"""
+    
+    def setUp(self):
+        realtime._publisher = None
+        self.alice = User.objects.create_user(username='alice', password='pass123')
+        self.bob = User.objects.create_user(username='bob', password='pass123')
+        self.add_activity(self.alice, 30)
+        self.add_activity(self.bob, 20)
+    
+    def add_activity(self, user, points):
+        Activity.objects.create(
+            user=user,
+            activity_type='running',
+            duration=points,
+            points_earned=points,
+            date=datetime.now()
+        )
+    
+    async def test_publishes_one_delta_per_window(self):
+        """Test that several changes are published as one rank delta"""
+        publisher = realtime.LeaderboardPublisher(realtime.LocalBroker())
+        subscription = publisher.broker.subscribe(realtime.channel_for('all_time'))
+        snapshot = await sync_to_async(publisher.snapshot)('all_time')
+        self.assertEqual([entry['username'] for entry in snapshot['entries']], ['alice', 'bob'])
+        
+        await sync_to_async(self.add_activity)(self.bob, 15)
+        await sync_to_async(self.add_activity)(self.bob, 15)
+        self.assertEqual(await sync_to_async(publisher.publish)('all_time'), 1)
+        
+        message = await asyncio.wait_for(subscription.get(), timeout=1)
+        self.assertEqual(message['type'], 'delta')
+        changes = {entry['username']: entry for entry in message['changes']}
+        self.assertEqual(changes['bob']['rank'], 1)
+        self.assertEqual(changes['bob']['total_points'], 50)
+        self.assertEqual(changes['alice']['rank'], 2)
+        self.assertTrue(subscription.queue.empty())
+    
+    async def test_publishes_changes_made_by_other_processes(self):
+        """Test that a bumped shared leaderboard version is noticed without the signal"""
+        publisher = realtime.LeaderboardPublisher(realtime.LocalBroker(), window=60, poll_interval=60)
+        subscription = publisher.broker.subscribe(realtime.channel_for('all_time'))
+        await sync_to_async(publisher.snapshot)('all_time')
+        await sync_to_async(publisher.poll)()
+        self.assertEqual(publisher._dirty, set())
+        
+        def rebuild_elsewhere():
+            # What a run_jobs worker leaves behind: moved entries and a bumped version
+            entries = get_collection(Leaderboard)
+            entries.update_one({'user_id': self.bob.pk, 'period': 'all_time'},
+                               {'$set': {'total_points': 80, 'rank': 1}})
+            entries.update_one({'user_id': self.alice.pk, 'period': 'all_time'}, {'$set': {'rank': 2}})
+            caching.invalidate(caching.LEADERBOARD)
+        
+        await sync_to_async(rebuild_elsewhere)()
+        await sync_to_async(publisher.poll)()
+        self.assertEqual(await sync_to_async(publisher.flush)(), 1)
+        message = await asyncio.wait_for(subscription.get(), timeout=1)
+        changes = {entry['username']: entry for entry in message['changes']}
+        self.assertEqual((changes['bob']['rank'], changes['bob']['total_points']), (1, 80))
+    
+    def test_rest_rows_keyed_like_stream_entries(self):
+        """Test that list rows carry the user_id stream deltas are keyed by"""
+        rows = self.client.get('/api/leaderboard/').json()['results']
+        entries = realtime.load_entries('all_time', 100)
+        self.assertEqual([row['user_id'] for row in rows], [entry['user_id'] for entry in entries])
+    
+    def test_no_work_without_viewers(self):
+        """Test that changes are not computed when nobody is watching"""
+        publisher = realtime.get_publisher()
+        self.add_activity(self.bob, 50)
+        self.assertIsNone(publisher._thread)
+    
+    async def stream(self, query_string=b''):
+        scope = {'type': 'http', 'path': realtime.STREAM_PATH, 'query_string': query_string}
+        messages = []
+        done = asyncio.Event()
+        
+        async def receive():
+            await done.wait()
+            return {'type': 'http.disconnect'}
+        
+        async def send(message):
+            messages.append(message)
+            if message.get('body', b'').startswith(b'event: snapshot'):
+                done.set()
+        
+        await asyncio.wait_for(realtime.leaderboard_stream(scope, receive, send), timeout=5)
+        return messages
+    
+    async def test_stream_starts_with_snapshot(self):
+        """Test that a new viewer gets the current standings"""
+        messages = await self.stream()
+        self.assertEqual(messages[0]['status'], 200)
+        self.assertIn((b'content-type', b'text/event-stream'), messages[0]['headers'])
+        
+        event = messages[1]['body'].decode()
+        data = json.loads(event.split('data: ', 1)[1])
+        self.assertEqual(data['period'], 'all_time')
+        self.assertEqual(data['entries'][0]['username'], 'alice')
+        self.assertEqual(data['entries'][0]['rank'], 1)
+    
+    async def test_stream_rejects_unknown_period(self):
+        """Test that an unknown period gets a 400"""
+        messages = await self.stream(b'period=yearly')
+        self.assertEqual(messages[0]['status'], 400)
+
+
+class ActivityRollupTest(TestCase):
+    """Test cases for verifying and repairing activity rollups"""
+    
+    def setUp(self):
+        rollups.get_rollups_collection().delete_many({})
+        self.alice = User.objects.create_user(username='alice', password='testpass123')
+        self.bob = User.objects.create_user(username='bob', password='testpass123')
+        for user, duration in [(self.alice, 30), (self.alice, 20), (self.bob, 40)]:
+            Activity.objects.create(
+                user=user,
+                activity_type='running',
+                duration=duration,
+                distance=2.5,
+                points_earned=duration,
+                date=datetime(2026, 10, 1)
+            )
+    
+    def verify(self, *args):
+        output = StringIO()
+        call_command('verify_activity_rollups', *args, stdout=output)
+        return output.getvalue()
+    
+    def test_rollups_match_activities(self):
+        """Test that rollups kept by the signals pass verification"""
+        report = rollups.verify()
+        self.assertEqual(report.users, 2)
+        self.assertEqual(report.drifted, [])
+        self.assertEqual(report.orphaned, [])
+        self.assertIn('Checked 2 users: 0 drifted, 0 orphaned', self.verify())
+    
+    def test_repair_fixes_drift(self):
+        """Test that drifted and orphaned rollups are found and repaired"""
+        collection = rollups.get_rollups_collection()
+        collection.update_one({'_id': self.alice.pk}, {'$inc': {'types.running.total_points': 7}})
+        collection.insert_one({'_id': 999999, 'totals': {'total_activities': 1}})
+        
+        output = self.verify()
+        self.assertIn('1 drifted, 1 orphaned', output)
+        self.assertIn(f'Drifted: {self.alice.pk}', output)
+        self.assertIn('Orphaned: 999999', output)
+        self.assertEqual(rollups.verify(user_ids=[self.bob.pk]).drifted, [])
+        
+        output = self.verify('--repair')
+        self.assertIn('Rollups written: 2', output)
+        report = rollups.verify()
+        self.assertEqual((report.drifted, report.orphaned), ([], []))
+        self.assertEqual(rollups.user_stats(self.alice.pk, ['type'])['by_type']['running'], {
+            'total_activities': 2, 'total_points': 50, 'total_duration': 50, 'total_distance': 5.0,
+        })
+        self.assertIsNone(collection.find_one({'_id': 999999}))
+
+
+class IndexManagementTest(TestCase):
+    """Test cases for declared MongoDB indexes"""
+    
+    def test_declared_indexes_exist_after_migrate(self):
+        """Test that migrate created every declared index"""
+        for collection_name, specs in DECLARED_INDEXES.items():
+            keys = [info['key'] for info in get_collection(collection_name).index_information().values()]
+            for spec in specs:
+                self.assertIn(list(spec.keys), [list(key) for key in keys], spec.name)
+    
+    def test_ensure_indexes_is_idempotent(self):
+        """Test that a second run creates nothing"""
+        ensure_indexes()
+        created, failed = ensure_indexes()
+        self.assertEqual(created, [])
+        self.assertEqual(failed, [])
+    
+    def test_plain_index_replaced_by_declared_unique_one(self):
+        """Test that djongo's foreign key index on profiles becomes unique"""
+        collection = get_collection(UserProfile)
+        unique = [info for info in collection.index_information().values() if info['key'] == [('user_id', 1)]]
+        self.assertEqual([info.get('unique') for info in unique], [True])
+        
+        collection.drop_index('user')
+        collection.create_index([('user_id', 1)], name='user_profiles_user_id_plain')
+        created, failed = ensure_indexes()
+        self.assertEqual((created, failed), ([f'{UserProfile._meta.db_table}.user'], []))
+        self.assertTrue(collection.index_information()['user']['unique'])
+
+
+class PointsBufferTest(TestCase):
+    """Test cases for write-behind point accrual"""
+    
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='pass123')
+        UserProfile.objects.create(user=self.user, points=10)
+    
+    def test_increments_merge_until_flush(self):
+        """Test that buffered increments are written together on flush"""
+        buffer = PointsBuffer(flush_interval=60, flush_size=100)
+        buffer.add(self.user.pk, 5)
+        buffer.add(self.user.pk, 7)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 10)
+        
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 22)
+        self.assertEqual(buffer.flush(), 0)
+    
+    def test_flushes_when_full(self):
+        """Test that reaching the size limit flushes immediately"""
+        buffer = PointsBuffer(flush_interval=60, flush_size=1)
+        buffer.add(self.user.pk, 5)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 15)
+    
+    def wait_for_points(self, points):
+        deadline = time.monotonic() + 5
+        while UserProfile.objects.get(user=self.user).points != points and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, points)
+    
+    def test_flushes_after_interval(self):
+        """Test that the flusher thread writes pending increments on its own"""
+        buffer = PointsBuffer(flush_interval=0.05, flush_size=100)
+        buffer.add(self.user.pk, 5)
+        self.wait_for_points(15)
+        buffer.add(self.user.pk, 3)
+        self.wait_for_points(18)
+    
+    def test_failed_flush_is_retried(self):
+        """Test that increments kept by a failed flush are written one interval later"""
+        buffer = PointsBuffer(flush_interval=0.05, flush_size=100)
+        with mock.patch('octofit_tracker.points.write_increments', side_effect=ConnectionError('down')):
+            with self.assertLogs('octofit_tracker.points', 'ERROR') as logs:
+                buffer.add(self.user.pk, 5)
+                deadline = time.monotonic() + 5
+                while not logs.records and time.monotonic() < deadline:
+                    time.sleep(0.01)
+        self.assertEqual(UserProfile.objects.get(user=self.user).points, 10)
+        self.wait_for_points(15)
+
+
+class ScoringTest(APITestCase):
+    """Test cases for the points rule tables and re-scoring"""
+    
+    def setUp(self):
+        cache.clear()
+        rollups.get_rollups_collection().delete_many({})
+        self.client = APIClient()
+        self.alice = User.objects.create_user(username='alice', password='testpass123')
+        self.bob = User.objects.create_user(username='bob', password='testpass123')
+        self.team = Team.objects.create(name='Team A')
+        self.team.members.add(self.alice, self.bob)
+    
+    def post_activity(self, user, day, activity_type='running', duration=30, distance=None):
+        self.client.force_authenticate(user=user)
+        data = {'activity_type': activity_type, 'duration': duration, 'date': day.isoformat()}
+        if distance is not None:
+            data['distance'] = distance
+        response = self.client.post('/api/activities/', data)
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response.data['points_earned']
+    
+    def test_first_rules_match_type_multipliers(self):
+        """Test that version 1 scores duration times the type multiplier"""
+        rules = scoring.get_rules(1)
+        types = ['running', 'cycling', 'swimming', 'strength_training', 'walking', 'yoga', 'other', 'unknown']
+        points = scoring.evaluate(rules, types, [37] * len(types), [5.0] * len(types))
+        self.assertEqual(points.tolist(), [
+            int(37 * rules.multipliers.get(activity_type, 1.0)) for activity_type in types
+        ])
+    
+    def test_distance_streak_and_cap(self):
+        """Test the distance bonus, streak tiers and the cap of version 2"""
+        rules = scoring.get_rules(2)
+        points = scoring.evaluate(
+            rules, ['running', 'running', 'yoga', 'running'], [30, 30, 30, 400], [5.0, None, 3.0, 60.0],
+            streaks=[1, 3, 7, 1],
+        )
+        self.assertEqual(points.tolist(), [55, 49, 45, 600])
+        
+        days = [10, 11, 12, 12, 14, 11, 12]
+        users = [1, 1, 1, 1, 1, 2, 2]
+        self.assertEqual(scoring.streak_lengths(users, days).tolist(), [1, 2, 3, 3, 1, 1, 2])
+    
+    def test_unknown_rules_version(self):
+        """Test that an unregistered version is rejected"""
+        with self.assertRaises(ValueError):
+            scoring.get_rules(99)
+        with self.assertRaises(CommandError):
+            call_command('rescore_activities', rules_version=99, stdout=StringIO())
+    
+    @override_settings(POINTS_RULES_VERSION=2)
+    def test_new_activities_use_current_rules(self):
+        """Test that new activities get distance and streak bonuses from stored history"""
+        start = datetime(2024, 9, 1, 12)
+        self.assertEqual(self.post_activity(self.alice, start, distance=5.0), 55)
+        self.assertEqual(self.post_activity(self.alice, start + timedelta(days=1)), 45)
+        # Third day in a row
+        self.assertEqual(self.post_activity(self.alice, start + timedelta(days=2)), 49)
+        
+        self.client.force_authenticate(user=self.alice)
+        date = (start + timedelta(days=3)).isoformat()
+        response = self.client.post('/api/activities/bulk/', [
+            {'activity_type': 'walking', 'duration': 20, 'distance': 2.0, 'date': date},
+        ], format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 55 + 45 + 49 + 24)
+    
+    @override_settings(POINTS_RULES_VERSION=2)
+    def test_writes_rescore_later_streak_days(self):
+        """Test that backdating, deleting and editing activities re-score the streaks they touch"""
+        start = datetime.now().replace(hour=12) - timedelta(days=2)
+        self.post_activity(self.alice, start + timedelta(days=1))
+        self.post_activity(self.alice, start + timedelta(days=2))
+        # Backdated: the last activity is now on the third day in a row
+        self.assertEqual(self.post_activity(self.alice, start), 45)
+        last = Activity.objects.get(user=self.alice, date__gte=start + timedelta(days=2))
+        self.assertEqual(last.points_earned, 49)
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 45 + 45 + 49)
+        
+        middle = Activity.objects.get(user=self.alice, date__gte=start + timedelta(days=1), date__lt=last.date)
+        response = self.client.delete(f'/api/activities/{middle.pk}/')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(Activity.objects.get(pk=last.pk).points_earned, 45)
+        self.assertEqual(Leaderboard.objects.get(user=self.alice, period='all_time').total_points, 45 + 45)
+        
+        response = self.client.patch(f'/api/activities/{last.pk}/', {'duration': 60}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['points_earned'], 90)
+        self.assertEqual(Leaderboard.objects.get(user=self.alice, period='all_time').total_points, 45 + 90)
+        self.assertEqual(Team.objects.get(pk=self.team.pk).total_points, 45 + 90)
+        self.assertEqual(rollups.verify().drifted, [])
+    
+    def test_edit_rescores_activity(self):
+        """Test that changing an activity's type re-scores it and moves the user's points"""
+        self.post_activity(self.alice, datetime(2024, 9, 1, 12))
+        activity = Activity.objects.get(user=self.alice)
+        response = self.client.patch(f'/api/activities/{activity.pk}/', {'activity_type': 'yoga'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['points_earned'], 36)
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 36)
+        self.assertEqual(Leaderboard.objects.get(user=self.alice, period='all_time').total_points, 36)
+    
+    def test_rescore_propagates_deltas(self):
+        """Test that re-scoring updates activities, profiles, leaderboards, teams and rollups"""
+        start = datetime.now() - timedelta(days=2)
+        for days in range(3):
+            self.post_activity(self.alice, start + timedelta(days=days), distance=5.0)
+        self.post_activity(self.bob, start, activity_type='yoga', duration=120)
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 135)
+        self.assertEqual(Leaderboard.objects.get(user=self.bob, period='all_time').rank, 1)
+        
+        output = StringIO()
+        call_command('rescore_activities', rules_version=2, dry_run=True, stdout=output)
+        self.assertIn('3 changed, +35 points', output.getvalue())
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 135)
+        
+        output = StringIO()
+        call_command('rescore_activities', rules_version=2, chunk_size=1, stdout=output)
+        self.assertIn('3 changed, +35 points', output.getvalue())
+        self.assertEqual(
+            sorted(Activity.objects.filter(user=self.alice).values_list('points_earned', flat=True)),
+            [55, 55, 60]
+        )
+        self.assertEqual(UserProfile.objects.get(user=self.alice).points, 170)
+        # Only today's activity falls in the daily window
+        for period, points in [('all_time', 170), ('monthly', 170), ('weekly', 170), ('daily', 60)]:
+            entry = Leaderboard.objects.get(user=self.alice, period=period)
+            self.assertEqual(entry.total_points, points, period)
+            self.assertEqual(entry.rank, 1, period)
+        self.assertEqual(Leaderboard.objects.get(user=self.bob, period='all_time').rank, 2)
+        self.assertEqual(Team.objects.get(pk=self.team.pk).total_points, 170 + 144)
+        self.assertEqual(rollups.user_stats(self.alice.pk)['total_points'], 170)
+        self.assertEqual(rollups.verify().drifted, [])
+        
+        output = StringIO()
+        call_command('rescore_activities', rules_version=2, stdout=output)
+        self.assertIn('0 changed', output.getvalue())
@@ -0,0 +1,175 @@
+"""
+Bucketed activity time series for charts.
+
+A series covers one user's activities, optionally of one type, in day,
+week (Monday to Sunday) or month buckets, UTC. The totals come from one
+pipeline that groups the activities in range by day; days are folded into
+weeks and months here, since ``$dateTrunc`` needs MongoDB 5.0.
+
+Closed buckets, those ending before today, can only change when an activity
+dated before today is written, so they are cached for a day
+(``TIMESERIES_CACHE_TIMEOUT``). Each user has a version that such writes
+bump, orphaning every closed bucket cached for them; writes dated today
+leave it alone. Versions are kept in Mongo, so a bump made by any process,
+e.g. another web worker or ``rescore_activities``, reaches every process. A
+request only queries the buckets that are still open or not cached yet.
+"""
+from collections import namedtuple
+from datetime import date, datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .caching import bump_versions, shared_version
+from .models import Activity
+from .mongo import get_collection, to_mongo_datetime
+
+INTERVALS = ('day', 'week', 'month')
+# Summed activity fields, by their ``?metric=`` name; each is a Series column
+METRICS = ('points', 'duration', 'distance')
+# Buckets returned when no range is given, ending with the current one
+DEFAULT_BUCKETS = {'day': 30, 'week': 12, 'month': 12}
+MAX_BUCKETS = 400
+
+KEY_PREFIX = 'octofit:timeseries'
+
+Series = namedtuple('Series', ['buckets', 'activities', 'points', 'duration', 'distance'])
+
+
+def bucket_start(day, interval):
+    """The first day of the bucket containing ``day``"""
+    if interval == 'week':
+        return day - timedelta(days=day.weekday())
+    if interval == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket(start, interval):
+    if interval == 'week':
+        return start + timedelta(days=7)
+    if interval == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def today():
+    return timezone.now().astimezone(dt_timezone.utc).date()
+
+
+def parse_day(value):
+    day = parse_date(value)
+    if day is None:
+        raise ValueError(f'Invalid date: {value}')
+    return day
+
+
+def bucket_range(interval, since=None, until=None):
+    """
+    The bucket start days from the one containing ``since`` up to ``until``
+    (exclusive), both dates.
+
+    Without ``since`` the range starts ``DEFAULT_BUCKETS`` buckets before
+    ``until``; without ``until`` it ends with the current bucket. Raises
+    ValueError for an empty range or one of more than ``MAX_BUCKETS``.
+    """
+    if until is None:
+        until = next_bucket(bucket_start(today(), interval), interval)
+    if since is None:
+        start = bucket_start(until - timedelta(days=1), interval)
+        for _ in range(DEFAULT_BUCKETS[interval] - 1):
+            start = bucket_start(start - timedelta(days=1), interval)
+    else:
+        start = bucket_start(since, interval)
+    starts = []
+    while start < until:
+        starts.append(start)
+        if len(starts) > MAX_BUCKETS:
+            raise ValueError(f'Ranges are limited to {MAX_BUCKETS} buckets')
+        start = next_bucket(start, interval)
+    if not starts:
+        raise ValueError('The range is empty')
+    return starts
+
+
+def _version_name(user_id):
+    return f'timeseries:{user_id}'
+
+
+def invalidate(user_ids):
+    """Orphan the cached closed buckets of these users"""
+    bump_versions(_version_name(user_id) for user_id in user_ids)
+
+
+def apply_activity_changes(snapshots):
+    """Invalidate the users whose closed buckets these activity snapshots touch"""
+    current_day = datetime.combine(today(), time.min)
+    invalidate(snap['user_id'] for snap in snapshots if snap is not None and snap['day'] < current_day)
+
+
+def _bucket_key(user_id, version, interval, activity_type, start):
+    return f'{KEY_PREFIX}:{user_id}:{version}:{interval}:{activity_type or "*"}:{start.isoformat()}'
+
+
+def _daily_totals(user_id, activity_type, since, until):
+    """``{date: (activities, points, duration, distance)}`` for days with activities"""
+    match = {
+        'user_id': user_id,
+        'date': {
+            '$gte': to_mongo_datetime(datetime.combine(since, time.min)),
+            '$lt': to_mongo_datetime(datetime.combine(until, time.min)),
+        },
+    }
+    if activity_type:
+        match['activity_type'] = activity_type
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}},
+            'activities': {'$sum': 1},
+            'points': {'$sum': '$points_earned'},
+            'duration': {'$sum': '$duration'},
+            'distance': {'$sum': '$distance'},
+        }},
+    ]
+    return {
+        date.fromisoformat(group['_id']): (
+            group['activities'], group['points'] or 0, group['duration'] or 0, group['distance'] or 0,
+        )
+        for group in get_collection(Activity).aggregate(pipeline)
+    }
+
+
+def user_series(user_id, interval, activity_type=None, since=None, until=None):
+    """
+    A user's activity totals per bucket, as a ``Series`` of equal-length
+    columns with a zero for every bucket without activities.
+    """
+    starts = bucket_range(interval, since, until)
+    closed_before = bucket_start(today(), interval)
+    version = shared_version(_version_name(user_id))
+    keys = {
+        start: _bucket_key(user_id, version, interval, activity_type, start)
+        for start in starts if start < closed_before
+    }
+    cached = cache.get_many(list(keys.values()))
+    totals = {start: cached[key] for start, key in keys.items() if key in cached}
+
+    missing = [start for start in starts if start not in totals]
+    if missing:
+        end = next_bucket(starts[-1], interval)
+        computed = {start: (0, 0, 0, 0) for start in missing}
+        for day, day_totals in _daily_totals(user_id, activity_type, missing[0], end).items():
+            start = bucket_start(day, interval)
+            if start in computed:
+                computed[start] = tuple(a + b for a, b in zip(computed[start], day_totals))
+        cache.set_many(
+            {keys[start]: bucket for start, bucket in computed.items() if start in keys},
+            getattr(settings, 'TIMESERIES_CACHE_TIMEOUT', 86400),
+        )
+        totals.update(computed)
+
+    columns = zip(*(totals[start] for start in starts))
+    return Series([start.isoformat() for start in starts], *(list(column) for column in columns))
@@ -20,9 +20,11 @@ from rest_framework import routers
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework.reverse import reverse
+from . import async_views
 from .views import (
     UserViewSet, UserProfileViewSet, TeamViewSet,
-    ActivityViewSet, LeaderboardViewSet, WorkoutViewSet
+    ActivityViewSet, LeaderboardViewSet, WorkoutViewSet, job_detail, job_list,
+    profiling_summary
 )
 
 # Get codespace environment variable for URL construction
@@ -63,5 +65,13 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('', api_root, name='api-root'),
     path('api/', api_root, name='api-root'),
+    path('api/profiling/', profiling_summary, name='profiling-summary'),
+    path('api/jobs/', job_list, name='job-list'),
+    path('api/jobs/<str:job_id>/', job_detail, name='job-detail'),
+    # Async read paths; these shadow the router's sync routes for the same URLs
+    path('api/leaderboard/', async_views.leaderboard_list),
+    path('api/activities/my_activities/', async_views.my_activities),
+    path('api/activities/stats/', async_views.activity_stats),
+    path('api/activities/timeseries/', async_views.activity_timeseries),
     path('api/', include(router.urls)),
 ]
@@ -1,16 +1,69 @@
+from bson import ObjectId
+from bson.errors import InvalidId
+from django.http import Http404, StreamingHttpResponse
 from rest_framework import viewsets, permissions, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
+from rest_framework.reverse import reverse
 from django.contrib.auth.models import User
-from django.db.models import Sum, Count
+from . import (
+    caching, export, jobs, leaderboard, profiling, recommendations, rollups, search, teams, timeseries
+)
+from .ingest import MAX_BATCH_SIZE, ingest_activities
 from .models import UserProfile, Team, Activity, Leaderboard, Workout
+from .mongo import get_collection
+from .parsers import NDJSONParser
+from .scoring import day_number, get_rules, rescore_around
 from .serializers import (
     UserSerializer, UserProfileSerializer, TeamSerializer,
     ActivitySerializer, LeaderboardSerializer, WorkoutSerializer
 )
 
 
-class UserViewSet(viewsets.ModelViewSet):
+class ObjectIdLookupMixin:
+    """
+    Look objects up by ObjectId primary key.
+
+    djongo compares string lookups on ObjectIdField as plain strings, which
+    never match, so convert the URL value before the lookup.
+    """
+
+    def get_object(self):
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            self.kwargs[lookup_url_kwarg] = ObjectId(self.kwargs[lookup_url_kwarg])
+        except (InvalidId, TypeError):
+            raise Http404
+        return super().get_object()
+
+
+class ProjectionMixin:
+    """Load only what the serializer's ``?fields=``/``?expand=`` selection shows"""
+
+    def project(self, queryset):
+        # Pagination reads the ordering fields to build the next cursor
+        ordering = [field.lstrip('-') for field in getattr(self, 'ordering', None) or ()]
+        return self.get_serializer().project(queryset, extra=ordering)
+
+    def filter_queryset(self, queryset):
+        return self.project(super().filter_queryset(queryset))
+
+
+class PaginatedActionMixin(ProjectionMixin):
+    """Page the querysets returned by custom list actions like list() does"""
+
+    def paginated_response(self, queryset):
+        queryset = self.project(queryset)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            serializer = self.get_serializer(page, many=True)
+            return self.get_paginated_response(serializer.data)
+        serializer = self.get_serializer(queryset, many=True)
+        return Response(serializer.data)
+
+
+class UserViewSet(ProjectionMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing users
     """
@@ -25,7 +78,7 @@ class UserViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class UserProfileViewSet(viewsets.ModelViewSet):
+class UserProfileViewSet(ObjectIdLookupMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing user profiles
     """
@@ -35,9 +88,10 @@ class UserProfileViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         """Filter queryset based on user permissions"""
+        queryset = UserProfile.objects.select_related('user')
         if self.request.user.is_staff:
-            return UserProfile.objects.all()
-        return UserProfile.objects.filter(user=self.request.user)
+            return queryset
+        return queryset.filter(user=self.request.user)
 
     @action(detail=False, methods=['get'])
     def my_profile(self, request):
@@ -47,7 +101,7 @@ class UserProfileViewSet(viewsets.ModelViewSet):
         return Response(serializer.data)
 
 
-class TeamViewSet(viewsets.ModelViewSet):
+class TeamViewSet(ObjectIdLookupMixin, ProjectionMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing teams
     """
@@ -55,112 +109,293 @@ class TeamViewSet(viewsets.ModelViewSet):
     serializer_class = TeamSerializer
     permission_classes = [permissions.AllowAny]
 
-    @action(detail=True, methods=['post'])
+    def get_queryset(self):
+        """Load captains alongside the teams, and members only when shown"""
+        if self.action in ('stats', 'members'):
+            return Team.objects.all()
+        queryset = Team.objects.select_related('captain')
+        if 'members' in self.get_serializer().fields:
+            queryset = queryset.prefetch_related('members')
+        return queryset
+
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def join(self, request, pk=None):
         """Allow a user to join a team"""
         team = self.get_object()
-        user = request.user
         
-        if user in team.members.all():
+        if not teams.join(team.pk, [request.user.pk]):
             return Response(
                 {'detail': 'You are already a member of this team'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        team.members.add(user)
-        team.save()
+        # The membership write already bumped the count, totals and updated_at
+        team.refresh_from_db(fields=teams.MATERIALIZED_FIELDS + ('updated_at',))
         
         serializer = self.get_serializer(team)
         return Response(serializer.data)
 
-    @action(detail=True, methods=['post'])
+    @action(detail=True, methods=['post'], permission_classes=[permissions.IsAuthenticated])
     def leave(self, request, pk=None):
         """Allow a user to leave a team"""
         team = self.get_object()
-        user = request.user
         
-        if user not in team.members.all():
+        if not teams.leave(team.pk, [request.user.pk]):
             return Response(
                 {'detail': 'You are not a member of this team'},
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        team.members.remove(user)
-        team.save()
-        
         return Response({'detail': 'Successfully left the team'})
 
+    @action(
+        detail=True,
+        methods=['post'],
+        url_path='members/bulk',
+        permission_classes=[permissions.IsAuthenticated]
+    )
+    def bulk_members(self, request, pk=None):
+        """Add and remove many members at once (captain or admin only)"""
+        team = self.get_object()
+        if not request.user.is_staff and team.captain_id != request.user.pk:
+            return Response(
+                {'detail': 'Only the team captain can change the roster'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        changes = {}
+        for key in ('add', 'remove'):
+            user_ids = request.data.get(key, [])
+            if not isinstance(user_ids, list) or not all(type(pk) is int for pk in user_ids):
+                return Response(
+                    {'detail': f"'{key}' must be a list of user ids"},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            changes[key] = user_ids
+        if len(changes['add']) + len(changes['remove']) > teams.MAX_ROSTER_SIZE:
+            return Response(
+                {'detail': f'Rosters are limited to {teams.MAX_ROSTER_SIZE} users per request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        known = set()
+        if changes['add']:
+            known = set(User.objects.filter(id__in=changes['add']).values_list('id', flat=True))
+        added = teams.join(team.pk, [pk for pk in changes['add'] if pk in known])
+        removed = teams.leave(team.pk, changes['remove'])
+        team.refresh_from_db(fields=teams.MATERIALIZED_FIELDS)
+        
+        return Response({
+            'added': len(added),
+            'removed': len(removed),
+            'unknown': [pk for pk in changes['add'] if pk not in known],
+            'member_count': team.member_count,
+        })
+
     @action(detail=True, methods=['get'])
     def stats(self, request, pk=None):
         """Get team statistics"""
         team = self.get_object()
-        
-        # Calculate team statistics
-        team_activities = Activity.objects.filter(user__in=team.members.all())
-        stats = team_activities.aggregate(
-            total_activities=Count('_id'),
-            total_points=Sum('points_earned'),
-            total_duration=Sum('duration'),
-            total_distance=Sum('distance')
+        return Response(teams.team_stats(team))
+
+    @action(detail=True, methods=['get'])
+    def members(self, request, pk=None):
+        """Page through a team's members in user id order"""
+        team = self.get_object()
+        # Page the membership rows on the (team_id, user_id) index, then load
+        # just that page of users
+        self.ordering = ('user_id',)
+        memberships = Team.members.through.objects.filter(team_id=team.pk)
+        page = self.paginate_queryset(memberships)
+        users = User.objects.in_bulk([membership.user_id for membership in page])
+        serializer = UserSerializer(
+            [users[membership.user_id] for membership in page if membership.user_id in users],
+            many=True,
+            context=self.get_serializer_context(),
         )
-        
-        return Response(stats)
+        return self.get_paginated_response(serializer.data)
 
 
-class ActivityViewSet(viewsets.ModelViewSet):
+class ActivityViewSet(ObjectIdLookupMixin, PaginatedActionMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing activities
     """
     queryset = Activity.objects.all()
     serializer_class = ActivitySerializer
     permission_classes = [permissions.AllowAny]
+    ordering = ('-date', '-_id')
 
     def get_queryset(self):
         """Filter queryset based on user permissions"""
         # Allow all users to see all activities for demo purposes
-        return Activity.objects.all()
+        return Activity.objects.select_related('user')
 
     def perform_create(self, serializer):
         """Set the user when creating an activity"""
         serializer.save(user=self.request.user)
+    
+    def perform_destroy(self, instance):
+        """Delete the activity and re-score the streaks it was part of"""
+        user_id, day = instance.user_id, day_number(instance.date)
+        instance.delete()
+        if get_rules().streak_bonus:
+            rescore_around(user_id, [day])
+
+    @action(
+        detail=False,
+        methods=['post'],
+        parser_classes=[JSONParser, NDJSONParser],
+        permission_classes=[permissions.IsAuthenticated]
+    )
+    def bulk(self, request):
+        """Create a batch of activities from a JSON array or NDJSON body"""
+        items = request.data
+        if not isinstance(items, list):
+            return Response(
+                {'detail': 'Expected a list of activities'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > MAX_BATCH_SIZE:
+            return Response(
+                {'detail': f'Batches are limited to {MAX_BATCH_SIZE} activities'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        activities, errors = ingest_activities(
+            request.user, items, context=self.get_serializer_context()
+        )
+        if not activities:
+            response_status = status.HTTP_400_BAD_REQUEST
+        elif errors:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_201_CREATED
+        
+        return Response({
+            'created': len(activities),
+            'ids': [str(activity._id) for activity in activities],
+            'errors': errors,
+        }, status=response_status)
 
     @action(detail=False, methods=['get'])
     def my_activities(self, request):
         """Get current user's activities"""
-        activities = Activity.objects.filter(user=request.user)
-        serializer = self.get_serializer(activities, many=True)
-        return Response(serializer.data)
+        activities = self.get_queryset().filter(user=request.user)
+        return self.paginated_response(activities)
 
     @action(detail=False, methods=['get'])
     def stats(self, request):
-        """Get user's activity statistics"""
-        activities = Activity.objects.filter(user=request.user)
-        stats = activities.aggregate(
-            total_activities=Count('_id'),
-            total_points=Sum('points_earned'),
-            total_duration=Sum('duration'),
-            total_distance=Sum('distance')
-        )
-        return Response(stats)
+        """
+        Get user's activity statistics, read from their rollup.
+
+        ``breakdown=type,month`` adds the same totals per activity type and
+        per month.
+        """
+        breakdowns = [name for name in request.query_params.get('breakdown', '').split(',') if name]
+        if any(name not in rollups.BREAKDOWNS for name in breakdowns):
+            return Response(
+                {'detail': f"Unknown breakdown. Choose from: {', '.join(rollups.BREAKDOWNS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(rollups.user_stats(request.user.pk, breakdowns))
+
+    @action(detail=False, methods=['get'])
+    def timeseries(self, request):
+        """
+        Get the current user's activity totals over time, as columns.
+
+        ``interval`` is day, week or month and ``metric`` points, duration
+        or distance; ``type`` limits the series to one activity type.
+        ``since`` and ``until`` (exclusive) are dates; by default the series
+        ends with the current bucket.
+        """
+        params = request.query_params
+        interval = params.get('interval', 'day')
+        metric = params.get('metric', 'points')
+        if interval not in timeseries.INTERVALS:
+            return Response(
+                {'detail': f"Unknown interval. Choose from: {', '.join(timeseries.INTERVALS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if metric not in timeseries.METRICS:
+            return Response(
+                {'detail': f"Unknown metric. Choose from: {', '.join(timeseries.METRICS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            since, until = (
+                timeseries.parse_day(params[name]) if name in params else None
+                for name in ('since', 'until')
+            )
+            series = timeseries.user_series(
+                request.user.pk, interval, activity_type=params.get('type'), since=since, until=until
+            )
+        except ValueError as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'interval': interval,
+            'metric': metric,
+            'type': params.get('type'),
+            'buckets': series.buckets,
+            'values': getattr(series, metric),
+            'activities': series.activities,
+        })
+
+    @action(detail=False, methods=['get'], permission_classes=[permissions.IsAdminUser])
+    def export(self, request):
+        """
+        Stream activities as Parquet, Arrow IPC or CSV (admin only).
+
+        ``output`` picks the format, Parquet by default; ``user``, ``type``, ``since`` and
+        ``until`` (exclusive) filter the rows.
+        """
+        params = request.query_params
+        output = params.get('output', export.DEFAULT_FORMAT)
+        if output not in export.FORMATS:
+            return Response(
+                {'detail': f"Unsupported output. Choose one of: {', '.join(export.FORMATS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            match = export.build_filter(
+                user_id=int(params['user']) if 'user' in params else None,
+                activity_type=params.get('type'),
+                since=export.parse_bound(params['since']) if 'since' in params else None,
+                until=export.parse_bound(params['until']) if 'until' in params else None,
+            )
+        except ValueError as exc:
+            return Response({'detail': str(exc)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        content_type, extension = export.FORMATS[output]
+        # Take the collection now: the response is iterated after the view returns
+        chunks = export.export_activities(match, output, collection=get_collection(Activity))
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="activities.{extension}"'
+        return response
 
 
-class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
+class LeaderboardViewSet(ObjectIdLookupMixin, ProjectionMixin, viewsets.ReadOnlyModelViewSet):
     """
     ViewSet for viewing leaderboard (read-only)
     """
     queryset = Leaderboard.objects.all()
     serializer_class = LeaderboardSerializer
     permission_classes = [permissions.AllowAny]
+    ordering = ('rank', '_id')
 
     def get_queryset(self):
         """Filter leaderboard by period"""
-        queryset = Leaderboard.objects.all()
+        queryset = Leaderboard.objects.select_related('user')
         period = self.request.query_params.get('period', 'all_time')
         
         if period:
             queryset = queryset.filter(period=period)
         
-        return queryset.order_by('rank')
+        return queryset.order_by(*self.ordering)
+
+    @caching.cached_response(caching.LEADERBOARD)
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
 
     @action(detail=False, methods=['post'])
     def update_rankings(self, request):
@@ -171,69 +406,169 @@ class LeaderboardViewSet(viewsets.ReadOnlyModelViewSet):
                 status=status.HTTP_403_FORBIDDEN
             )
         
-        # Update leaderboard for all users
-        users = User.objects.all()
-        period = request.data.get('period', 'all_time')
-        
-        for user in users:
-            activities = Activity.objects.filter(user=user)
-            
-            stats = activities.aggregate(
-                total_activities=Count('_id'),
-                total_points=Sum('points_earned'),
-                total_duration=Sum('duration'),
-                total_distance=Sum('distance')
-            )
-            
-            Leaderboard.objects.update_or_create(
-                user=user,
-                period=period,
-                defaults={
-                    'total_points': stats['total_points'] or 0,
-                    'total_activities': stats['total_activities'] or 0,
-                    'total_duration': stats['total_duration'] or 0,
-                    'total_distance': stats['total_distance'] or 0,
-                }
+        period = request.data.get('period', leaderboard.DEFAULT_PERIOD)
+        if period not in leaderboard.PERIODS:
+            return Response(
+                {'detail': f"Unknown period. Choose one of: {', '.join(leaderboard.PERIODS)}"},
+                status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Update ranks
-        leaderboard_entries = Leaderboard.objects.filter(period=period).order_by('-total_points')
-        for index, entry in enumerate(leaderboard_entries, start=1):
-            entry.rank = index
-            entry.save()
+        # Rebuilds run on a job worker; poll the returned job for progress
+        job, created = jobs.enqueue_leaderboard_rebuild(period)
         
-        return Response({'detail': 'Leaderboard updated successfully'})
+        return Response(
+            {
+                'detail': 'Leaderboard update queued' if created else 'Leaderboard update already queued',
+                'job': jobs.to_representation(job),
+            },
+            status=status.HTTP_202_ACCEPTED,
+            headers={'Location': reverse('job-detail', args=[str(job['_id'])], request=request)},
+        )
 
 
-class WorkoutViewSet(viewsets.ModelViewSet):
+class WorkoutViewSet(ObjectIdLookupMixin, PaginatedActionMixin, viewsets.ModelViewSet):
     """
     ViewSet for managing workouts
     """
     queryset = Workout.objects.all()
     serializer_class = WorkoutSerializer
     permission_classes = [permissions.AllowAny]
+    ordering = ('-created_at', '-_id')
+
+    def get_queryset(self):
+        """Load each workout's creator alongside it"""
+        return Workout.objects.select_related('created_by')
 
     def perform_create(self, serializer):
         """Set the creator when creating a workout"""
         serializer.save(created_by=self.request.user)
 
+    def get_fitness_level(self):
+        """Return the requesting user's fitness level, looked up once per request"""
+        if not hasattr(self, '_fitness_level'):
+            try:
+                profile = UserProfile.objects.get(user=self.request.user)
+                self._fitness_level = profile.fitness_level
+            except UserProfile.DoesNotExist:
+                self._fitness_level = 'beginner'
+        return self._fitness_level
+
     @action(detail=False, methods=['get'])
     def recommended(self, request):
-        """Get recommended workouts based on user's fitness level"""
+        """
+        The best workouts at the user's fitness level, ranked by their recent activity.
+
+        ``limit`` sets how many (at most 100); ``muscles`` boosts workouts
+        targeting them and ``equipment`` leaves out workouts needing anything
+        not listed. Both are comma-separated.
+        """
+        params = request.query_params
         try:
-            profile = UserProfile.objects.get(user=request.user)
-            fitness_level = profile.fitness_level
-        except UserProfile.DoesNotExist:
-            fitness_level = 'beginner'
+            limit = int(params.get('limit', recommendations.DEFAULT_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= recommendations.MAX_LIMIT:
+            return Response(
+                {'detail': f'limit must be between 1 and {recommendations.MAX_LIMIT}'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        workouts = Workout.objects.filter(difficulty=fitness_level)
-        serializer = self.get_serializer(workouts, many=True)
-        return Response(serializer.data)
+        ranked = recommendations.recommend(
+            request.user.pk if request.user.is_authenticated else None,
+            self.get_fitness_level(),
+            limit=limit,
+            muscles=[muscle for muscle in params.get('muscles', '').split(',') if muscle],
+            equipment=[item for item in params['equipment'].split(',') if item] if 'equipment' in params else None,
+        )
+        return Response({'results': self.ranked_results(ranked)})
+    
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full-text search over titles, descriptions, exercises and target muscles.
+
+        Every word of ``q`` must match. ``difficulty``, ``activity_type`` and
+        ``equipment`` narrow the results, and ``facets`` counts the values of
+        each over the matches. Paged with ``limit`` (at most 100) and ``offset``.
+        """
+        params = request.query_params
+        try:
+            limit = int(params.get('limit', search.DEFAULT_LIMIT))
+            offset = int(params.get('offset', 0))
+        except ValueError:
+            limit = offset = -1
+        if not 1 <= limit <= search.MAX_LIMIT or offset < 0:
+            return Response(
+                {'detail': f'limit must be between 1 and {search.MAX_LIMIT} and offset at least 0'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        count, ranked, facets = search.index.search(
+            params.get('q', ''),
+            difficulty=params.get('difficulty'),
+            activity_type=params.get('activity_type'),
+            equipment=params.get('equipment'),
+            limit=limit,
+            offset=offset,
+        )
+        return Response({'count': count, 'facets': facets, 'results': self.ranked_results(ranked)})
+    
+    def ranked_results(self, ranked):
+        """Serialize ``(workout id, score)`` pairs from an index, keeping their order"""
+        workouts = self.project(self.get_queryset()).in_bulk([workout_id for workout_id, _ in ranked])
+        # Workouts deleted by another process stay in the indexes until they reload
+        ranked = [(workouts[workout_id], score) for workout_id, score in ranked if workout_id in workouts]
+        results = self.get_serializer([workout for workout, _ in ranked], many=True).data
+        for result, (_, score) in zip(results, ranked):
+            result['score'] = round(score, 3)
+        return results
 
     @action(detail=False, methods=['get'])
+    @caching.cached_response(caching.WORKOUTS)
     def by_difficulty(self, request):
         """Get workouts filtered by difficulty"""
         difficulty = request.query_params.get('difficulty', 'beginner')
-        workouts = Workout.objects.filter(difficulty=difficulty)
-        serializer = self.get_serializer(workouts, many=True)
-        return Response(serializer.data)
+        workouts = self.get_queryset().filter(difficulty=difficulty)
+        return self.paginated_response(workouts)
+
+
+@api_view(['GET', 'DELETE'])
+@permission_classes([permissions.IsAdminUser])
+def profiling_summary(request):
+    """Per-endpoint request profiles, worst first; DELETE resets the window"""
+    if not profiling.is_enabled():
+        raise Http404
+    if request.method == 'DELETE':
+        profiling.log.clear()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+    
+    sort = request.query_params.get('sort', 'p95_ms')
+    return Response({
+        'requests': len(profiling.log.records()),
+        'endpoints': profiling.summary(sort),
+    })
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def job_list(request):
+    """Recent background jobs, newest first, optionally filtered by status or name"""
+    job_status = request.query_params.get('status')
+    if job_status and job_status not in jobs.STATUSES:
+        return Response(
+            {'detail': f"Unknown status. Choose one of: {', '.join(jobs.STATUSES)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    results = jobs.list_jobs(status=job_status, name=request.query_params.get('name'))
+    return Response([jobs.to_representation(job) for job in results])
+
+
+@api_view(['GET'])
+@permission_classes([permissions.IsAdminUser])
+def job_detail(request, job_id):
+    """Status and progress of one background job"""
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise Http404
+    return Response(jobs.to_representation(job))
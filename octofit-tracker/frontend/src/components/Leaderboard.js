@@ -1,14 +1,28 @@
 import React, { useState, useEffect } from 'react';
 
+const apiBase = `https://${process.env.REACT_APP_CODESPACE_NAME}-8000.app.github.dev/api`;
+
+// Stream entries and REST rows both carry user_id at the top level
+const applyDelta = (entries, delta) => {
+  const byUser = new Map(entries.map((entry) => [entry.user_id, entry]));
+  delta.removed.forEach((userId) => byUser.delete(userId));
+  delta.changes.forEach((entry) => byUser.set(entry.user_id, entry));
+  return [...byUser.values()].sort((a, b) => a.rank - b.rank || a.user_id - b.user_id);
+};
+
 const Leaderboard = () => {
   const [leaderboard, setLeaderboard] = useState([]);
   const [loading, setLoading] = useState(true);
   const [error, setError] = useState(null);
 
   useEffect(() => {
+    // Once the stream has sent a snapshot it owns the list; a REST page
+    // arriving later would replace the streamed top entries with a shorter page
+    let streaming = false;
+
     const fetchLeaderboard = async () => {
       try {
-        const apiUrl = `https://${process.env.REACT_APP_CODESPACE_NAME}-8000.app.github.dev/api/leaderboard/`;
+        const apiUrl = `${apiBase}/leaderboard/`;
         console.log('Leaderboard - Fetching from:', apiUrl);
         
         const response = await fetch(apiUrl);
@@ -23,16 +37,44 @@ const Leaderboard = () => {
         const leaderboardData = data.results || data;
         console.log('Leaderboard - Processed data:', leaderboardData);
         
+        if (streaming) return;
         setLeaderboard(leaderboardData);
         setLoading(false);
       } catch (err) {
         console.error('Leaderboard - Error fetching data:', err);
+        if (streaming) return;
         setError(err.message);
         setLoading(false);
       }
     };
 
     fetchLeaderboard();
+
+    // Live rank changes; a snapshot replaces the list, deltas patch it
+    let version = 0;
+    const stream = new EventSource(`${apiBase}/leaderboard/stream/`);
+    stream.addEventListener('snapshot', (event) => {
+      const snapshot = JSON.parse(event.data);
+      streaming = true;
+      version = snapshot.version;
+      setLeaderboard(snapshot.entries);
+      setError(null);
+      setLoading(false);
+    });
+    stream.addEventListener('delta', (event) => {
+      const delta = JSON.parse(event.data);
+      if (delta.version <= version) return;
+      version = delta.version;
+      setLeaderboard((entries) => applyDelta(entries, delta));
+    });
+    stream.onerror = () => {
+      // Without an ASGI server the stream isn't served at all; rather than
+      // reconnecting forever, stop and keep the list already shown
+      console.warn('Leaderboard - Stream unavailable, showing the last loaded standings');
+      stream.close();
+    };
+
+    return () => stream.close();
   }, []);
 
   if (loading) return <div className="container mt-4">Loading leaderboard...</div>;
@@ -58,7 +100,7 @@ const Leaderboard = () => {
           <tbody>
             {leaderboard.length > 0 ? (
               leaderboard.map((entry, index) => (
-                <tr key={entry.id} className={index < 3 ? 'table-active' : ''}>
+                <tr key={entry.user_id} className={index < 3 ? 'table-active' : ''}>
                   <td className="text-center">
                     {index === 0 && <span className="badge bg-warning text-dark fs-6">🥇 1</span>}
                     {index === 1 && <span className="badge bg-secondary text-white fs-6">🥈 2</span>}
@@ -66,7 +108,7 @@ const Leaderboard = () => {
                     {index > 2 && <span className="badge bg-light text-dark border">{index + 1}</span>}
                   </td>
                   <td className="fw-bold">{entry.username || entry.user?.username || 'Unknown'}</td>
-                  <td><span className="badge bg-info text-dark">{entry.user?.team_name || 'No Team'}</span></td>
+                  <td><span className="badge bg-info text-dark">{entry.team_name || entry.user?.team_name || 'No Team'}</span></td>
                   <td className="text-center fw-bold text-warning">{entry.total_points}</td>
                   <td className="text-center">{entry.total_activities}</td>
                 </tr>